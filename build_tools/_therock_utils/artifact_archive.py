@@ -0,0 +1,318 @@
+"""Reads artifact archives in place.
+
+An artifact archive (see `fileset_tool.py artifact-archive`) is a tarball whose
+first member is `artifact_manifest.txt`, optionally followed by an
+`artifact_index.json` (see `artifact_index.py`), followed by the files of each
+manifest relpath. Flattening an archive strips the manifest relpath from each
+member name, which is the relative path the member has in an artifact dir.
+
+`ArtifactArchive` lists the members of an archive by that relative path
+without extracting anything: if the archive has an index, only its first few
+KiB are decompressed. Entries are `ArchiveEntry` objects, which implement the
+parts of the `os.DirEntry` interface that do not need a file system path, and
+read their contents from the archive on demand.
+
+Archives are compressed as a single stream, so contents are read forward
+only: reading the members of an archive in archive order decompresses it once,
+while reading a member that precedes the last one read starts over from the
+beginning of the archive.
+"""
+
+from typing import BinaryIO
+
+import os
+from pathlib import Path
+import posixpath
+import shutil
+import tarfile
+
+from .artifact_index import (
+    ARTIFACT_INDEX_NAME,
+    ENTRY_DIR,
+    ENTRY_FILE,
+    ENTRY_HARDLINK,
+    ENTRY_SYMLINK,
+    ArtifactIndex,
+    IndexEntry,
+)
+from .compression import open_compressed_reader
+
+# Symlink chains longer than this are treated as dangling (as the OS does).
+_MAX_SYMLINK_HOPS = 40
+
+_COPY_CHUNK_SIZE = 1 << 20
+
+
+class ManifestPrefixes:
+    """Maps archive member names to paths relative to their manifest relpath.
+
+    Looks up each parent directory of a member name in a dict instead of
+    testing every relpath, so the cost is independent of the manifest size.
+    If relpaths nest, the one listed first in the manifest wins.
+    """
+
+    def __init__(self, relpaths: list[str]):
+        self.relpaths = [relpath for relpath in relpaths if relpath]
+        # Manifest position of each relpath.
+        self._order = {}
+        for i, relpath in enumerate(self.relpaths):
+            self._order.setdefault(relpath, i)
+
+    def scope(self, member_name: str) -> str | None:
+        """Strips the manifest relpath prefix that a member is a part of."""
+        best = None
+        sep = member_name.find("/")
+        while sep >= 0:
+            order = self._order.get(member_name[:sep])
+            if order is not None and (best is None or order < best[0]):
+                best = (order, sep)
+            sep = member_name.find("/", sep + 1)
+        if best is None:
+            return None
+        return member_name[best[1] + 1 :]
+
+
+def read_archive_header(
+    artifact_path: Path, tf: tarfile.TarFile
+) -> tuple[ManifestPrefixes, ArtifactIndex | None, tarfile.TarInfo | None]:
+    """Reads the manifest and (if present) index from the start of an archive.
+
+    Returns the manifest prefixes, the index and the first payload member.
+    """
+    manifest_member = tf.next()
+    if manifest_member is None or manifest_member.name != "artifact_manifest.txt":
+        raise IOError(
+            f"Artifact archive {artifact_path} must have artifact_manifest.txt as its first member"
+        )
+    with tf.extractfile(manifest_member) as mf_file:
+        prefixes = ManifestPrefixes(mf_file.read().decode().splitlines())
+    index = None
+    member = tf.next()
+    # Archives created before the index was added do not have one.
+    if member is not None and member.name == ARTIFACT_INDEX_NAME:
+        with tf.extractfile(member) as index_file:
+            index = ArtifactIndex.from_bytes(index_file.read())
+        member = tf.next()
+    return prefixes, index, member
+
+
+def check_not_delta(artifact_path: Path, index: ArtifactIndex | None):
+    if index is not None and index.delta_base is not None:
+        raise IOError(
+            f"Artifact archive {artifact_path} is a delta archive: flatten it "
+            f"with artifact-flatten --base and --delta"
+        )
+
+
+class ArtifactArchive:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # Entries by relative path, in archive order.
+        self.entries: dict[str, ArchiveEntry] = {}
+        self._by_member_name: dict[str, ArchiveEntry] = {}
+        # Forward reader for contents: the open archive and its next member.
+        self._archive_file: BinaryIO | None = None
+        self._tf: tarfile.TarFile | None = None
+        self._next_member: tarfile.TarInfo | None = None
+        self._next_order = 0
+        # Whether the next member is yet to be read, which is deferred while
+        # the contents of the previous one are being read.
+        self._advance = False
+
+        with open_compressed_reader(self.path) as archive_file, tarfile.TarFile.open(
+            fileobj=archive_file, mode="r:"
+        ) as tf:
+            prefixes, index, member = read_archive_header(self.path, tf)
+            check_not_delta(self.path, index)
+            if index is not None:
+                index_entries = index.entries.values()
+            else:
+                # Without an index, list the members by reading through the
+                # archive (skipping over their contents).
+                index_entries = []
+                while member:
+                    index_entries.append(IndexEntry.from_tarinfo(member))
+                    member = tf.next()
+            for order, index_entry in enumerate(index_entries):
+                relpath = prefixes.scope(index_entry.path)
+                if relpath is None:
+                    raise IOError(
+                        f"Artifact archive {self.path} has a member not in its "
+                        f"manifest: {index_entry.path}"
+                    )
+                entry = ArchiveEntry(self, relpath, index_entry, order)
+                self.entries[relpath] = entry
+                self._by_member_name[index_entry.path] = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def member(self, member_name: str) -> "ArchiveEntry | None":
+        """Returns the entry of an archive member name, if any."""
+        return self._by_member_name.get(member_name)
+
+    def open_entry(self, entry: "ArchiveEntry") -> BinaryIO:
+        """Returns a file object reading the contents of a file entry.
+
+        It is valid until the next call. See the module docstring for the cost
+        of reading entries out of archive order.
+        """
+        if not entry.is_file(follow_symlinks=False):
+            raise IOError(f"Cannot read contents of non-file {entry}")
+        if entry.type == ENTRY_HARDLINK:
+            target = entry.hardlink_target()
+            if target is None:
+                raise IOError(f"Hardlink target of {entry} is not in the archive")
+            entry = target
+        restarted = False
+        if self._tf is None or entry.order < self._next_order + self._advance:
+            self._restart()
+            restarted = True
+        while True:
+            if self._advance:
+                self._next_member = self._tf.next()
+                self._next_order += 1
+            member = self._next_member
+            if member is None:
+                if restarted:
+                    raise IOError(f"Artifact archive {self.path} is missing {entry}")
+                # Only an index out of archive order gets here.
+                self._restart()
+                restarted = True
+                continue
+            self._advance = True
+            if member.name == entry.member_name:
+                return self._tf.extractfile(member)
+
+    def close(self):
+        if self._tf is not None:
+            self._tf.close()
+            self._archive_file.close()
+            self._tf = None
+            self._archive_file = None
+
+    def _restart(self):
+        self.close()
+        self._archive_file = open_compressed_reader(self.path)
+        self._tf = tarfile.TarFile.open(fileobj=self._archive_file, mode="r:")
+        _, _, self._next_member = read_archive_header(self.path, self._tf)
+        self._next_order = 0
+        self._advance = False
+
+
+class ArchiveEntry:
+    """A member of an `ArtifactArchive`, with the parts of the `os.DirEntry`
+    interface that do not need a file system path."""
+
+    __slots__ = ["archive", "relpath", "index_entry", "order"]
+
+    def __init__(
+        self,
+        archive: ArtifactArchive,
+        relpath: str,
+        index_entry: IndexEntry,
+        order: int,
+    ):
+        self.archive = archive
+        self.relpath = relpath
+        self.index_entry = index_entry
+        # Position among the payload members of the archive.
+        self.order = order
+
+    @property
+    def name(self) -> str:
+        return self.relpath.rpartition("/")[2]
+
+    @property
+    def member_name(self) -> str:
+        return self.index_entry.path
+
+    @property
+    def type(self) -> str:
+        return self.index_entry.type
+
+    @property
+    def mode(self) -> int:
+        return self.index_entry.mode
+
+    @property
+    def link_target(self) -> str:
+        """The target of a symlink (as `os.readlink` would return it)."""
+        if self.type != ENTRY_SYMLINK:
+            raise OSError(f"Not a symlink: {self}")
+        return self.index_entry.target
+
+    def is_dir(self, *, follow_symlinks: bool = True) -> bool:
+        entry = self.resolve() if follow_symlinks else self
+        return entry is not None and entry.type == ENTRY_DIR
+
+    def is_file(self, *, follow_symlinks: bool = True) -> bool:
+        entry = self.resolve() if follow_symlinks else self
+        return entry is not None and entry.type in (ENTRY_FILE, ENTRY_HARDLINK)
+
+    def is_symlink(self) -> bool:
+        return self.type == ENTRY_SYMLINK
+
+    def is_junction(self) -> bool:
+        return False
+
+    def hardlink_target(self) -> "ArchiveEntry | None":
+        """Returns the entry holding the contents of a hardlink (which always
+        precedes it in the archive), or None if this is not a hardlink."""
+        if self.type != ENTRY_HARDLINK:
+            return None
+        return self.archive.member(self.index_entry.target)
+
+    def resolve(self) -> "ArchiveEntry | None":
+        """Follows symlinks within the archive, in every component of the path
+        (i.e. `lib/foo` where `lib` is a symlink to `lib64`).
+
+        Returns None if a symlink is dangling, which includes absolute symlinks
+        and those leading out of the archive.
+        """
+        # Components yet to be resolved, last one first.
+        pending = self.member_name.split("/")[::-1]
+        resolved = ""
+        hops = 0
+        while pending:
+            part = pending.pop()
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if not resolved:
+                    return None
+                resolved = posixpath.dirname(resolved)
+                continue
+            name = posixpath.join(resolved, part)
+            entry = self.archive.member(name)
+            if entry is not None and entry.type == ENTRY_SYMLINK:
+                hops += 1
+                target = entry.index_entry.target
+                if hops > _MAX_SYMLINK_HOPS or posixpath.isabs(target):
+                    return None
+                pending.extend(target.split("/")[::-1])
+                continue
+            if pending and entry is not None and entry.type != ENTRY_DIR:
+                return None
+            # Parent directories of members need not be members themselves.
+            resolved = name
+        return self.archive.member(resolved)
+
+    def open(self) -> BinaryIO:
+        """Opens the contents of a file entry (see `ArtifactArchive.open_entry`)."""
+        return self.archive.open_entry(self)
+
+    def extract_to(self, dest_path: Path):
+        """Writes the contents and permissions of a file entry to `dest_path`."""
+        with self.open() as member_file, open(dest_path, "wb") as out_file:
+            shutil.copyfileobj(member_file, out_file, _COPY_CHUNK_SIZE)
+            os.fchmod(out_file.fileno(), self.mode)
+
+    def __str__(self):
+        return f"{self.archive.path}/{self.member_name}"
+
+    def __repr__(self):
+        return f"<ArchiveEntry {self.relpath!r} in {self.archive.path.name}>"
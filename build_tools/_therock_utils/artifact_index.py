@@ -0,0 +1,251 @@
+"""Per-file index of the contents of an artifact archive.
+
+`artifact-archive` stores an `artifact_index.json` member directly after
+`artifact_manifest.txt`. It records every other member of the archive with its
+type, permission bits, size, content hash (files and hardlinks) and target
+(symlinks and hardlinks). Since
+it precedes the payload, consumers can list an archive or decide what to
+extract by only decompressing its first few KiB, and extraction can verify each
+file against its recorded hash while streaming.
+
+The index is compact JSON, shown formatted here:
+
+    {
+        "version": 1,
+        "hash_algorithm": "sha256",
+        "entries": [
+            {"path": "stage/bin", "type": "dir", "mode": 493},
+            {"path": "stage/bin/tool", "type": "file", "mode": 493,
+             "size": 1234, "digest": "..."},
+            {"path": "stage/lib/libfoo.so", "type": "symlink", "mode": 511,
+             "target": "libfoo.so.1"},
+            {"path": "stage/bin/tool2", "type": "hardlink", "mode": 493,
+             "size": 1234, "digest": "...", "target": "stage/bin/tool"}
+        ]
+    }
+
+Paths are archive member names. A hardlink entry is stored as a tar hardlink
+member whose target is an earlier "file" entry with the same contents. `build`
+indexes files that share an inode as hardlinks (unless told not to, which keeps
+reproducible archives independent of how their inputs are linked), and can
+also do so for files with identical contents and permissions.
+
+A delta archive (see `fileset_tool.py artifact-delta`) has a "delta_base" key:
+the `fingerprint()` of the index of the archive it is a delta against. Its
+index describes the complete new tree, but only entries that differ from the
+base are stored as members.
+"""
+
+from typing import Callable, Iterable
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import stat
+import tarfile
+
+from .hash_util import calculate_hash
+
+ARTIFACT_INDEX_NAME = "artifact_index.json"
+INDEX_VERSION = 1
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+# Entry types.
+ENTRY_DIR = "dir"
+ENTRY_FILE = "file"
+ENTRY_SYMLINK = "symlink"
+ENTRY_HARDLINK = "hardlink"
+
+_TYPE_MODE_BITS = {
+    ENTRY_DIR: stat.S_IFDIR,
+    ENTRY_FILE: stat.S_IFREG,
+    ENTRY_SYMLINK: stat.S_IFLNK,
+    ENTRY_HARDLINK: stat.S_IFREG,
+}
+
+
+class IndexEntry:
+    __slots__ = ["path", "type", "mode", "size", "digest", "target"]
+
+    def __init__(
+        self,
+        path: str,
+        type: str,
+        mode: int,
+        *,
+        size: int = 0,
+        digest: str = "",
+        target: str = "",
+    ):
+        self.path = path
+        self.type = type
+        self.mode = mode
+        self.size = size
+        self.digest = digest
+        self.target = target
+
+    def to_json(self) -> dict:
+        d = {"path": self.path, "type": self.type, "mode": self.mode}
+        if self.type == ENTRY_FILE or self.type == ENTRY_HARDLINK:
+            d["size"] = self.size
+            d["digest"] = self.digest
+        if self.type == ENTRY_SYMLINK or self.type == ENTRY_HARDLINK:
+            d["target"] = self.target
+        return d
+
+    @staticmethod
+    def from_json(d: dict) -> "IndexEntry":
+        return IndexEntry(
+            d["path"],
+            d["type"],
+            d["mode"],
+            size=d.get("size", 0),
+            digest=d.get("digest", ""),
+            target=d.get("target", ""),
+        )
+
+    @staticmethod
+    def from_tarinfo(info: tarfile.TarInfo) -> "IndexEntry":
+        """Makes an entry (without a digest) from an archive member."""
+        if info.issym():
+            return IndexEntry(info.name, ENTRY_SYMLINK, info.mode, target=info.linkname)
+        elif info.islnk():
+            return IndexEntry(
+                info.name, ENTRY_HARDLINK, info.mode, target=info.linkname
+            )
+        elif info.isdir():
+            return IndexEntry(info.name, ENTRY_DIR, info.mode)
+        return IndexEntry(info.name, ENTRY_FILE, info.mode, size=info.size)
+
+    def filemode(self) -> str:
+        """Returns an `ls -l` style mode string (i.e. "-rwxr-xr-x")."""
+        return stat.filemode(_TYPE_MODE_BITS[self.type] | self.mode)
+
+    def __repr__(self):
+        return f"IndexEntry({self.to_json()})"
+
+
+class ArtifactIndex:
+    def __init__(self, hash_algorithm: str = DEFAULT_HASH_ALGORITHM):
+        self.hash_algorithm = hash_algorithm
+        # Entries by path, in archive order.
+        self.entries: dict[str, IndexEntry] = {}
+        # Fingerprint of the base archive's index, for delta archives.
+        self.delta_base: str | None = None
+
+    def add(self, entry: IndexEntry):
+        self.entries[entry.path] = entry
+
+    def to_bytes(self) -> bytes:
+        contents = {
+            "version": INDEX_VERSION,
+            "hash_algorithm": self.hash_algorithm,
+        }
+        if self.delta_base is not None:
+            contents["delta_base"] = self.delta_base
+        contents["entries"] = [e.to_json() for e in self.entries.values()]
+        return json.dumps(contents, separators=(",", ":")).encode()
+
+    def fingerprint(self) -> str:
+        """Returns a sha256 hex digest identifying the indexed contents."""
+        return hashlib.sha256(self.to_bytes()).hexdigest()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "ArtifactIndex":
+        contents = json.loads(data)
+        version = contents.get("version")
+        if version != INDEX_VERSION:
+            raise IOError(f"Unsupported artifact index version: {version}")
+        index = ArtifactIndex(contents["hash_algorithm"])
+        index.delta_base = contents.get("delta_base")
+        for d in contents["entries"]:
+            index.add(IndexEntry.from_json(d))
+        return index
+
+    @staticmethod
+    def build(
+        members: Iterable[tuple[str, str]],
+        *,
+        hash_algorithm: str = DEFAULT_HASH_ALGORITHM,
+        jobs: int = 0,
+        dedup_content: bool = False,
+        link_inodes: bool = True,
+        normalize_mode: Callable[[int, str], int] | None = None,
+    ) -> "ArtifactIndex":
+        """Indexes (archive path, file system path) pairs.
+
+        File contents are hashed on a thread pool if `jobs > 1`. Files which
+        share an inode with an earlier file become hardlinks to it (if
+        `link_inodes`), as do files with the same contents and mode as an
+        earlier file if `dedup_content`. If given, `normalize_mode(mode, type)`
+        returns the mode to index for each entry.
+        """
+        index = ArtifactIndex(hash_algorithm)
+        file_entries: list[tuple[IndexEntry, str]] = []
+        # Hardlink entries and the entry they link to.
+        link_entries: list[tuple[IndexEntry, IndexEntry]] = []
+        first_by_inode: dict[tuple[int, int], IndexEntry] = {}
+        for arcname, fs_path in members:
+            st = os.lstat(fs_path)
+            mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISLNK(st.st_mode):
+                entry = IndexEntry(
+                    arcname, ENTRY_SYMLINK, mode, target=os.readlink(fs_path)
+                )
+            elif stat.S_ISDIR(st.st_mode):
+                entry = IndexEntry(arcname, ENTRY_DIR, mode)
+            elif stat.S_ISREG(st.st_mode):
+                inode = (st.st_dev, st.st_ino)
+                first = None
+                if link_inodes and st.st_nlink > 1:
+                    first = first_by_inode.get(inode)
+                if first is not None:
+                    entry = IndexEntry(
+                        arcname,
+                        ENTRY_HARDLINK,
+                        first.mode,
+                        size=first.size,
+                        target=first.path,
+                    )
+                    link_entries.append((entry, first))
+                else:
+                    entry = IndexEntry(arcname, ENTRY_FILE, mode, size=st.st_size)
+                    file_entries.append((entry, fs_path))
+                    first_by_inode[inode] = entry
+            else:
+                raise IOError(f"Unsupported file type for artifact index: {fs_path}")
+            if normalize_mode is not None:
+                entry.mode = normalize_mode(entry.mode, entry.type)
+            index.add(entry)
+
+        def hash_file(fs_path: str) -> str:
+            return calculate_hash(fs_path, hash_algorithm).hexdigest()
+
+        fs_paths = [fs_path for _, fs_path in file_entries]
+        if jobs > 1 and len(fs_paths) > 1:
+            with ThreadPoolExecutor(
+                max_workers=jobs, thread_name_prefix="index"
+            ) as executor:
+                digests = list(executor.map(hash_file, fs_paths))
+        else:
+            digests = [hash_file(fs_path) for fs_path in fs_paths]
+        for (entry, _), digest in zip(file_entries, digests):
+            entry.digest = digest
+
+        if dedup_content:
+            first_by_content: dict[tuple[str, int, int], IndexEntry] = {}
+            for entry, _ in file_entries:
+                if entry.size == 0:
+                    continue
+                key = (entry.digest, entry.size, entry.mode)
+                first = first_by_content.setdefault(key, entry)
+                if first is not entry:
+                    entry.type = ENTRY_HARDLINK
+                    entry.target = first.path
+        for entry, first in link_entries:
+            entry.digest = first.digest
+            if first.type == ENTRY_HARDLINK:
+                # The inode's first path was itself deduplicated by content.
+                entry.target = first.target
+        return index
@@ -16,14 +16,22 @@ Components are variable but are typically:
 Each valid artifact directory contains an `artifact_manifest.txt` file, which
 contains one relative path per line. That path represents a path into a TheRock
 build directory that its contents are subset from.
+
+An artifact may also be present as an archive of such a directory (i.e.
+`{name}_{component}_{target_family}.tar.xz`), see `fileset_tool.py
+artifact-archive`.
 """
 
 from typing import Callable
 
+import copy
 import re
 from pathlib import Path
 
+from .artifact_archive import ArtifactArchive
+from .compression import ARCHIVE_FORMATS
 from .pattern_match import PatternMatcher
+from .tree_index import TreeIndex
 
 
 class ArtifactName:
@@ -37,6 +45,23 @@ class ArtifactName:
 
 
 class ArtifactCatalog:
+    """Artifacts found in an artifacts/ dir.
+
+    Artifacts are either directories (as the build produces them) or archives
+    named `{artifact}.tar.xz` or `{artifact}.tar.zst` (as CI downloads them),
+    which are read in place (see `artifact_archive.py`). If both exist for an
+    artifact, the directory is used.
+
+    Each directory artifact contributes one base directory per manifest line,
+    and each archive artifact one base "directory" (the archive path) holding
+    the flattened contents of all of its manifest relpaths. Base directories
+    are only scanned when `pm` is first used, and each is scanned at most once:
+    views made with `filtered` share scans with the catalog they came from.
+
+    Archives stay open for reading entry contents until the catalog (or any of
+    its views) is closed, i.e. by using it as a context manager.
+    """
+
     def __init__(
         self,
         artifact_dir: Path,
@@ -44,18 +69,23 @@ class ArtifactCatalog:
     ):
         self.artifact_dir = artifact_dir
         self.artifact_basedirs: list[tuple[ArtifactName, Path]] = []
-        self.pm = PatternMatcher()
+        # Scans of base directories and the archives opened for them, shared
+        # by all views.
+        self._scans: dict[Path, TreeIndex] = {}
+        self._archives: list[ArtifactArchive] = []
+        self._pm: PatternMatcher | None = None
 
+        archives: list[tuple[str, Path]] = []
+        dir_names: set[str] = set()
         for subdir in self.artifact_dir.iterdir():
             if not subdir.is_dir():
+                for suffix in ARCHIVE_FORMATS.keys():
+                    if subdir.name.endswith(suffix):
+                        archives.append((subdir.name[: -len(suffix)], subdir))
                 continue
-            # Matches {name}_{component}_{target_family} with an optional
-            # extra suffix that we ignore.
-            m = re.match(r"^([^_]+)_([^_]+)_([^_]+)(_.+)?$", subdir.name)
-            if not m:
-                continue
-            name = ArtifactName(m.group(1), m.group(2), m.group(3))
-            if not filter(name):
+            dir_names.add(subdir.name)
+            name = _parse_artifact_name(subdir.name)
+            if name is None or not filter(name):
                 continue
             manifest = subdir / "artifact_manifest.txt"
             if not manifest.exists():
@@ -67,7 +97,70 @@ class ArtifactCatalog:
                 full_path = subdir / manifest_line
                 if full_path.exists():
                     self.artifact_basedirs.append((name, full_path))
-                    self.pm.add_basedir(full_path)
+        for archive_name, archive_path in archives:
+            if archive_name in dir_names:
+                continue
+            name = _parse_artifact_name(archive_name)
+            if name is None or not filter(name):
+                continue
+            self.artifact_basedirs.append((name, archive_path))
+
+    def filtered(self, filter: Callable[[ArtifactName], bool]) -> "ArtifactCatalog":
+        """Returns a view of the artifacts accepted by `filter`.
+
+        This is equivalent to `ArtifactCatalog(artifact_dir, filter)`, without
+        reading manifests again or rescanning base directories.
+        """
+        view = copy.copy(self)
+        view.artifact_basedirs = [
+            (an, basedir) for an, basedir in self.artifact_basedirs if filter(an)
+        ]
+        view._pm = None
+        return view
+
+    def close(self):
+        """Closes the archives read by this catalog and all of its views."""
+        for archive in self._archives:
+            archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def pm(self) -> PatternMatcher:
+        """All base directories merged into one PatternMatcher (as if added
+        with `add_basedir` in order).
+
+        Entries of archive artifacts are `ArchiveEntry` objects, which have no
+        file system `path`.
+        """
+        if self._pm is None:
+            pm = PatternMatcher()
+            for _, basedir in self.artifact_basedirs:
+                pm.all.update(self._scan(basedir))
+            self._pm = pm
+        return self._pm
+
+    def _scan(self, basedir: Path) -> TreeIndex:
+        scan = self._scans.get(basedir)
+        if scan is None:
+            if basedir.is_file():
+                archive = ArtifactArchive(basedir)
+                self._archives.append(archive)
+                scan = TreeIndex()
+                root_id = scan.add_root(str(basedir.absolute()))
+                for relpath, entry in archive.entries.items():
+                    prefix, sep, name = relpath.rpartition("/")
+                    scan.add_object(root_id, scan.intern_dir(prefix + sep), name, entry)
+            else:
+                basedir_pm = PatternMatcher()
+                basedir_pm.add_basedir(basedir)
+                scan = basedir_pm.all
+            self._scans[basedir] = scan
+        return scan
 
     @property
     def artifact_names(self) -> list[ArtifactName]:
@@ -80,3 +173,12 @@ class ArtifactCatalog:
             for an in self.artifact_names
             if an.target_family != "generic"
         )
+
+
+def _parse_artifact_name(artifact_name: str) -> ArtifactName | None:
+    # Matches {name}_{component}_{target_family} with an optional extra suffix
+    # that we ignore.
+    m = re.match(r"^([^_]+)_([^_]+)_([^_]+)(_.+)?$", artifact_name)
+    if not m:
+        return None
+    return ArtifactName(m.group(1), m.group(2), m.group(3))
@@ -0,0 +1,127 @@
+"""Classifies native binaries by their headers.
+
+Packaging only needs to tell executables, shared libraries and static archives
+apart from everything else. Rather than running a general purpose file type
+detector (libmagic) over every file, `classify_binary` reads the few bytes that
+decide this:
+
+* Static archives start with the `!<arch>` magic.
+* ELF files are classified by `e_type`: ET_EXEC is an executable. ET_DYN is
+  either a shared library or a position independent executable, which is told
+  by DF_1_PIE if the dynamic section has DT_FLAGS_1 (as libmagic does). Older
+  linkers do not mark executables that way, so without DT_FLAGS_1 an ET_DYN
+  file with an interpreter (PT_INTERP) but no DT_SONAME is an executable.
+
+That is the ELF header, the program headers and (for ET_DYN) the dynamic
+section: a few hundred bytes, regardless of the file size.
+"""
+
+import os
+import struct
+
+BINARY_EXE = "exe"
+BINARY_SO = "so"
+BINARY_AR = "ar"
+BINARY_OTHER = "other"
+
+_AR_MAGIC = b"!<arch>\n"
+_ELF_MAGIC = b"\x7fELF"
+
+# e_ident[EI_CLASS] and e_ident[EI_DATA].
+_ELFCLASS32 = 1
+_ELFCLASS64 = 2
+_ELFDATA2LSB = 1
+_ELFDATA2MSB = 2
+
+_ET_EXEC = 2
+_ET_DYN = 3
+
+_PT_DYNAMIC = 2
+_PT_INTERP = 3
+
+_DT_NULL = 0
+_DT_SONAME = 14
+_DT_FLAGS_1 = 0x6FFFFFFB
+_DF_1_PIE = 0x08000000
+
+# Bounds on what is read from malformed files.
+_MAX_PHNUM = 4096
+_MAX_DYNAMIC_SIZE = 1 << 20
+
+
+class _ElfLayout:
+    """Struct formats of one ELF class and byte order."""
+
+    def __init__(self, elf_class: int, byte_order: str):
+        if elf_class == _ELFCLASS64:
+            # e_type, e_phoff, e_phentsize and e_phnum of the header (after
+            # e_ident).
+            self.header = struct.Struct(byte_order + "H14xQ14xHH6x")
+            # p_type, p_offset and p_filesz of a program header.
+            self.phdr = struct.Struct(byte_order + "I4xQ16xQ16x")
+            self.dyn = struct.Struct(byte_order + "qQ")
+        else:
+            self.header = struct.Struct(byte_order + "H10xI10xHH6x")
+            self.phdr = struct.Struct(byte_order + "II8xI12x")
+            self.dyn = struct.Struct(byte_order + "iI")
+
+
+_LAYOUTS = {
+    (elf_class, data): _ElfLayout(elf_class, byte_order)
+    for elf_class in (_ELFCLASS32, _ELFCLASS64)
+    for data, byte_order in ((_ELFDATA2LSB, "<"), (_ELFDATA2MSB, ">"))
+}
+
+
+def classify_binary(path: os.PathLike | str) -> str:
+    """Returns BINARY_EXE, BINARY_SO, BINARY_AR or BINARY_OTHER for a file."""
+    with open(path, "rb") as f:
+        ident = f.read(16)
+        if ident.startswith(_AR_MAGIC):
+            return BINARY_AR
+        if len(ident) < 16 or not ident.startswith(_ELF_MAGIC):
+            return BINARY_OTHER
+        layout = _LAYOUTS.get((ident[4], ident[5]))
+        if layout is None:
+            return BINARY_OTHER
+        header = f.read(layout.header.size)
+        if len(header) < layout.header.size:
+            return BINARY_OTHER
+        e_type, e_phoff, e_phentsize, e_phnum = layout.header.unpack(header)
+        if e_type == _ET_EXEC:
+            return BINARY_EXE
+        if e_type != _ET_DYN:
+            return BINARY_OTHER
+        return _classify_dyn(f, layout, e_phoff, e_phentsize, e_phnum)
+
+
+def _classify_dyn(f, layout: _ElfLayout, phoff: int, phentsize: int, phnum: int):
+    """Tells a PIE executable from a shared library (see module docstring)."""
+    has_interp = False
+    dynamic = None
+    if phentsize >= layout.phdr.size and 0 < phnum <= _MAX_PHNUM:
+        f.seek(phoff)
+        phdrs = f.read(phentsize * phnum)
+        for i in range(len(phdrs) // phentsize):
+            p_type, p_offset, p_filesz = layout.phdr.unpack_from(phdrs, i * phentsize)
+            if p_type == _PT_INTERP:
+                has_interp = True
+            elif p_type == _PT_DYNAMIC:
+                dynamic = (p_offset, min(p_filesz, _MAX_DYNAMIC_SIZE))
+
+    has_soname = False
+    if dynamic is not None:
+        f.seek(dynamic[0])
+        data = f.read(dynamic[1])
+        for d_tag, d_val in layout.dyn.iter_unpack(
+            data[: len(data) - len(data) % layout.dyn.size]
+        ):
+            if d_tag == _DT_NULL:
+                break
+            if d_tag == _DT_FLAGS_1:
+                return BINARY_EXE if d_val & _DF_1_PIE else BINARY_SO
+            if d_tag == _DT_SONAME:
+                has_soname = True
+    if has_interp and not has_soname:
+        return BINARY_EXE
+    return BINARY_SO
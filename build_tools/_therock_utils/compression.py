@@ -0,0 +1,375 @@
+"""Compression streams used for artifact archives.
+
+Artifact archives are tarballs compressed with either xz (`.tar.xz`, the
+default) or zstandard (`.tar.zst`). The format is selected by file suffix, see
+`archive_format`. zstandard support requires the optional `zstandard` module.
+
+`ParallelXzWriter` is a write-only file object that splits its input into
+fixed size blocks and compresses each block as an independent xz stream on a
+thread pool (the lzma module releases the GIL while compressing). The output
+is a concatenation of xz streams, which is a valid `.xz` file that the xz
+tools, `tar -xJ` and Python's `lzma`/`tarfile` modules decompress as one.
+
+Because block boundaries only depend on the block size, the output bytes are
+the same regardless of the number of threads used.
+
+`ZstdWriter` wraps the multi-threaded streaming compressor of the `zstandard`
+module behind the same interface. Given a block size, it ends a zstd frame at
+every block boundary.
+
+Both writers record the offsets of their independently decompressible blocks
+in `blocks`, so that a reader can start decompressing at the block containing
+some uncompressed offset (see `open_compressed_reader`).
+"""
+
+from typing import BinaryIO
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import lzma
+import os
+import sys
+import time
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+# Maps archive file suffixes to compression formats.
+ARCHIVE_FORMATS = {
+    ".tar.xz": "xz",
+    ".tar.zst": "zst",
+}
+
+DEFAULT_XZ_PRESET = 6
+
+# Level 12 compresses within ~10% of the xz default at a fraction of the time,
+# and zstd decompression speed is largely independent of the level.
+DEFAULT_ZSTD_LEVEL = 12
+
+DEFAULT_COMPRESSION_LEVELS = {
+    "xz": DEFAULT_XZ_PRESET,
+    "zst": DEFAULT_ZSTD_LEVEL,
+}
+
+# Same default as `xz -T`: three times the LZMA2 dictionary size of the preset
+# (8 MiB for preset 6).
+DEFAULT_XZ_BLOCK_SIZE = 3 * 8 * 1024 * 1024
+
+# Block size for archives meant for random access: small enough that reading
+# one member decompresses little else, large enough to compress reasonably.
+DEFAULT_SEEKABLE_BLOCK_SIZE = 1024 * 1024
+
+# Default cap on compression threads. Each xz thread holds ~100 MiB of encoder
+# state plus up to two blocks, and builds run many archive commands at once.
+DEFAULT_MAX_THREADS = 8
+
+
+def archive_format(path: os.PathLike | str) -> str:
+    """Returns the compression format ("xz" or "zst") of an archive path."""
+    name = os.fspath(path)
+    for suffix, format in ARCHIVE_FORMATS.items():
+        if name.endswith(suffix):
+            return format
+    raise ValueError(
+        f"Unsupported artifact archive name {name} (expected one of "
+        f"{', '.join(ARCHIVE_FORMATS.keys())})"
+    )
+
+
+def default_threads() -> int:
+    """Returns the default number of compression threads: all cores, up to
+    DEFAULT_MAX_THREADS."""
+    return min(os.cpu_count() or 1, DEFAULT_MAX_THREADS)
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ModuleNotFoundError(
+            "Reading or writing .tar.zst artifact archives requires the "
+            "'zstandard' Python module (pip install zstandard)"
+        )
+
+
+def open_compressed_writer(
+    fileobj: BinaryIO,
+    format: str,
+    *,
+    threads: int | None = None,
+    level: int | None = None,
+    block_size: int | None = None,
+):
+    """Opens a compressing writer of the given format over `fileobj`.
+
+    The returned object is a write-only file object and context manager with
+    `uncompressed_bytes`, `compressed_bytes`, `blocks` and `report()`. Closing
+    it does not close `fileobj`. If `block_size` is None, xz uses
+    DEFAULT_XZ_BLOCK_SIZE and zstd writes a single frame.
+    """
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[format]
+    if format == "xz":
+        return ParallelXzWriter(
+            fileobj,
+            threads=threads,
+            preset=level,
+            block_size=block_size or DEFAULT_XZ_BLOCK_SIZE,
+        )
+    elif format == "zst":
+        return ZstdWriter(fileobj, threads=threads, level=level, block_size=block_size)
+    raise ValueError(f"Unsupported compression format: {format}")
+
+
+def open_compressed_reader(
+    path: os.PathLike | str, *, compressed_offset: int = 0
+) -> BinaryIO:
+    """Opens an archive for streaming decompression based on its suffix.
+
+    If `compressed_offset` is given, it must be the start of a block (see the
+    writer `blocks`) and decompression starts there.
+    """
+    format = archive_format(path)
+    f = open(path, "rb")
+    try:
+        f.seek(compressed_offset)
+        if format == "xz":
+            return _ClosingLZMAFile(f)
+        require_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True, closefd=True
+        )
+    except:
+        f.close()
+        raise
+
+
+class _ClosingLZMAFile(lzma.LZMAFile):
+    """LZMAFile that closes the file object it was opened over."""
+
+    def __init__(self, fileobj: BinaryIO):
+        super().__init__(fileobj, "rb")
+        self._owned_fileobj = fileobj
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._owned_fileobj.close()
+
+
+class ParallelXzWriter:
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        *,
+        threads: int | None = None,
+        preset: int = DEFAULT_XZ_PRESET,
+        block_size: int = DEFAULT_XZ_BLOCK_SIZE,
+    ):
+        self.fileobj = fileobj
+        self.preset = preset
+        self.block_size = block_size
+        if threads is None:
+            threads = default_threads()
+        self.threads = threads
+        self._executor = (
+            ThreadPoolExecutor(max_workers=threads, thread_name_prefix="xz")
+            if threads > 1
+            else None
+        )
+        # Bound memory use to a couple of blocks in flight per thread.
+        self._max_pending = 2 * threads
+        self._pending: deque[tuple[Future, int]] = deque()
+        self._buffer = bytearray()
+        # (uncompressed offset, compressed offset) of each block written.
+        self.blocks: list[tuple[int, int]] = []
+        self._written_uncompressed = 0
+        self._closed = False
+        # Statistics.
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.block_count = 0
+        self._start_time = time.perf_counter()
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """Returns the uncompressed position in the stream."""
+        return self.uncompressed_bytes
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed ParallelXzWriter")
+        size = len(data)
+        self._buffer += data
+        self.uncompressed_bytes += size
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            self._submit(block)
+        return size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            # An empty stream still needs one (empty) xz stream to be valid.
+            if self._buffer or self.block_count == 0:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._write_pending()
+            self.fileobj.flush()
+        finally:
+            self._closed = True
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+            self.elapsed = time.perf_counter() - self._start_time
+
+    def report(self, label: str, file=sys.stderr):
+        elapsed = max(self.elapsed, 1e-9)
+        ratio = self.compressed_bytes / max(self.uncompressed_bytes, 1)
+        print(
+            f"{label}: {self.uncompressed_bytes / 1e6:.1f} MB -> "
+            f"{self.compressed_bytes / 1e6:.1f} MB (ratio {ratio:.3f}) in "
+            f"{self.elapsed:.2f}s ({self.uncompressed_bytes / elapsed / 1e6:.1f} MB/s, "
+            f"{self.block_count} blocks, {self.threads} threads, "
+            f"preset {self.preset})",
+            file=file,
+        )
+
+    def _compress(self, block: bytes) -> bytes:
+        return lzma.compress(
+            block, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=self.preset
+        )
+
+    def _submit(self, block: bytes):
+        self.block_count += 1
+        if self._executor is None:
+            self._write_block(self._compress(block), len(block))
+            return
+        self._pending.append((self._executor.submit(self._compress, block), len(block)))
+        while len(self._pending) > self._max_pending:
+            self._write_pending()
+
+    def _write_pending(self):
+        future, size = self._pending.popleft()
+        self._write_block(future.result(), size)
+
+    def _write_block(self, compressed: bytes, size: int):
+        self.blocks.append((self._written_uncompressed, self.compressed_bytes))
+        self.fileobj.write(compressed)
+        self.compressed_bytes += len(compressed)
+        self._written_uncompressed += size
+
+
+class ZstdWriter:
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        *,
+        threads: int | None = None,
+        level: int = DEFAULT_ZSTD_LEVEL,
+        block_size: int | None = None,
+    ):
+        require_zstandard()
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        if threads is None:
+            threads = default_threads()
+        self.threads = threads
+        # zstd's multi-threaded mode (threads >= 1) produces the same output
+        # for any number of workers, but differs from its single-threaded mode
+        # (threads=0). Always use the former so that output does not depend on
+        # the thread count.
+        compressor = zstandard.ZstdCompressor(level=level, threads=max(threads, 1))
+        self._writer = compressor.stream_writer(fileobj, closefd=False)
+        self._start_offset = fileobj.tell()
+        # (uncompressed offset, compressed offset) of each frame written.
+        self.blocks: list[tuple[int, int]] = [(0, 0)]
+        self._block_remaining = block_size
+        self._closed = False
+        # Statistics.
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self._start_time = time.perf_counter()
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """Returns the uncompressed position in the stream."""
+        return self.uncompressed_bytes
+
+    def write(self, data) -> int:
+        if self._closed:
+            raise ValueError("write to closed ZstdWriter")
+        size = len(data)
+        if self._block_remaining is None:
+            self._writer.write(data)
+            self.uncompressed_bytes += size
+            return size
+        view = memoryview(data)
+        while view:
+            chunk = view[: self._block_remaining]
+            self._writer.write(chunk)
+            self.uncompressed_bytes += len(chunk)
+            self._block_remaining -= len(chunk)
+            view = view[len(chunk) :]
+            if self._block_remaining == 0:
+                # End the frame so that the next block can be decompressed on
+                # its own.
+                self._writer.flush(zstandard.FLUSH_FRAME)
+                self.blocks.append(
+                    (
+                        self.uncompressed_bytes,
+                        self.fileobj.tell() - self._start_offset,
+                    )
+                )
+                self._block_remaining = self.block_size
+        return size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._closed:
+            return
+        try:
+            self._writer.close()
+            self.fileobj.flush()
+            self.compressed_bytes = self.fileobj.tell() - self._start_offset
+        finally:
+            self._closed = True
+            self.elapsed = time.perf_counter() - self._start_time
+
+    def report(self, label: str, file=sys.stderr):
+        elapsed = max(self.elapsed, 1e-9)
+        ratio = self.compressed_bytes / max(self.uncompressed_bytes, 1)
+        print(
+            f"{label}: {self.uncompressed_bytes / 1e6:.1f} MB -> "
+            f"{self.compressed_bytes / 1e6:.1f} MB (ratio {ratio:.3f}) in "
+            f"{self.elapsed:.2f}s ({self.uncompressed_bytes / elapsed / 1e6:.1f} MB/s, "
+            f"{self.threads} threads, level {self.level})",
+            file=file,
+        )
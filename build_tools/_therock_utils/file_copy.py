@@ -0,0 +1,543 @@
+"""Executes batches of directory, symlink and file copy operations.
+
+This is the engine behind `PatternMatcher.copy_to`. Operations are consumed in
+batches as they are produced (i.e. while the source tree is still being
+scanned). The destination directories of each batch are created before it is
+run, after which its symlinks and file links/copies are independent of each
+other and can be run on a thread pool. Results (verbose log lines, statistics
+and errors) are always processed in operation order, so output is the same
+regardless of the number of jobs.
+
+When a file cannot be (or is not allowed to be) hardlinked, `copy_file` uses
+the cheapest copy method that works, in order:
+
+* reflink: Copy-on-write clone via the FICLONE ioctl (btrfs, xfs, etc).
+* copy_file_range: In-kernel copy, which some file systems can also offload.
+* sendfile: In-kernel copy for kernels where copy_file_range is unavailable.
+* buffered: Userspace read/write loop.
+
+In sync mode, destination entries that already match their source are left
+alone: symlinks with the same target, and files which are the same inode as
+the source or have the same size, mode and mtime. `remove_stale` then deletes
+destination entries that are no longer part of the copy.
+
+Given an `ObjectStore`, files are instead added to the store and hardlinked
+from it (see `object_store.py`).
+"""
+
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Sequence
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import errno
+import itertools
+import os
+import shutil
+import stat
+import sys
+import time
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    # Not available on Windows.
+    fcntl = None
+
+if TYPE_CHECKING:
+    from .object_store import ObjectStore
+
+# Operation kinds.
+OP_DIR = 0
+OP_SYMLINK = 1
+OP_FILE = 2
+
+# Copy methods, in order of preference.
+COPY_METHODS = ["reflink", "copy_file_range", "sendfile", "buffered"]
+
+# _IOW(0x94, 9, int) from linux/fs.h.
+FICLONE = 0x40049409
+
+# Errors which indicate that a copy method is not supported for a file (as
+# opposed to an I/O error), and the next method should be tried.
+_UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV,
+}
+
+# Of those, errors which indicate that a copy method is not supported between
+# two file systems at all (as opposed to for one file, i.e. an append-only or
+# immutable one), so that it is not tried again for the same devices.
+_UNSUPPORTED_DEVICE_ERRNOS = {
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+}
+
+_IS_LINUX = sys.platform.startswith("linux")
+
+# (method, source st_dev, dest st_dev) combinations known not to work, so that
+# they are not retried for every file.
+_unsupported_methods: set[tuple[str, int, int]] = set()
+
+# Chunk size for in-kernel and buffered copies.
+_COPY_CHUNK_SIZE = 1 << 30
+_BUFFERED_CHUNK_SIZE = 1 << 20
+
+# Number of operations handed to a worker at a time. Submitting individual
+# operations costs more in executor overhead than a hardlink costs to make.
+BATCH_SIZE = 256
+
+
+class CopyOp:
+    __slots__ = ["kind", "src_path", "dest_path"]
+
+    def __init__(self, kind: int, src_path: str, dest_path: str):
+        self.kind = kind
+        self.src_path = src_path
+        self.dest_path = dest_path
+
+
+class CopyStats:
+    """Counters accumulated while copying, printed with `--stats`."""
+
+    def __init__(self):
+        self.dirs = 0
+        self.symlinks = 0
+        self.hardlinks = 0
+        # Count of files copied by each of COPY_METHODS.
+        self.copy_methods: dict[str, int] = {m: 0 for m in COPY_METHODS}
+        self.copied_bytes = 0
+        # Files written from archive members.
+        self.extracted = 0
+        # Files added to an object store as new objects. Files linked to
+        # existing objects count as hardlinks.
+        self.stored = 0
+        # Sync mode counters.
+        self.unchanged = 0
+        self.removed = 0
+        self.elapsed = 0.0
+
+    def add(self, other: "CopyStats"):
+        """Adds the counters (but not the elapsed time) of `other`."""
+        self.dirs += other.dirs
+        self.symlinks += other.symlinks
+        self.hardlinks += other.hardlinks
+        for method, count in other.copy_methods.items():
+            self.copy_methods[method] += count
+        self.copied_bytes += other.copied_bytes
+        self.extracted += other.extracted
+        self.stored += other.stored
+        self.unchanged += other.unchanged
+        self.removed += other.removed
+
+    @property
+    def copies(self) -> int:
+        return sum(self.copy_methods.values())
+
+    @property
+    def files(self) -> int:
+        return self.hardlinks + self.copies + self.extracted + self.stored
+
+    def report(self, label: str = "copy", file=sys.stderr):
+        elapsed = max(self.elapsed, 1e-9)
+        entries = self.dirs + self.symlinks + self.files + self.unchanged
+        print(
+            f"{label}: {entries} entries in {self.elapsed:.3f}s "
+            f"({entries / elapsed:.0f} entries/s): "
+            f"{self.dirs} dirs, {self.symlinks} symlinks, "
+            f"{self.hardlinks} hardlinks, {self.copies} copies, "
+            f"{self.extracted} extracted, {self.stored} stored "
+            f"({self.copied_bytes / elapsed / 1e6:.1f} MB/s copied)",
+            file=file,
+        )
+        if self.unchanged or self.removed:
+            print(
+                f"{label}: sync: {self.unchanged} unchanged, {self.removed} removed",
+                file=file,
+            )
+        if self.copies:
+            methods = ", ".join(f"{m}={c}" for m, c in self.copy_methods.items())
+            print(f"{label}: copy methods: {methods}", file=file)
+
+
+class _OpResult:
+    __slots__ = ["message", "method", "copied_bytes", "error"]
+
+    def __init__(self):
+        self.message = ""
+        self.method = ""
+        self.copied_bytes = 0
+        self.error: BaseException | None = None
+
+
+def make_dir(dir_path: str, *, replace_non_dirs: bool = False):
+    """Creates a directory and its parents.
+
+    If `replace_non_dirs`, a file or symlink in the way is removed first.
+    """
+    if replace_non_dirs and os.path.lexists(dir_path):
+        if os.path.islink(dir_path) or not os.path.isdir(dir_path):
+            os.unlink(dir_path)
+    os.makedirs(dir_path, exist_ok=True)
+
+
+def remove_stale(
+    destdir: str,
+    keep_relpaths: set[str],
+    *,
+    stats: CopyStats,
+    verbose: bool = False,
+):
+    """Removes entries under `destdir` that are not in `keep_relpaths`.
+
+    Relative paths are posix style. Parent directories of kept paths are
+    implicitly kept.
+    """
+    keep = set(keep_relpaths)
+    for relpath in keep_relpaths:
+        parent = relpath.rpartition("/")[0]
+        while parent and parent not in keep:
+            keep.add(parent)
+            parent = parent.rpartition("/")[0]
+
+    def scan_children(dirpath: str, prefix: str):
+        with os.scandir(dirpath) as it:
+            entries = list(it)
+        for entry in entries:
+            relpath = f"{prefix}{entry.name}"
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if relpath in keep:
+                if is_dir:
+                    scan_children(entry.path, f"{relpath}/")
+                continue
+            if verbose:
+                print(f"remove {entry.path}", file=sys.stderr)
+            if is_dir:
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+            stats.removed += 1
+
+    start_time = time.perf_counter()
+    scan_children(destdir, "")
+    stats.elapsed += time.perf_counter() - start_time
+
+
+def execute(
+    ops: Iterable[CopyOp],
+    *,
+    stats: CopyStats,
+    jobs: int = 0,
+    verbose: bool = False,
+    always_copy: bool = False,
+    replace_existing: bool = False,
+    sync: bool = False,
+    store: "ObjectStore | None" = None,
+):
+    """Executes copy operations.
+
+    Operations are taken from `ops` in batches. The directories of a batch are
+    created first, then its symlinks and files, on a pool of `jobs` threads if
+    greater than 1 (with a bounded number of batches in flight). If
+    `replace_existing`, destination entries are unlinked before being written.
+    If `sync`, destination entries that already match are left unchanged and
+    others are replaced. If `store` is given, files are linked from it.
+
+    The first error (in operation order) is raised after log lines for all
+    preceding operations have been printed.
+    """
+    start_time = time.perf_counter()
+
+    def make_batches() -> Iterator[list[CopyOp]]:
+        # Operations arrive in scan order, so consecutive operations mostly
+        # share a destination directory and each is created about once.
+        last_dir_path = None
+        batch: list[CopyOp] = []
+        for op in ops:
+            if op.kind == OP_DIR:
+                dir_path = op.dest_path
+            else:
+                dir_path = os.path.dirname(op.dest_path)
+            if dir_path != last_dir_path:
+                make_dir(dir_path, replace_non_dirs=sync)
+                last_dir_path = dir_path
+            batch.append(op)
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run_batch(batch: Sequence[CopyOp]) -> list[_OpResult]:
+        return [
+            _run_op(op, verbose, always_copy, replace_existing, sync, store)
+            for op in batch
+        ]
+
+    try:
+        _process_results(_run_batches(make_batches(), run_batch, jobs), stats, verbose)
+    finally:
+        stats.elapsed += time.perf_counter() - start_time
+
+
+def _run_batches(
+    batches: Iterator[list[CopyOp]],
+    run_batch: Callable[[list[CopyOp]], list[_OpResult]],
+    jobs: int,
+) -> Iterator[list[_OpResult]]:
+    """Runs batches in order, on a thread pool if `jobs > 1` and there is more
+    than one batch."""
+    first = next(batches, None)
+    second = next(batches, None) if first is not None else None
+    if jobs <= 1 or second is None:
+        for batch in itertools.chain((first, second), batches):
+            if batch is not None:
+                yield run_batch(batch)
+        return
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="copy") as executor:
+        pending: deque[Future] = deque()
+        try:
+            for batch in itertools.chain((first, second), batches):
+                pending.append(executor.submit(run_batch, batch))
+                while len(pending) > 2 * jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def _process_results(
+    batch_results: Iterator[list[_OpResult]], stats: CopyStats, verbose: bool
+):
+    for results in batch_results:
+        for result in results:
+            if verbose:
+                print(result.message, file=sys.stderr)
+            if result.error is not None:
+                raise result.error
+            method = result.method
+            if method == "mkdir":
+                stats.dirs += 1
+            elif method == "symlink":
+                stats.symlinks += 1
+            elif method == "hardlink":
+                stats.hardlinks += 1
+            elif method == "unchanged":
+                stats.unchanged += 1
+            elif method == "stored":
+                stats.stored += 1
+                stats.copied_bytes += result.copied_bytes
+            else:
+                stats.copy_methods[method] += 1
+                stats.copied_bytes += result.copied_bytes
+
+
+def _run_op(
+    op: CopyOp,
+    verbose: bool,
+    always_copy: bool,
+    replace_existing: bool,
+    sync: bool,
+    store: "ObjectStore | None",
+) -> _OpResult:
+    result = _OpResult()
+    dest_path = op.dest_path
+    messages = []
+    try:
+        if op.kind == OP_DIR:
+            # Already created as part of the skeleton.
+            messages.append(f"mkdir {dest_path}")
+            result.method = "mkdir"
+            return result
+
+        if sync:
+            dest_stat = _lstat_or_none(dest_path)
+            if dest_stat is not None:
+                if _is_unchanged(op, dest_stat, store):
+                    messages.append(f"unchanged {dest_path}")
+                    result.method = "unchanged"
+                    return result
+                if stat.S_ISDIR(dest_stat.st_mode):
+                    shutil.rmtree(dest_path)
+                else:
+                    os.unlink(dest_path)
+        elif replace_existing and (
+            os.path.exists(dest_path) or os.path.islink(dest_path)
+        ):
+            os.unlink(dest_path)
+
+        if op.kind == OP_SYMLINK:
+            target_path = os.readlink(op.src_path)
+            messages.append(f"symlink {target_path} -> {dest_path}")
+            os.symlink(target_path, dest_path)
+            result.method = "symlink"
+            return result
+
+        # Regular file.
+        if store is not None:
+            object_path, is_new = store.add_file(op.src_path)
+            messages.append(f"store {op.src_path} -> {object_path} -> {dest_path}")
+            method = store.link(object_path, dest_path)
+            if is_new:
+                result.method = "stored"
+                result.copied_bytes = os.path.getsize(object_path)
+            else:
+                result.method = method
+                if method != "hardlink":
+                    result.copied_bytes = os.path.getsize(object_path)
+            return result
+        if not always_copy:
+            # Attempt to link.
+            messages.append(f"hardlink {op.src_path} -> {dest_path}")
+            try:
+                os.link(op.src_path, dest_path, follow_symlinks=False)
+                result.method = "hardlink"
+                return result
+            except OSError:
+                messages.append(" (falling back to copy) ")
+        # Make a copy instead.
+        messages.append(f"copy {op.src_path} -> {dest_path}")
+        result.method, result.copied_bytes = copy_file(op.src_path, dest_path)
+        messages.append(f" ({result.method})")
+    except Exception as e:
+        result.error = e
+    finally:
+        if verbose:
+            result.message = "".join(messages)
+    return result
+
+
+def _lstat_or_none(path: str) -> os.stat_result | None:
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+
+def _is_unchanged(
+    op: CopyOp, dest_stat: os.stat_result, store: "ObjectStore | None" = None
+) -> bool:
+    if op.kind == OP_SYMLINK:
+        return stat.S_ISLNK(dest_stat.st_mode) and os.readlink(
+            op.dest_path
+        ) == os.readlink(op.src_path)
+    if not stat.S_ISREG(dest_stat.st_mode):
+        return False
+    src_stat = os.lstat(op.src_path)
+    if src_stat.st_ino == dest_stat.st_ino and src_stat.st_dev == dest_stat.st_dev:
+        return True
+    if (
+        src_stat.st_size == dest_stat.st_size
+        and src_stat.st_mtime_ns == dest_stat.st_mtime_ns
+        and src_stat.st_mode == dest_stat.st_mode
+    ):
+        return True
+    # Objects keep the modification time of whichever file added them first,
+    # so a destination linked from the store is compared by its object.
+    return (
+        store is not None
+        and src_stat.st_size == dest_stat.st_size
+        and store.is_file_object(op.src_path, dest_stat)
+    )
+
+
+def copy_file(src_path: str, dest_path: str) -> tuple[str, int]:
+    """Copies a regular file's contents and metadata (like `shutil.copy2`).
+
+    Returns the copy method used (one of COPY_METHODS) and the number of bytes
+    copied.
+    """
+    with open(src_path, "rb") as fsrc, open(dest_path, "wb") as fdst:
+        src_fd = fsrc.fileno()
+        dest_fd = fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        devices = (os.fstat(src_fd).st_dev, os.fstat(dest_fd).st_dev)
+        for method in COPY_METHODS:
+            copier = _COPIERS[method]
+            if copier is None or (method, *devices) in _unsupported_methods:
+                continue
+            try:
+                copier(src_fd, dest_fd, size)
+            except OSError as e:
+                if method == "buffered" or e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                if e.errno in _UNSUPPORTED_DEVICE_ERRNOS:
+                    _unsupported_methods.add((method, *devices))
+                continue
+            break
+    shutil.copystat(src_path, dest_path, follow_symlinks=False)
+    return method, size
+
+
+def _copy_reflink(src_fd: int, dest_fd: int, size: int):
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd: int, dest_fd: int, size: int):
+    offset = 0
+    while True:
+        try:
+            copied = os.copy_file_range(src_fd, dest_fd, _COPY_CHUNK_SIZE)
+        except OSError:
+            # Only fall back to another method if nothing was written.
+            if offset:
+                raise IOError(f"copy_file_range failed after {offset} bytes")
+            raise
+        if copied == 0:
+            break
+        offset += copied
+    _check_copied_size("copy_file_range", offset, size)
+
+
+def _copy_sendfile(src_fd: int, dest_fd: int, size: int):
+    offset = 0
+    while True:
+        try:
+            copied = os.sendfile(dest_fd, src_fd, offset, _COPY_CHUNK_SIZE)
+        except OSError:
+            if offset:
+                raise IOError(f"sendfile failed after {offset} bytes")
+            raise
+        if copied == 0:
+            break
+        offset += copied
+    _check_copied_size("sendfile", offset, size)
+
+
+def _check_copied_size(method: str, copied: int, size: int):
+    """Checks that an in-kernel copy copied the whole file.
+
+    Some file systems (i.e. some FUSE, overlay and procfs-like ones) report
+    end of file without copying anything. That falls back to the next method.
+    """
+    if copied == size:
+        return
+    if copied == 0:
+        raise OSError(errno.EINVAL, f"{method} copied nothing of {size} bytes")
+    raise IOError(f"{method} copied {copied} of {size} bytes")
+
+
+def _copy_buffered(src_fd: int, dest_fd: int, size: int):
+    with open(src_fd, "rb", closefd=False) as fsrc, open(
+        dest_fd, "wb", closefd=False
+    ) as fdst:
+        shutil.copyfileobj(fsrc, fdst, _BUFFERED_CHUNK_SIZE)
+
+
+_COPIERS = {
+    "reflink": _copy_reflink if fcntl is not None and _IS_LINUX else None,
+    "copy_file_range": (
+        _copy_file_range if hasattr(os, "copy_file_range") and _IS_LINUX else None
+    ),
+    "sendfile": _copy_sendfile if hasattr(os, "sendfile") and _IS_LINUX else None,
+    "buffered": _copy_buffered,
+}
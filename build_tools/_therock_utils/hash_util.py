@@ -1,3 +1,5 @@
+from typing import BinaryIO
+
 import hashlib
 
 
@@ -22,3 +24,31 @@ def write_hash(hash_file, digest):
     with open(hash_file, "wt") as f:
         f.write(digest.hexdigest())
         f.write("\n")
+
+
+class HashingWriter:
+    """Write-only file object that hashes everything written through it.
+
+    This lets an archive be hashed as it is produced instead of reading it back
+    afterwards. One digest is computed per algorithm, in order.
+    """
+
+    def __init__(self, fileobj: BinaryIO, hash_algorithms: list[str]):
+        self.fileobj = fileobj
+        self.digests = [
+            hashlib.new(hash_algorithm) for hash_algorithm in hash_algorithms
+        ]
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        for digest in self.digests:
+            digest.update(data)
+        return self.fileobj.write(data)
+
+    def tell(self) -> int:
+        return self.fileobj.tell()
+
+    def flush(self):
+        self.fileobj.flush()
@@ -0,0 +1,253 @@
+"""Local content-addressed store of artifact files.
+
+Between builds most artifact files are unchanged, and the same files appear in
+several artifacts (i.e. generic and per target family variants). With
+`--store`, `fileset_tool.py artifact` and `artifact-flatten` put each file into
+an `ObjectStore` once, keyed by its content hash and permissions, and populate
+their output trees with hardlinks to the stored objects. Disk use and write
+volume then only grow with files that actually changed.
+
+Layout:
+
+    {root}/objects/ab/cdef...-755   Object with sha256 "abcdef..." and mode 0o755
+    {root}/tmp/                     Objects being written
+
+Objects are written under `tmp/` and published with `os.link`, which is atomic,
+so concurrent writers (threads or processes) never observe partial objects.
+Like any hardlinked tree, output trees must be replaced rather than modified in
+place, or the stored object changes with them.
+
+Linking an object updates its inode change time, which `gc` uses as the last
+use time. Objects that are still linked from some output tree are never
+evicted, since removing them would not free any space.
+"""
+
+from typing import BinaryIO
+
+import errno
+import hashlib
+import os
+from pathlib import Path
+import stat
+import tempfile
+import time
+
+from .file_copy import copy_file
+from .hash_util import calculate_hash
+
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+# Temporary files older than this are left over from interrupted writes.
+_STALE_TMP_AGE = 24 * 60 * 60
+
+_CHUNK_SIZE = 1 << 20
+
+# Errors which indicate that an object cannot be hardlinked to a destination
+# (across file systems, at the link count limit, or where the file system does
+# not permit hardlinks), and it should be copied instead.
+_LINK_UNSUPPORTED_ERRNOS = {
+    errno.EMLINK,
+    errno.EPERM,
+    errno.EXDEV,
+}
+
+
+class ObjectStore:
+    def __init__(self, root: Path, hash_algorithm: str = DEFAULT_HASH_ALGORITHM):
+        self.root = Path(root)
+        self.hash_algorithm = hash_algorithm
+        self.objects_dir = self.root / "objects"
+        self.tmp_dir = self.root / "tmp"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        # Object paths of source files already hashed, by (st_dev, st_ino,
+        # st_size, st_mtime_ns, st_mode), so that files are only hashed once.
+        self._added_files: dict[tuple[int, int, int, int, int], str] = {}
+
+    def object_path(self, digest: str, mode: int) -> str:
+        return os.path.join(
+            self.objects_dir, digest[:2], f"{digest[2:]}-{stat.S_IMODE(mode):o}"
+        )
+
+    def add_file(self, src_path: str) -> tuple[str, bool]:
+        """Adds the contents and permissions of a regular file.
+
+        Returns the object path and whether the object is new.
+        """
+        object_path = self._file_object_path(src_path)
+        if os.path.exists(object_path):
+            return object_path, False
+        tmp_path = self._make_tmp_path()
+        try:
+            copy_file(src_path, tmp_path)
+            return object_path, self._publish(tmp_path, object_path)
+        finally:
+            os.unlink(tmp_path)
+
+    def is_file_object(self, src_path: str, st: os.stat_result) -> bool:
+        """Returns whether `st` is of the object for the contents and
+        permissions of a regular file, i.e. whether a destination linked from
+        that object is up to date.
+        """
+        try:
+            object_stat = os.stat(self._file_object_path(src_path))
+        except FileNotFoundError:
+            return False
+        return (object_stat.st_dev, object_stat.st_ino) == (st.st_dev, st.st_ino)
+
+    def _file_object_path(self, src_path: str) -> str:
+        st = os.stat(src_path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+        object_path = self._added_files.get(key)
+        if object_path is None:
+            digest = calculate_hash(src_path, self.hash_algorithm).hexdigest()
+            object_path = self.object_path(digest, st.st_mode)
+            self._added_files[key] = object_path
+        return object_path
+
+    def add_stream(
+        self,
+        fileobj: BinaryIO,
+        mode: int,
+        *,
+        digest: str | None = None,
+        size: int | None = None,
+    ) -> tuple[str, bool]:
+        """Adds contents read from `fileobj` with permission bits `mode`.
+
+        If the `digest` (and `size`) of the contents are known, nothing is
+        read when the object already exists, and otherwise the contents are
+        verified against them. Returns the object path and whether the object
+        is new.
+        """
+        if digest is not None:
+            object_path = self.object_path(digest, mode)
+            if os.path.exists(object_path):
+                return object_path, False
+        tmp_path = self._make_tmp_path()
+        try:
+            hasher = hashlib.new(self.hash_algorithm)
+            written = 0
+            with open(tmp_path, "wb") as tmp_file:
+                while chunk := fileobj.read(_CHUNK_SIZE):
+                    hasher.update(chunk)
+                    tmp_file.write(chunk)
+                    written += len(chunk)
+                os.fchmod(tmp_file.fileno(), stat.S_IMODE(mode))
+            actual_digest = hasher.hexdigest()
+            if (digest is not None and actual_digest != digest) or (
+                size is not None and written != size
+            ):
+                raise IOError(
+                    f"Contents added to the object store do not match their "
+                    f"expected digest {digest}"
+                )
+            object_path = self.object_path(actual_digest, mode)
+            return object_path, self._publish(tmp_path, object_path)
+        finally:
+            os.unlink(tmp_path)
+
+    def link(self, object_path: str, dest_path: str) -> str:
+        """Hardlinks an object to `dest_path`, falling back to a copy where it
+        cannot be linked (i.e. across file systems).
+
+        A copy is written next to `dest_path` and renamed into place, so that
+        `dest_path` never has partial contents. Returns "hardlink" or the copy
+        method used (see `copy_file`).
+        """
+        try:
+            os.link(object_path, dest_path)
+            return "hardlink"
+        except OSError as e:
+            if e.errno not in _LINK_UNSUPPORTED_ERRNOS:
+                raise
+        dest_dir, dest_name = os.path.split(dest_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dest_dir or ".", prefix=f".{dest_name}.")
+        os.close(fd)
+        try:
+            method, _ = copy_file(object_path, tmp_path)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return method
+
+    def gc(
+        self,
+        *,
+        max_bytes: int | None = None,
+        max_age: float | None = None,
+        dry_run: bool = False,
+    ) -> "GcResult":
+        """Evicts least recently used objects.
+
+        Objects unused for more than `max_age` seconds are evicted, then the
+        least recently used objects until the store holds at most `max_bytes`.
+        Objects still linked from an output tree are kept.
+        """
+        now = time.time()
+        result = GcResult()
+        candidates: list[tuple[float, int, str]] = []
+        with os.scandir(self.objects_dir) as fanout_it:
+            fanout_dirs = [e.path for e in fanout_it if e.is_dir()]
+        for fanout_dir in fanout_dirs:
+            with os.scandir(fanout_dir) as it:
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    result.objects += 1
+                    result.bytes += st.st_size
+                    if st.st_nlink > 1:
+                        continue
+                    candidates.append((st.st_ctime, st.st_size, entry.path))
+        # Oldest first.
+        candidates.sort()
+        for last_used, size, path in candidates:
+            expired = max_age is not None and now - last_used > max_age
+            oversized = max_bytes is not None and result.bytes > max_bytes
+            if not (expired or oversized):
+                continue
+            if not dry_run:
+                os.unlink(path)
+            result.objects -= 1
+            result.bytes -= size
+            result.removed_objects += 1
+            result.removed_bytes += size
+        if not dry_run:
+            self._remove_stale_tmp(now)
+        return result
+
+    def _make_tmp_path(self) -> str:
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        return tmp_path
+
+    def _publish(self, tmp_path: str, object_path: str) -> bool:
+        """Links a completed temporary file into place. Returns False if the
+        object was published concurrently."""
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            os.link(tmp_path, object_path)
+            return True
+        except FileExistsError:
+            return False
+
+    def _remove_stale_tmp(self, now: float):
+        with os.scandir(self.tmp_dir) as it:
+            for entry in it:
+                if now - entry.stat().st_mtime > _STALE_TMP_AGE:
+                    os.unlink(entry.path)
+
+
+class GcResult:
+    def __init__(self):
+        # Objects and bytes remaining.
+        self.objects = 0
+        self.bytes = 0
+        self.removed_objects = 0
+        self.removed_bytes = 0
+
+    def __str__(self):
+        return (
+            f"{self.removed_objects} objects ({self.removed_bytes / 1e6:.1f} MB) "
+            f"removed, {self.objects} objects ({self.bytes / 1e6:.1f} MB) kept"
+        )
@@ -1,45 +1,175 @@
-from typing import Generator, Sequence
+from typing import Generator, Iterable, Iterator, Sequence
 
+from concurrent.futures import Future, ThreadPoolExecutor
 import os
-from pathlib import Path, PurePosixPath
+from pathlib import Path
 import re
 import shutil
+import stat
 import sys
 
+from . import file_copy
+from .object_store import ObjectStore
+from .tree_index import TreeEntry, TreeIndex, mode_type
+
 
 class RecursiveGlobPattern:
     def __init__(self, glob: str):
         self.glob = glob
         pattern = f"^{re.escape(glob)}$"
         # Intermediate recursive directory match.
-        pattern = pattern.replace("/\\*\\*/", "/(.*/)?")
+        pattern = pattern.replace("/\\*\\*/", "/(?:.*/)?")
         # First segment recursive directory match.
-        pattern = pattern.replace("^\\*\\*/", "^(.*/)?")
+        pattern = pattern.replace("^\\*\\*/", "^(?:.*/)?")
         # Last segment recursive directory match.
-        pattern = pattern.replace("/\\*\\*$", "(/.*)?$")
+        pattern = pattern.replace("/\\*\\*$", "(?:/.*)?$")
         # Intra-segment * match.
         pattern = pattern.replace("\\*", "[^/]*")
         # Intra-segment ? match.
         pattern = pattern.replace("\\?", "[^/]*")
         self.pattern = re.compile(pattern)
+        # Unanchored regex source, suitable for combining with other patterns.
+        self.regex = pattern[1:-1]
+
+        # Common glob shapes that can be matched with plain string operations
+        # instead of a regex. At most one of these is set.
+        #   literal: "lib/libfoo.so" (no wildcards)
+        #   suffix: "**/*.so" (any path ending in ".so")
+        #   prefix: "bin/**" (the "bin" directory and anything under it)
+        self.literal: str | None = None
+        self.suffix: str | None = None
+        self.prefix: str | None = None
+        if not _has_wildcard(glob):
+            self.literal = glob
+        elif glob.startswith("**/*") and not _has_wildcard(glob[4:], "/"):
+            self.suffix = glob[4:]
+        elif glob.endswith("/**") and not _has_wildcard(glob[:-3]):
+            self.prefix = glob[:-3]
+
+        # Per path segment matchers used for directory pruning (see
+        # SubtreePruner). A `**` segment is represented as None and matches
+        # zero or more segments. This is a (possibly larger) superset of what
+        # the full pattern matches, which is what pruning needs.
+        self.segments: list[re.Pattern | None] = [
+            None if segment == "**" else _compile_segment(segment)
+            for segment in glob.split("/")
+        ]
 
     def matches(self, relpath: str, direntry: os.DirEntry[str]) -> bool:
         m = self.pattern.match(relpath)
         return True if m else False
 
 
+def _compile_segment(segment: str) -> re.Pattern:
+    pattern = re.escape(segment)
+    pattern = pattern.replace("\\*", "[^/]*")
+    pattern = pattern.replace("\\?", "[^/]*")
+    return re.compile(pattern)
+
+
+def _has_wildcard(glob: str, extra_chars: str = "") -> bool:
+    return any(c in glob for c in "*?" + extra_chars)
+
+
+class CompiledGlobSet:
+    """A set of RecursiveGlobPatterns that are evaluated as a unit.
+
+    Matching a path against the set answers whether *any* pattern matches. Glob
+    shapes that reduce to literal, suffix or prefix comparisons are checked with
+    string operations and everything else is merged into a single alternation
+    regex, so that a path is tested in one pass regardless of how many patterns
+    are in the set.
+    """
+
+    def __init__(self, patterns: Sequence[RecursiveGlobPattern]):
+        self.patterns = list(patterns)
+        literals: set[str] = set()
+        suffixes: list[str] = []
+        prefixes: list[str] = []
+        regexes: list[str] = []
+        for p in self.patterns:
+            if p.literal is not None:
+                literals.add(p.literal)
+            elif p.suffix is not None:
+                suffixes.append(p.suffix)
+            elif p.prefix is not None:
+                # The prefix itself matches as well as anything under it.
+                literals.add(p.prefix)
+                prefixes.append(f"{p.prefix}/")
+            else:
+                regexes.append(p.regex)
+        self.literals = frozenset(literals)
+        self.suffixes = tuple(suffixes)
+        self.prefixes = tuple(prefixes)
+        self.regex = (
+            re.compile("^(?:" + "|".join(f"(?:{r})" for r in regexes) + ")$")
+            if regexes
+            else None
+        )
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def matches(self, relpath: str) -> bool:
+        if relpath in self.literals:
+            return True
+        if self.suffixes and relpath.endswith(self.suffixes):
+            return True
+        if self.prefixes and relpath.startswith(self.prefixes):
+            return True
+        if self.regex is not None and self.regex.match(relpath):
+            return True
+        return False
+
+
 class MatchPredicate:
+    """Evaluates include/exclude/force_include recursive glob patterns.
+
+    Each pattern list is compiled into a CompiledGlobSet. If `verify` is True
+    (or the `THEROCK_VERIFY_PATTERN_MATCH` environment variable is set to a
+    non-empty value), every match is also evaluated pattern by pattern with
+    `matches_per_pattern` and an AssertionError is raised if the two disagree.
+    """
+
     def __init__(
         self,
         includes: Sequence[str] = (),
         excludes: Sequence[str] = (),
         force_includes: Sequence[str] = (),
+        *,
+        verify: bool | None = None,
     ):
         self.includes = [RecursiveGlobPattern(p) for p in includes]
         self.excludes = [RecursiveGlobPattern(p) for p in excludes]
         self.force_includes = [RecursiveGlobPattern(p) for p in force_includes]
+        self.include_set = CompiledGlobSet(self.includes)
+        self.exclude_set = CompiledGlobSet(self.excludes)
+        self.force_include_set = CompiledGlobSet(self.force_includes)
+        if verify is None:
+            verify = bool(os.getenv("THEROCK_VERIFY_PATTERN_MATCH"))
+        self.verify = verify
+
+    def matches(self, match_path: str, direntry: os.DirEntry[str]) -> bool:
+        if self.force_include_set.matches(match_path):
+            result = True
+        elif self.include_set and not self.include_set.matches(match_path):
+            result = False
+        else:
+            result = not self.exclude_set.matches(match_path)
+        if self.verify:
+            expected = self.matches_per_pattern(match_path, direntry)
+            if result != expected:
+                raise AssertionError(
+                    f"Compiled pattern match of {match_path!r} returned {result} "
+                    f"but per-pattern match returned {expected} "
+                    f"(includes={[p.glob for p in self.includes]}, "
+                    f"excludes={[p.glob for p in self.excludes]}, "
+                    f"force_includes={[p.glob for p in self.force_includes]})"
+                )
+        return result
 
-    def matches(self, match_path: str, direntry: os.DirEntry[str]):
+    def matches_per_pattern(self, match_path: str, direntry: os.DirEntry[str]):
+        """Reference implementation which evaluates each pattern in turn."""
         includes = self.includes
         excludes = self.excludes
         force_includes = self.force_includes
@@ -59,6 +189,99 @@ class MatchPredicate:
         return True
 
 
+class SubtreePruner:
+    """Determines which directories can contain entries matched by a predicate.
+
+    Include and force_include patterns are evaluated segment by segment as the
+    tree is descended: a directory only needs to be scanned if some pattern can
+    still match a path beneath it. Independently, a directory matched by an
+    exclude pattern of the form `{pattern}/**` has every descendant excluded,
+    so it does not need to be scanned unless a force_include pattern could
+    match under it.
+
+    States are opaque values produced by `root()` and `descend()`. A `descend()`
+    result of None means that nothing under that directory can match.
+    """
+
+    def __init__(self, predicate: MatchPredicate):
+        # With no includes, everything that is not excluded matches, so only
+        # exclude based pruning applies. The same is true if any include
+        # pattern starts with `**`, since it can match under any directory.
+        self.include_patterns = predicate.includes + predicate.force_includes
+        if not predicate.includes or any(
+            p.segments[0] is None for p in self.include_patterns
+        ):
+            self.include_patterns = None
+        self.force_include_patterns = predicate.force_includes
+        self.exclude_subtrees = CompiledGlobSet(
+            [p for p in predicate.excludes if p.glob.endswith("/**")]
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.include_patterns is not None or bool(self.exclude_subtrees)
+
+    def root(self):
+        include_states = (
+            None
+            if self.include_patterns is None
+            else _advance_segments(self.include_patterns, None, None)
+        )
+        force_states = _advance_segments(self.force_include_patterns, None, None)
+        return include_states, force_states
+
+    def descend(self, state, relpath: str, name: str):
+        include_states, force_states = state
+        force_states = _advance_segments(
+            self.force_include_patterns, force_states, name
+        )
+        if include_states is not None:
+            include_states = _advance_segments(
+                self.include_patterns, include_states, name
+            )
+            if not include_states and not force_states:
+                return None
+        if not force_states and self.exclude_subtrees.matches(relpath):
+            return None
+        return include_states, force_states
+
+
+def _advance_segments(
+    patterns: list[RecursiveGlobPattern],
+    states: frozenset[tuple[int, int]] | None,
+    name: str | None,
+) -> frozenset[tuple[int, int]]:
+    """Advances (pattern index, segment index) states by one path segment.
+
+    If `states` is None, returns the initial states. Only states which still
+    have segments left to match (i.e. can match something under the current
+    directory) are returned.
+    """
+    if states is None:
+        candidates = [(i, 0) for i in range(len(patterns))]
+    else:
+        candidates = []
+        for i, j in states:
+            segment = patterns[i].segments[j]
+            if segment is None:
+                # `**` consumes this segment and may consume more.
+                candidates.append((i, j))
+                candidates.append((i, j + 1))
+            elif segment.fullmatch(name):
+                candidates.append((i, j + 1))
+    # Epsilon closure: a `**` segment may also match zero segments.
+    result = set()
+    while candidates:
+        i, j = candidates.pop()
+        segments = patterns[i].segments
+        if j >= len(segments) or (i, j) in result:
+            continue
+        result.add((i, j))
+        if segments[j] is None:
+            candidates.append((i, j + 1))
+    return frozenset(result)
+
+
 class PatternMatcher:
     def __init__(
         self,
@@ -67,37 +290,186 @@ class PatternMatcher:
         force_includes: Sequence[str] = (),
     ):
         self.predicate = MatchPredicate(includes, excludes, force_includes)
-        # Dictionary of relative posix-style path to DirEntry.
-        # Last relative path to entry.
-        self.all: dict[str, os.DirEntry[str]] = {}
+        # Relative posix-style path to DirEntry-like TreeEntry. The last
+        # scanned entry for a relative path wins.
+        self.all = TreeIndex()
+
+    def add_basedir(self, basedir: Path, *, prune: bool = True, scan_threads: int = 0):
+        """Scans a directory tree, adding its entries to `all`.
 
-    def add_basedir(self, basedir: Path):
+        If `prune` is True, subtrees that cannot contain entries matched by
+        the current predicate are not scanned (their root directory entry is
+        still recorded). Callers that change the predicate after scanning must
+        pass `prune=False`.
+
+        If `scan_threads` is greater than 1, directories are listed
+        concurrently on a thread pool of that size. This helps on file systems
+        where each directory listing has high latency (i.e. NFS or overlay
+        backed build directories). Entries are recorded in the same order as
+        a serial scan.
+        """
         all = self.all
         basedir = basedir.absolute()
+        if len(all):
+            # Entries of this scan replace existing entries with the same path.
+            all.enable_lookup()
+        root_id = all.add_root(str(basedir))
+        add_direntry = all.add_direntry
+        intern_dir = all.intern_dir
+        pruner = SubtreePruner(self.predicate)
+        if not prune or not pruner.enabled:
+            pruner = None
+
+        def descend(prune_state, relpath: str, name: str) -> tuple[bool, object]:
+            if pruner is None:
+                return True, None
+            child_state = pruner.descend(prune_state, relpath, name)
+            return child_state is not None, child_state
 
         # Using scandir and being judicious about path concatenation/conversion
         # (versus using walk) is on the order of 10-50x faster. This is still
         # about 10x slower than an `ls -R` but gets us down to tens of
         # milliseconds for an LLVM install sized tree, which is acceptable.
-        def scan_children(rootpath: str, prefix: str):
+        def scan_children(rootpath: str, prefix: str, prune_state):
+            dir_id = intern_dir(prefix)
             with os.scandir(rootpath) as it:
                 for entry in it:
+                    add_direntry(root_id, dir_id, entry)
                     if entry.is_dir(follow_symlinks=False):
                         relpath = f"{prefix}{entry.name}"
-                        new_rootpath = os.path.join(rootpath, entry.name)
-                        all[relpath] = entry
-                        scan_children(new_rootpath, f"{relpath}/")
-                    else:
+                        scan, child_state = descend(prune_state, relpath, entry.name)
+                        if scan:
+                            new_rootpath = os.path.join(rootpath, entry.name)
+                            scan_children(new_rootpath, f"{relpath}/", child_state)
+
+        # Parallel variant of scan_children. Each directory is listed on the
+        # pool, and the worker that lists it immediately submits listings of
+        # its child directories, so the pool runs ahead of the in-order walk
+        # that records entries.
+        def list_children(
+            executor: ThreadPoolExecutor, rootpath: str, prefix: str, prune_state
+        ) -> list[tuple[os.DirEntry[str], Future | None]]:
+            children = []
+            with os.scandir(rootpath) as it:
+                for entry in it:
+                    child_listing = None
+                    if entry.is_dir(follow_symlinks=False):
                         relpath = f"{prefix}{entry.name}"
-                        all[relpath] = entry
+                        scan, child_state = descend(prune_state, relpath, entry.name)
+                        if scan:
+                            child_listing = executor.submit(
+                                list_children,
+                                executor,
+                                entry.path,
+                                f"{relpath}/",
+                                child_state,
+                            )
+                    children.append((entry, child_listing))
+            return children
+
+        def record_children(prefix: str, listing: Future):
+            dir_id = intern_dir(prefix)
+            for entry, child_listing in listing.result():
+                add_direntry(root_id, dir_id, entry)
+                if child_listing is not None:
+                    record_children(f"{prefix}{entry.name}/", child_listing)
 
-        scan_children(basedir, "")
+        root_state = pruner.root() if pruner is not None else None
+        if scan_threads > 1:
+            with ThreadPoolExecutor(
+                max_workers=scan_threads, thread_name_prefix="scan"
+            ) as executor:
+                try:
+                    record_children(
+                        "",
+                        executor.submit(
+                            list_children, executor, str(basedir), "", root_state
+                        ),
+                    )
+                except BaseException:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+        else:
+            scan_children(basedir, "", root_state)
 
     def matches(self) -> Generator[tuple[str, os.DirEntry[str]], None, None]:
         for match_path, direntry in self.all.items():
             if self.predicate.matches(match_path, direntry):
                 yield match_path, direntry
 
+    def scan_matches(
+        self, basedirs: Sequence[Path], *, prune: bool = True
+    ) -> Generator[tuple[str, os.DirEntry[str]], None, None]:
+        """Scans directory trees, yielding matching entries as they are found.
+
+        This yields the same entries, in the same order, as `add_basedir` for
+        each of `basedirs` followed by `matches()`, but nothing is recorded in
+        `all`. Scanning, matching and whatever consumes the entries form a
+        pipeline: memory use is bounded by the tree depth (plus the number of
+        paths present in more than one base directory) rather than by the
+        number of entries.
+
+        A path present in several base directories is yielded once, where the
+        first of them has it, with the entry of the last of them. Since later
+        base directories have not been scanned yet at that point, they are
+        checked with an lstat of the path for each match.
+        """
+        basedirs = [basedir.absolute() for basedir in basedirs]
+        # Entries of later base directories yielded in place of earlier ones,
+        # and their paths.
+        overrides = TreeIndex()
+        root_ids = [overrides.add_root(str(basedir)) for basedir in basedirs]
+        overridden: set[str] = set()
+        for k, basedir in enumerate(basedirs):
+            # Last first, since the last entry for a path wins.
+            later = [
+                _OverrideFinder(overrides, root_ids[j], basedirs[j])
+                for j in reversed(range(k + 1, len(basedirs)))
+            ]
+            for relpath, direntry in self._walk(basedir, prune):
+                if not self.predicate.matches(relpath, direntry):
+                    continue
+                if overridden and relpath in overridden:
+                    continue
+                for finder in later:
+                    override = finder.find(relpath)
+                    if override is not None:
+                        overridden.add(relpath)
+                        direntry = override
+                        break
+                yield relpath, direntry
+
+    def _walk(
+        self, basedir: Path, prune: bool
+    ) -> Generator[tuple[str, os.DirEntry[str]], None, None]:
+        """Yields (relpath, DirEntry) of a directory tree in the order that
+        `add_basedir` records them, keeping one open listing per level."""
+        pruner = SubtreePruner(self.predicate)
+        if not prune or not pruner.enabled:
+            pruner = None
+        stack = [(os.scandir(basedir), "", pruner.root() if pruner else None)]
+        try:
+            while stack:
+                it, prefix, prune_state = stack[-1]
+                for entry in it:
+                    relpath = f"{prefix}{entry.name}"
+                    yield relpath, entry
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    child_state = None
+                    if pruner is not None:
+                        child_state = pruner.descend(prune_state, relpath, entry.name)
+                        if child_state is None:
+                            continue
+                    stack.append((os.scandir(entry.path), f"{relpath}/", child_state))
+                    break
+                else:
+                    it.close()
+                    stack.pop()
+        finally:
+            for it, _, _ in stack:
+                it.close()
+
     def copy_to(
         self,
         *,
@@ -106,65 +478,128 @@ class PatternMatcher:
         verbose: bool = False,
         always_copy: bool = False,
         remove_dest: bool = True,
-    ):
+        jobs: int = 0,
+        stats: file_copy.CopyStats | None = None,
+        sync: bool = False,
+        delete_stale: bool = True,
+        copied_relpaths: set[str] | None = None,
+        store: ObjectStore | None = None,
+        entries: Iterable[tuple[str, os.DirEntry[str]]] | None = None,
+    ) -> file_copy.CopyStats:
+        """Copies all matching entries to `destdir`.
+
+        Files are hardlinked where possible (unless `always_copy`) and copied
+        otherwise. If `jobs` is greater than 1, links and copies are performed
+        on a thread pool of that size. Counters are accumulated into `stats`
+        (a new CopyStats if not provided), which is returned.
+
+        If `sync`, the destination is updated incrementally instead: entries
+        that already match their source are left alone (`remove_dest` is
+        ignored) and, if `delete_stale`, entries under `destdir` that are not
+        part of the copy are removed.
+
+        If `copied_relpaths` is provided, the destination relative path of
+        every entry copied is added to it.
+
+        If `store` is provided, files are added to it and hardlinked from it
+        instead (`always_copy` is ignored).
+
+        If `entries` is provided (i.e. from `scan_matches`), they are copied
+        instead of `matches()`. Entries are copied as they are produced.
+        """
+        if stats is None:
+            stats = file_copy.CopyStats()
+        if sync:
+            remove_dest = False
         if remove_dest and destdir.exists():
             if verbose:
                 print(f"rmtree {destdir}", file=sys.stderr)
             shutil.rmtree(destdir)
         destdir.mkdir(parents=True, exist_ok=True)
 
-        for relpath, direntry in self.matches():
-            try:
-                destpath = destdir / PurePosixPath(destprefix + relpath)
-                if direntry.is_dir() and not direntry.is_symlink():
-                    # Directory.
-                    if verbose:
-                        print(f"mkdir {destpath}", file=sys.stderr, end="")
-                    destpath.mkdir(parents=True, exist_ok=True)
-                elif direntry.is_symlink():
-                    # Symlink.
-                    if not remove_dest and (destpath.exists() or destpath.is_symlink()):
-                        os.unlink(destpath)
-                    targetpath = os.readlink(direntry.path)
-                    if verbose:
-                        print(
-                            f"symlink {targetpath} -> {destpath}",
-                            file=sys.stderr,
-                            end="",
-                        )
-                    destpath.parent.mkdir(parents=True, exist_ok=True)
-                    os.symlink(targetpath, destpath)
+        destroot = os.fspath(destdir)
+        if entries is None:
+            entries = self.matches()
+        keep_relpaths: set[str] | None = copied_relpaths
+        if keep_relpaths is None and sync and delete_stale:
+            keep_relpaths = set()
+
+        def ops() -> Iterator[file_copy.CopyOp]:
+            for relpath, direntry in entries:
+                destpath = os.path.join(destroot, destprefix + relpath)
+                if direntry.is_symlink():
+                    kind = file_copy.OP_SYMLINK
+                elif direntry.is_dir():
+                    kind = file_copy.OP_DIR
                 else:
-                    # Regular file.
-                    if not remove_dest and (destpath.exists() or destpath.is_symlink()):
-                        os.unlink(destpath)
-                    destpath.parent.mkdir(parents=True, exist_ok=True)
-                    linked_file = False
-                    if not always_copy:
-                        # Attempt to link
-                        try:
-                            if verbose:
-                                print(
-                                    f"hardlink {direntry.path} -> {destpath}",
-                                    file=sys.stderr,
-                                    end="",
-                                )
-                            os.link(direntry.path, destpath, follow_symlinks=False)
-                            linked_file = True
-                        except OSError:
-                            if verbose:
-                                print(
-                                    " (falling back to copy) ", file=sys.stderr, end=""
-                                )
-                    if not linked_file:
-                        # Make a copy instead.
-                        if verbose:
-                            print(
-                                f"copy {direntry.path} -> {destpath}",
-                                file=sys.stderr,
-                                end="",
-                            )
-                        shutil.copy2(direntry.path, destpath, follow_symlinks=False)
-            finally:
-                if verbose:
-                    print("", file=sys.stderr)
+                    kind = file_copy.OP_FILE
+                yield file_copy.CopyOp(kind, direntry.path, destpath)
+                if keep_relpaths is not None:
+                    keep_relpaths.add(destprefix + relpath)
+
+        file_copy.execute(
+            ops(),
+            stats=stats,
+            jobs=jobs,
+            verbose=verbose,
+            always_copy=always_copy,
+            replace_existing=not remove_dest,
+            sync=sync,
+            store=store,
+        )
+        if sync and delete_stale:
+            file_copy.remove_stale(
+                destroot, keep_relpaths, stats=stats, verbose=verbose
+            )
+        return stats
+
+
+class _OverrideFinder:
+    """Finds the entries of a not yet scanned base directory for
+    `PatternMatcher.scan_matches`.
+
+    A path is only found if a scan would record it, i.e. none of its parent
+    directories are symlinks. Parents are checked once per directory, which
+    is cheap since matches arrive in scan order.
+    """
+
+    def __init__(self, overrides: TreeIndex, root_id: int, basedir: Path):
+        self.overrides = overrides
+        self.root_id = root_id
+        self.basedir = os.fspath(basedir)
+        # Whether the last checked directory prefix is a real directory.
+        self._prefix: str | None = None
+        self._prefix_is_dir = False
+
+    def find(self, relpath: str) -> TreeEntry | None:
+        prefix, sep, name = relpath.rpartition("/")
+        prefix += sep
+        if prefix != self._prefix:
+            self._prefix = prefix
+            self._prefix_is_dir = self._is_real_dir(prefix)
+        if not self._prefix_is_dir:
+            return None
+        try:
+            st = os.lstat(os.path.join(self.basedir, relpath))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        overrides = self.overrides
+        overrides.add(
+            self.root_id,
+            overrides.intern_dir(prefix),
+            name,
+            mode_type(st.st_mode),
+            st.st_ino,
+        )
+        return overrides.entry(len(overrides) - 1)
+
+    def _is_real_dir(self, prefix: str) -> bool:
+        path = self.basedir
+        for part in prefix.split("/")[:-1]:
+            path = os.path.join(path, part)
+            try:
+                if not stat.S_ISDIR(os.lstat(path).st_mode):
+                    return False
+            except (FileNotFoundError, NotADirectoryError):
+                return False
+        return True
@@ -0,0 +1,100 @@
+"""Sidecar index for random access into artifact archives.
+
+`artifact-archive --seekable` compresses the tar stream in small independent
+blocks (see `compression.py`) and writes a `{archive}.seek.json` file next to
+the archive. It maps each tar member to its uncompressed byte range and lists
+the compressed offset at which each block starts. To read one member, a reader
+finds the block containing the member's header, starts decompressing there and
+discards at most one block's worth of preceding data.
+
+The index is compact JSON:
+
+    {
+        "version": 1,
+        "format": "xz",
+        "compressed_size": 123456,
+        "blocks": [[0, 0], [1048576, 40123], ...],
+        "members": [["artifact_manifest.txt", 0, 1024], ...]
+    }
+
+Blocks are (uncompressed offset, compressed offset) pairs. Members are
+(name, start, end) uncompressed offsets, where the range covers the member's
+headers and padded data.
+"""
+
+from bisect import bisect_right
+import json
+import os
+from pathlib import Path
+
+SEEK_INDEX_SUFFIX = ".seek.json"
+SEEK_INDEX_VERSION = 1
+
+
+def seek_index_path_for(archive_path: Path) -> Path:
+    return archive_path.with_name(archive_path.name + SEEK_INDEX_SUFFIX)
+
+
+class SeekIndex:
+    def __init__(
+        self,
+        format: str,
+        compressed_size: int,
+        blocks: list[tuple[int, int]],
+        members: list[tuple[str, int, int]],
+    ):
+        self.format = format
+        self.compressed_size = compressed_size
+        self.blocks = blocks
+        self.members = members
+        self._block_starts = [b[0] for b in blocks]
+
+    def block_for(self, offset: int) -> tuple[int, int]:
+        """Returns the (uncompressed, compressed) start of the block containing
+        the uncompressed `offset`."""
+        i = bisect_right(self._block_starts, offset) - 1
+        if i < 0:
+            raise ValueError(f"Offset {offset} precedes the first block")
+        return self.blocks[i]
+
+    def check_archive(self, archive_path: Path):
+        """Raises an IOError if the index does not belong to the archive."""
+        size = os.path.getsize(archive_path)
+        if size != self.compressed_size:
+            raise IOError(
+                f"Seek index for {archive_path} is stale (it describes a "
+                f"{self.compressed_size} byte archive, but the archive is "
+                f"{size} bytes)"
+            )
+
+    def to_bytes(self) -> bytes:
+        return json.dumps(
+            {
+                "version": SEEK_INDEX_VERSION,
+                "format": self.format,
+                "compressed_size": self.compressed_size,
+                "blocks": self.blocks,
+                "members": self.members,
+            },
+            separators=(",", ":"),
+        ).encode()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "SeekIndex":
+        contents = json.loads(data)
+        version = contents.get("version")
+        if version != SEEK_INDEX_VERSION:
+            raise IOError(f"Unsupported seek index version: {version}")
+        return SeekIndex(
+            contents["format"],
+            contents["compressed_size"],
+            [tuple(b) for b in contents["blocks"]],
+            [tuple(m) for m in contents["members"]],
+        )
+
+    def save(self, path: Path):
+        path.write_bytes(self.to_bytes())
+
+    @staticmethod
+    def load(path: Path) -> "SeekIndex":
+        return SeekIndex.from_bytes(path.read_bytes())
@@ -0,0 +1,98 @@
+"""Fast fingerprints of scanned file trees.
+
+The artifact and dist steps of the build re-run whenever an upstream stamp
+file is touched, which is usually far more often than the staged files change.
+`fileset_tool.py --fingerprint-file` hashes what an invocation would read (the
+metadata of its scanned trees, its descriptor and options) into a
+`TreeFingerprint` and records it next to its outputs. If the recorded
+fingerprint matches on the next run, the outputs are known to be up to date and
+nothing is rewritten, so that steps depending on them see unmodified files.
+
+Only metadata is hashed: each entry contributes its relative path, file type
+and permission bits, and for files their size and mtime, and for symlinks their
+target. Directory sizes and mtimes are left out, since they change with
+unrelated activity in the directory. Like make, this trusts that a file whose
+contents changed also has a new mtime or size.
+"""
+
+from typing import Iterable
+
+import hashlib
+import os
+from pathlib import Path
+import stat
+
+FINGERPRINT_VERSION = 1
+
+
+class TreeFingerprint:
+    def __init__(self):
+        self._hasher = hashlib.sha256(f"fingerprint {FINGERPRINT_VERSION}\n".encode())
+
+    def add_value(self, name: str, value: object):
+        """Adds a named value, hashed by its `repr`."""
+        self._update(f"value {name} {value!r}\n")
+
+    def add_file_contents(self, name: str, path: os.PathLike | str):
+        """Adds the contents of a (small) file."""
+        contents = Path(path).read_bytes()
+        self._update(f"contents {name} {len(contents)}\n")
+        self._hasher.update(contents)
+
+    def add_file_stat(self, name: str, path: os.PathLike | str):
+        """Adds the metadata of a single file (i.e. an archive)."""
+        st = os.stat(path)
+        self._update(
+            f"stat {name} {st.st_mode:o} {st.st_size} {st.st_mtime_ns} "
+            f"{st.st_dev} {st.st_ino}\n"
+        )
+
+    def add_tree(self, name: str, entries: Iterable[tuple[str, os.DirEntry[str]]]):
+        """Adds (relative path, DirEntry-like) pairs as recorded by a scan (i.e.
+        `PatternMatcher.all.items()`).
+
+        Entries are hashed in the order given, which for a scan of an unchanged
+        tree is the same from run to run.
+        """
+        lines = [f"tree {name}\n"]
+        for relpath, direntry in entries:
+            st = direntry.stat(follow_symlinks=False)
+            mode = st.st_mode
+            if stat.S_ISDIR(mode):
+                lines.append(f"{relpath}\0{mode:o}\n")
+            elif stat.S_ISLNK(mode):
+                lines.append(f"{relpath}\0{mode:o}\0{os.readlink(direntry.path)}\n")
+            else:
+                lines.append(f"{relpath}\0{mode:o}\0{st.st_size}\0{st.st_mtime_ns}\n")
+        self._update("".join(lines))
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
+
+    def _update(self, text: str):
+        self._hasher.update(text.encode(errors="surrogateescape"))
+
+
+def read_fingerprint(path: Path) -> str | None:
+    """Returns the fingerprint recorded at `path`, if any."""
+    try:
+        return path.read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_fingerprint(path: Path, fingerprint: str):
+    """Records a fingerprint, replacing `path` atomically.
+
+    Callers remove the previous fingerprint (see `clear_fingerprint`) before
+    they start modifying their outputs, so that an interrupted run is never
+    mistaken for an up to date one.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(fingerprint + "\n")
+    os.replace(tmp_path, path)
+
+
+def clear_fingerprint(path: Path):
+    path.unlink(missing_ok=True)
@@ -0,0 +1,275 @@
+"""Compact index of scanned directory trees.
+
+`PatternMatcher.all` maps every relative path of a scanned tree to its entry.
+Keeping an `os.DirEntry` (which holds its absolute path) and a relative path
+string for each entry takes hundreds of bytes per entry, which adds up to
+hundreds of MB for the million entry trees of a full build.
+
+`TreeIndex` is a drop-in replacement for that dict. It stores entries in
+columns instead:
+
+    _names      entry names (the only per entry objects)
+    _dirs       array of ids of the interned relative directory prefix
+                ("" or "a/b/") of each entry
+    _roots      array of ids of the scanned base directory of each entry
+    _types      array of entry types (directory, file, symlink or other)
+    _inodes     array of inode numbers
+
+All of which come from the directory listing for free (on most file systems).
+Relative and absolute paths are concatenated when iterating, and entries are
+handed out as `TreeEntry` views that implement the `os.DirEntry` interface.
+Permission bits, sizes and times are not recorded, since that would take a
+`stat` per entry during the scan: `TreeEntry.stat()` reads them when asked.
+
+Like the dict it replaces, assigning an existing relative path (i.e. scanning
+a second base directory with overlapping contents) replaces its entry in
+place, keeping its position in iteration order. Lookups by relative path use
+per directory dicts of names, which are only built when first needed.
+
+Entries that do not live under a base directory (i.e. the `ArchiveEntry`
+objects of artifact archives) can be added with `add_object`, and are handed
+out as is rather than as `TreeEntry` views.
+"""
+
+from typing import Iterator
+
+from array import array
+from itertools import repeat
+import os
+import stat
+
+TYPE_DIR = 0
+TYPE_FILE = 1
+TYPE_SYMLINK = 2
+TYPE_OTHER = 3
+
+
+def direntry_type(entry: os.DirEntry[str]) -> int:
+    """Returns the TYPE_* of a directory listing entry (without following
+    symlinks)."""
+    if entry.is_dir(follow_symlinks=False):
+        return TYPE_DIR
+    if entry.is_symlink():
+        return TYPE_SYMLINK
+    if entry.is_file(follow_symlinks=False):
+        return TYPE_FILE
+    return TYPE_OTHER
+
+
+def mode_type(mode: int) -> int:
+    """Returns the TYPE_* of an `st_mode`."""
+    if stat.S_ISDIR(mode):
+        return TYPE_DIR
+    if stat.S_ISLNK(mode):
+        return TYPE_SYMLINK
+    if stat.S_ISREG(mode):
+        return TYPE_FILE
+    return TYPE_OTHER
+
+
+class TreeIndex:
+    def __init__(self):
+        # Absolute base directory paths, with a trailing separator.
+        self._root_prefixes: list[str] = []
+        # Interned relative directory prefixes and their ids.
+        self._dir_prefixes: list[str] = []
+        self._dir_ids: dict[str, int] = {}
+        # Columns.
+        self._names: list[str] = []
+        self._dirs = array("I")
+        self._roots = array("I")
+        self._types = array("B")
+        self._inodes = array("Q")
+        # Entry index by name, per directory id. None until first needed.
+        self._children: list[dict[str, int]] | None = None
+        # Entries added with add_object, by entry number.
+        self._objects: dict[int, object] = {}
+
+    def add_root(self, root_path: str) -> int:
+        """Registers an absolute base directory, returning its id."""
+        self._root_prefixes.append(os.path.join(root_path, ""))
+        return len(self._root_prefixes) - 1
+
+    def intern_dir(self, prefix: str) -> int:
+        """Returns the id of a relative directory prefix ("" or "a/b/")."""
+        dir_id = self._dir_ids.get(prefix)
+        if dir_id is None:
+            dir_id = len(self._dir_prefixes)
+            self._dir_prefixes.append(prefix)
+            self._dir_ids[prefix] = dir_id
+            if self._children is not None:
+                self._children.append({})
+        return dir_id
+
+    def add(self, root_id: int, dir_id: int, name: str, type: int, inode: int) -> int:
+        """Adds an entry, replacing an existing one with the same relative path
+        (if lookups are enabled, see `enable_lookup`). Returns its number."""
+        children = self._children
+        if children is not None:
+            dir_children = children[dir_id]
+            i = dir_children.get(name)
+            if i is not None:
+                self._roots[i] = root_id
+                self._types[i] = type
+                self._inodes[i] = inode
+                if self._objects:
+                    self._objects.pop(i, None)
+                return i
+            dir_children[name] = len(self._names)
+        self._names.append(name)
+        self._dirs.append(dir_id)
+        self._roots.append(root_id)
+        self._types.append(type)
+        self._inodes.append(inode)
+        return len(self._names) - 1
+
+    def add_direntry(self, root_id: int, dir_id: int, entry: os.DirEntry[str]):
+        self.add(root_id, dir_id, entry.name, direntry_type(entry), entry.inode())
+
+    def add_object(self, root_id: int, dir_id: int, name: str, entry: object):
+        """Adds a DirEntry-like object that has no path under the base
+        directory `root_id`, which is handed out in place of a `TreeEntry`."""
+        i = self.add(root_id, dir_id, name, direntry_type(entry), 0)
+        self._objects[i] = entry
+
+    def enable_lookup(self):
+        """Builds the per directory name dicts, after which lookups by relative
+        path work and adding an existing path replaces its entry. Entries
+        added before must have unique paths (as any single scan does)."""
+        if self._children is not None:
+            return
+        children: list[dict[str, int]] = [{} for _ in self._dir_prefixes]
+        for i, (name, dir_id) in enumerate(zip(self._names, self._dirs)):
+            children[dir_id][name] = i
+        self._children = children
+
+    def update(self, other: "TreeIndex"):
+        """Adds all entries of `other`, replacing those with the same relative
+        path (like `dict.update`)."""
+        if len(self):
+            self.enable_lookup()
+        root_ids = [self.add_root(prefix) for prefix in other._root_prefixes]
+        dir_ids = [self.intern_dir(prefix) for prefix in other._dir_prefixes]
+        for name, dir_id, root_id, type, inode in zip(
+            other._names, other._dirs, other._roots, other._types, other._inodes
+        ):
+            self.add(root_ids[root_id], dir_ids[dir_id], name, type, inode)
+        for j, entry in other._objects.items():
+            self._objects[self._find(other.relpath(j))] = entry
+
+    def _find(self, relpath: str) -> int | None:
+        self.enable_lookup()
+        prefix, sep, name = relpath.rpartition("/")
+        dir_id = self._dir_ids.get(prefix + sep)
+        if dir_id is None:
+            return None
+        return self._children[dir_id].get(name)
+
+    def entry(self, i: int) -> "TreeEntry":
+        """Returns the entry number `i`, in iteration order."""
+        if self._objects:
+            entry = self._objects.get(i)
+            if entry is not None:
+                return entry
+        return TreeEntry((self, i))
+
+    def relpath(self, i: int) -> str:
+        return self._dir_prefixes[self._dirs[i]] + self._names[i]
+
+    # Mapping interface.
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, relpath: str) -> bool:
+        return self._find(relpath) is not None
+
+    def __getitem__(self, relpath: str) -> "TreeEntry":
+        i = self._find(relpath)
+        if i is None:
+            raise KeyError(relpath)
+        return self.entry(i)
+
+    def get(self, relpath: str, default=None):
+        i = self._find(relpath)
+        return default if i is None else self.entry(i)
+
+    def __iter__(self) -> Iterator[str]:
+        return self.keys()
+
+    # Iteration is built from map and zip, which run in C, since iterating
+    # over all entries is what a PatternMatcher mostly does.
+    def keys(self) -> Iterator[str]:
+        return map(
+            str.__add__, map(self._dir_prefixes.__getitem__, self._dirs), self._names
+        )
+
+    def values(self) -> Iterator["TreeEntry"]:
+        if self._objects:
+            return map(self.entry, range(len(self._names)))
+        return map(TreeEntry, zip(repeat(self), range(len(self._names))))
+
+    def items(self) -> Iterator[tuple[str, "TreeEntry"]]:
+        return zip(self.keys(), self.values())
+
+
+class TreeEntry(tuple):
+    """A `TreeIndex` entry, with the interface of `os.DirEntry`.
+
+    This is an (index, entry number) tuple, so that iteration creates entries
+    without running any Python code.
+    """
+
+    __slots__ = ()
+
+    @property
+    def name(self) -> str:
+        index, i = self
+        return index._names[i]
+
+    @property
+    def relpath(self) -> str:
+        index, i = self
+        return index.relpath(i)
+
+    @property
+    def path(self) -> str:
+        index, i = self
+        return (
+            index._root_prefixes[index._roots[i]]
+            + index._dir_prefixes[index._dirs[i]]
+            + index._names[i]
+        )
+
+    def inode(self) -> int:
+        index, i = self
+        return index._inodes[i]
+
+    def is_dir(self, *, follow_symlinks: bool = True) -> bool:
+        index, i = self
+        type = index._types[i]
+        if type == TYPE_SYMLINK and follow_symlinks:
+            return os.path.isdir(self.path)
+        return type == TYPE_DIR
+
+    def is_file(self, *, follow_symlinks: bool = True) -> bool:
+        index, i = self
+        type = index._types[i]
+        if type == TYPE_SYMLINK and follow_symlinks:
+            return os.path.isfile(self.path)
+        return type == TYPE_FILE
+
+    def is_symlink(self) -> bool:
+        index, i = self
+        return index._types[i] == TYPE_SYMLINK
+
+    def is_junction(self) -> bool:
+        return False
+
+    def stat(self, *, follow_symlinks: bool = True) -> os.stat_result:
+        return os.stat(self.path, follow_symlinks=follow_symlinks)
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def __repr__(self):
+        return f"<TreeEntry {self.name!r}>"
@@ -13,16 +13,59 @@ with the following changes:
 * It does not support character classes.
 """
 
-from typing import Callable
+from typing import BinaryIO, Callable, Iterable
 import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import io
 import os
 from pathlib import Path, PurePosixPath
 import sys
 import shutil
+import stat
 import tarfile
+import tempfile
+import time
 
-from _therock_utils.hash_util import calculate_hash, write_hash
-from _therock_utils.pattern_match import PatternMatcher
+from _therock_utils.artifact_archive import (
+    ManifestPrefixes,
+    check_not_delta,
+    read_archive_header,
+)
+from _therock_utils.artifact_index import (
+    ARTIFACT_INDEX_NAME,
+    ENTRY_DIR,
+    ENTRY_FILE,
+    ENTRY_HARDLINK,
+    ENTRY_SYMLINK,
+    ArtifactIndex,
+    IndexEntry,
+)
+from _therock_utils.compression import (
+    ARCHIVE_FORMATS,
+    DEFAULT_COMPRESSION_LEVELS,
+    DEFAULT_MAX_THREADS,
+    DEFAULT_SEEKABLE_BLOCK_SIZE,
+    archive_format,
+    default_threads,
+    open_compressed_reader,
+    open_compressed_writer,
+)
+from _therock_utils.file_copy import CopyStats, remove_stale
+from _therock_utils.hash_util import HashingWriter, calculate_hash, write_hash
+from _therock_utils.object_store import ObjectStore
+from _therock_utils.pattern_match import MatchPredicate, PatternMatcher
+from _therock_utils.seek_index import (
+    SEEK_INDEX_SUFFIX,
+    SeekIndex,
+    seek_index_path_for,
+)
+from _therock_utils.tree_fingerprint import (
+    TreeFingerprint,
+    clear_fingerprint,
+    read_fingerprint,
+    write_fingerprint,
+)
 
 
 class ComponentDefaults:
@@ -95,20 +138,64 @@ ComponentDefaults.get("run").excludes.extend(ComponentDefaults.get("lib").includ
 ComponentDefaults.get("run").excludes.extend(ComponentDefaults.get("doc").includes)
 
 
+def _scan_matches(
+    args: argparse.Namespace, pm: PatternMatcher, *, materialize: bool = False
+) -> Iterable[tuple[str, os.DirEntry[str]]]:
+    """Returns the matching entries of the `basedir` arguments.
+
+    Serial scans are streamed (see `PatternMatcher.scan_matches`), so that
+    output starts right away and memory does not grow with the tree. Parallel
+    scans, and callers that need `pm.all` (`materialize`), scan the trees into
+    `pm.all` first.
+    """
+    if args.scan_threads > 1 or materialize:
+        for basedir in args.basedir:
+            pm.add_basedir(basedir, scan_threads=args.scan_threads)
+        return pm.matches()
+    return pm.scan_matches(args.basedir)
+
+
 def do_list(args: argparse.Namespace, pm: PatternMatcher):
-    for relpath, direntry in pm.matches():
+    for relpath, direntry in _scan_matches(args, pm):
         print(relpath)
 
 
 def do_copy(args: argparse.Namespace, pm: PatternMatcher):
     verbose = args.verbose
     destdir: Path = args.dest_dir
-    pm.copy_to(
+    # The fingerprint covers the whole scan, so it needs `pm.all`. A streamed
+    # scan would also see its own output if it is inside a base directory.
+    materialize = bool(args.fingerprint_file) or any(
+        destdir.absolute().is_relative_to(basedir.absolute())
+        for basedir in args.basedir
+    )
+    entries = _scan_matches(args, pm, materialize=materialize)
+    fingerprint = None
+    if args.fingerprint_file:
+        fingerprint = _tool_fingerprint()
+        fingerprint.add_value("basedirs", [os.fspath(d) for d in args.basedir])
+        fingerprint.add_value("dest_dir", os.fspath(destdir))
+        fingerprint.add_value("include", args.include)
+        fingerprint.add_value("exclude", args.exclude)
+        fingerprint.add_value(
+            "options", (args.always_copy, args.remove_dest, args.sync)
+        )
+        fingerprint.add_tree("", pm.all.items())
+        if _outputs_up_to_date(args, fingerprint, [destdir], "copy"):
+            return
+    stats = pm.copy_to(
         destdir=destdir,
         verbose=verbose,
         always_copy=args.always_copy,
         remove_dest=args.remove_dest,
+        jobs=args.jobs,
+        sync=args.sync,
+        entries=entries,
     )
+    if fingerprint is not None:
+        write_fingerprint(args.fingerprint_file, fingerprint.hexdigest())
+    if args.stats:
+        stats.report()
 
 
 def do_artifact(args):
@@ -135,167 +222,1385 @@ def do_artifact(args):
     that cover most common cases. Local deviations must be added explicitly
     in the descriptor.
 
-    This is called once per component and will create a directory for that
-    component.
+    This creates a directory for each `--component` given, paired in order with
+    an `--output-dir`. When several components are produced at once, each
+    stage directory is scanned once and the result is shared between them.
+    With `--sync`, an existing output directory is updated in place rather than
+    being recreated. With `--fingerprint-file`, nothing is written if the
+    scanned stage directories, descriptor and options are the same as in the
+    run that recorded the fingerprint.
     """
     descriptor = load_toml_file(args.descriptor) or {}
-    component_name = args.component
-    # Set up output dir.
-    output_dir: Path = args.output_dir
-    if output_dir.exists():
-        shutil.rmtree(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    # Get metadata for the component we are merging.
-    try:
-        component_record = descriptor["components"][component_name]
-    except KeyError:
-        # No components.
-        component_record = {}
-
-    all_basedir_relpaths = []
-    for basedir_relpath, basedir_record in component_record.items():
-        use_default_patterns = basedir_record.get("default_patterns", True)
-        basedir = args.root_dir / Path(basedir_relpath)
-        optional = basedir_record.get("optional")
-        if optional and not basedir.exists():
-            continue
-        all_basedir_relpaths.append(basedir_relpath)
+    component_names: list[str] = args.component
+    output_dirs: list[Path] = args.output_dir
+    if len(component_names) != len(output_dirs):
+        raise ValueError(
+            f"Expected one --output-dir per --component (got "
+            f"{len(component_names)} components and {len(output_dirs)} output dirs)"
+        )
+
+    # Get metadata for the components we are merging.
+    component_records: list[dict] = []
+    for component_name in component_names:
+        try:
+            component_records.append(descriptor["components"][component_name])
+        except KeyError:
+            # No components.
+            component_records.append({})
 
-        # Force includes.
-        force_includes = _dup_list_or_str(basedir_record.get("force_include"))
+    # Stage directories used by more than one component are scanned once, in
+    # full, and shared. Otherwise, the scan is pruned by the component's
+    # patterns.
+    basedir_use_counts: dict[str, int] = {}
+    for component_record in component_records:
+        for basedir_relpath in component_record.keys():
+            basedir_use_counts[basedir_relpath] = (
+                basedir_use_counts.get(basedir_relpath, 0) + 1
+            )
+    shared_scans: dict[str, PatternMatcher] = {}
+
+    # Scan all stage directories before writing anything, so that the outputs
+    # can be left alone if the fingerprint of the inputs did not change.
+    component_scans: list[list[tuple[str, PatternMatcher]]] = []
+    for component_name, component_record in zip(component_names, component_records):
+        scans = []
+        for basedir_relpath, basedir_record in component_record.items():
+            use_default_patterns = basedir_record.get("default_patterns", True)
+            basedir = args.root_dir / Path(basedir_relpath)
+            optional = basedir_record.get("optional")
+            if optional and not basedir.exists():
+                continue
+
+            # Force includes.
+            force_includes = _dup_list_or_str(basedir_record.get("force_include"))
+
+            # Includes.
+            includes = _dup_list_or_str(basedir_record.get("include"))
+            if use_default_patterns:
+                includes.extend(
+                    ComponentDefaults.ALL.get(
+                        component_name, ComponentDefaults()
+                    ).includes
+                )
 
-        # Includes.
-        includes = _dup_list_or_str(basedir_record.get("include"))
-        if use_default_patterns:
-            includes.extend(
-                ComponentDefaults.ALL.get(component_name, ComponentDefaults()).includes
+            # Excludes.
+            excludes = _dup_list_or_str(basedir_record.get("exclude"))
+            if use_default_patterns:
+                excludes.extend(
+                    ComponentDefaults.ALL.get(
+                        component_name, ComponentDefaults()
+                    ).excludes
+                )
+
+            pm = PatternMatcher(
+                includes=includes,
+                excludes=excludes,
+                force_includes=force_includes,
             )
+            if basedir_use_counts[basedir_relpath] > 1:
+                shared_pm = shared_scans.get(basedir_relpath)
+                if shared_pm is None:
+                    shared_pm = PatternMatcher()
+                    shared_pm.add_basedir(basedir, scan_threads=args.scan_threads)
+                    shared_scans[basedir_relpath] = shared_pm
+                pm.all = shared_pm.all
+            else:
+                pm.add_basedir(basedir, scan_threads=args.scan_threads)
+            scans.append((basedir_relpath, pm))
+        component_scans.append(scans)
+
+    fingerprint = None
+    if args.fingerprint_file:
+        fingerprint = _tool_fingerprint()
+        fingerprint.add_file_contents("descriptor", args.descriptor)
+        fingerprint.add_value("root_dir", os.fspath(args.root_dir.absolute()))
+        fingerprint.add_value("components", component_names)
+        fingerprint.add_value("output_dirs", [os.fspath(d) for d in output_dirs])
+        fingerprint.add_value("sync", args.sync)
+        fingerprint.add_value("store", args.store and os.fspath(args.store))
+        fingerprinted_scans: set[int] = set()
+        for scans in component_scans:
+            for basedir_relpath, pm in scans:
+                # Shared scans are only hashed once.
+                if id(pm.all) not in fingerprinted_scans:
+                    fingerprinted_scans.add(id(pm.all))
+                    fingerprint.add_tree(basedir_relpath, pm.all.items())
+        if _outputs_up_to_date(
+            args,
+            fingerprint,
+            [output_dir / "artifact_manifest.txt" for output_dir in output_dirs],
+            f"artifact {' '.join(component_names)}",
+        ):
+            return
+
+    store = ObjectStore(args.store) if args.store else None
+    for component_name, scans, output_dir in zip(
+        component_names, component_scans, output_dirs
+    ):
+        # Set up output dir.
+        if output_dir.exists() and not args.sync:
+            shutil.rmtree(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
 
-        # Excludes.
-        excludes = _dup_list_or_str(basedir_record.get("exclude"))
-        if use_default_patterns:
-            excludes.extend(
-                ComponentDefaults.ALL.get(component_name, ComponentDefaults()).excludes
+        all_basedir_relpaths = []
+        stats = CopyStats()
+        copied_relpaths = {"artifact_manifest.txt"}
+        for basedir_relpath, pm in scans:
+            all_basedir_relpaths.append(basedir_relpath)
+            pm.copy_to(
+                destdir=output_dir,
+                destprefix=basedir_relpath + "/",
+                remove_dest=False,
+                jobs=args.jobs,
+                stats=stats,
+                sync=args.sync,
+                delete_stale=False,
+                copied_relpaths=copied_relpaths,
+                store=store,
             )
+        if args.sync:
+            remove_stale(str(output_dir), copied_relpaths, stats=stats)
+
+        # Write a manifest containing relative paths of all base directories.
+        manifest_path = output_dir / "artifact_manifest.txt"
+        manifest_path.write_text("\n".join(all_basedir_relpaths) + "\n")
+        if args.stats:
+            stats.report(f"artifact {component_name}")
+
+    if fingerprint is not None:
+        write_fingerprint(args.fingerprint_file, fingerprint.hexdigest())
 
-        pm = PatternMatcher(
-            includes=includes,
-            excludes=excludes,
-            force_includes=force_includes,
-        )
-        pm.add_basedir(basedir)
-        pm.copy_to(
-            destdir=output_dir,
-            destprefix=basedir_relpath + "/",
-            remove_dest=False,
-        )
 
-    # Write a manifest containing relative paths of all base directories.
-    manifest_path = output_dir / "artifact_manifest.txt"
-    manifest_path.write_text("\n".join(all_basedir_relpaths) + "\n")
+def _tool_fingerprint() -> TreeFingerprint:
+    """Starts a fingerprint with the sources of this tool and of the
+    `_therock_utils` modules, so that changing them invalidates outputs."""
+    fingerprint = TreeFingerprint()
+    tool_path = Path(__file__)
+    fingerprint.add_file_contents("tool", tool_path)
+    for source_path in sorted((tool_path.parent / "_therock_utils").glob("*.py")):
+        fingerprint.add_file_contents(f"_therock_utils/{source_path.name}", source_path)
+    return fingerprint
+
+
+def _outputs_up_to_date(
+    args, fingerprint: TreeFingerprint, outputs: list[Path], label: str
+) -> bool:
+    """Checks `fingerprint` against the one recorded in `--fingerprint-file`.
+
+    Returns True if they match and all `outputs` exist, in which case the
+    caller should not touch its outputs. Otherwise the recorded fingerprint is
+    removed, to be rewritten once the outputs are complete.
+    """
+    if read_fingerprint(args.fingerprint_file) == fingerprint.hexdigest() and all(
+        output.exists() for output in outputs
+    ):
+        if args.stats:
+            print(f"{label}: inputs unchanged, outputs are up to date", file=sys.stderr)
+        return True
+    clear_fingerprint(args.fingerprint_file)
+    return False
 
 
 def do_artifact_archive(args):
     output_path: Path = args.o
-    if output_path.exists():
-        output_path.unlink()
+    compression_format = archive_format(output_path)
+    # Each --hash-file is paired in order with a --hash-algorithm. If no
+    # algorithm is given, all hash files use sha256.
+    hash_files: list[Path] = args.hash_file or []
+    hash_algorithms: list[str] = args.hash_algorithm or ["sha256"] * len(hash_files)
+    if len(hash_files) != len(hash_algorithms):
+        raise ValueError(
+            f"Expected one --hash-algorithm per --hash-file (got "
+            f"{len(hash_algorithms)} algorithms and {len(hash_files)} hash files)"
+        )
+    seek_index_path = args.seek_index or seek_index_path_for(output_path)
+    for p in [output_path, seek_index_path]:
+        if p.exists():
+            p.unlink()
     output_path.parent.mkdir(parents=True, exist_ok=True)
+    block_size = args.block_size
+    if args.seekable and block_size is None:
+        block_size = DEFAULT_SEEKABLE_BLOCK_SIZE
+    # (name, start, end) uncompressed offsets of each member.
+    seek_members: list[tuple[str, int, int]] = []
+    member_order = args.member_order
+    if member_order is None:
+        member_order = "path" if args.reproducible else "scan"
+    tar_filter = None
+    if args.reproducible:
+        source_date_epoch = int(os.getenv("SOURCE_DATE_EPOCH", "0"))
+        tar_filter = lambda tarinfo: _reproducible_tarinfo(tarinfo, source_date_epoch)
+    base_header = None
+    if args.base is not None:
+        base_header = _read_delta_base(args.base)
+
+    # The compressed stream is hashed as it is written so that the archive does
+    # not need to be read back.
+    with open(output_path, "xb") as archive_file:
+        hashing_writer = HashingWriter(archive_file, hash_algorithms)
+        with open_compressed_writer(
+            hashing_writer,
+            compression_format,
+            threads=args.compression_threads,
+            level=args.compression_level,
+            block_size=block_size,
+        ) as compressor, tarfile.TarFile.open(fileobj=compressor, mode="w") as arc:
+            for artifact_path in args.artifact:
+                manifest_path: Path = artifact_path / "artifact_manifest.txt"
+                relpaths = manifest_path.read_text().splitlines()
+                members: list[tuple[str, str]] = []
+                for relpath in relpaths:
+                    if not relpath:
+                        continue
+                    source_dir = artifact_path / relpath
+                    if not source_dir.exists():
+                        continue
+                    pm = PatternMatcher()
+                    pm.add_basedir(source_dir)
+                    for subpath, dir_entry in pm.all.items():
+                        members.append((f"{relpath}/{subpath}", dir_entry.path))
+                _order_members(members, member_order)
+                # Reproducible archives ignore which inputs share an inode, so
+                # that they do not depend on how the inputs are linked (i.e.
+                # whether they come from an object store).
+                index = ArtifactIndex.build(
+                    members,
+                    jobs=args.jobs,
+                    dedup_content=args.dedup_content,
+                    link_inodes=not args.reproducible,
+                    normalize_mode=_reproducible_mode if args.reproducible else None,
+                )
+                if base_header is not None:
+                    # Only store the entries that differ from the base.
+                    base_prefixes, base_index = base_header
+                    unchanged = _delta_unchanged_paths(
+                        base_prefixes, base_index, ManifestPrefixes(relpaths), index
+                    )
+                    index.delta_base = base_index.fingerprint()
+                    members = [m for m in members if m[0] not in unchanged]
+                    if args.stats:
+                        _report_delta(base_index, index, unchanged)
+
+                # Important: The manifest must be stored first, followed by the
+                # index, so that both can be read without decompressing the
+                # rest of the archive.
+                start = arc.offset
+                arc.add(
+                    manifest_path,
+                    arcname=manifest_path.name,
+                    recursive=False,
+                    filter=tar_filter,
+                )
+                seek_members.append((manifest_path.name, start, arc.offset))
+                index_contents = index.to_bytes()
+                index_info = tarfile.TarInfo(ARTIFACT_INDEX_NAME)
+                index_info.size = len(index_contents)
+                index_info.mode = 0o644
+                index_info.mtime = int(manifest_path.stat().st_mtime)
+                if tar_filter:
+                    index_info = tar_filter(index_info)
+                start = arc.offset
+                arc.addfile(index_info, io.BytesIO(index_contents))
+                seek_members.append((ARTIFACT_INDEX_NAME, start, arc.offset))
+                for arcname, fs_path in members:
+                    start = arc.offset
+                    _add_indexed_member(
+                        arc, fs_path, index.entries[arcname], tar_filter
+                    )
+                    seek_members.append((arcname, start, arc.offset))
+
+    if args.stats:
+        compressor.report(f"artifact-archive {output_path.name}")
+        if args.base is not None:
+            base_size = args.base.stat().st_size
+            print(
+                f"artifact-delta: {compressor.compressed_bytes / 1e6:.1f} MB delta vs "
+                f"{base_size / 1e6:.1f} MB base archive "
+                f"({100 * compressor.compressed_bytes / max(base_size, 1):.1f}%)",
+                file=sys.stderr,
+            )
+
+    if args.seekable:
+        SeekIndex(
+            compression_format,
+            compressor.compressed_bytes,
+            compressor.blocks,
+            seek_members,
+        ).save(seek_index_path)
+
+    for hash_file, digest in zip(hash_files, hashing_writer.digests):
+        write_hash(hash_file, digest)
+
+
+def _read_delta_base(
+    base_path: Path,
+) -> tuple[ManifestPrefixes, ArtifactIndex]:
+    """Reads the manifest and index of the base archive of a delta."""
+    with open_compressed_reader(base_path) as archive_file, tarfile.TarFile.open(
+        fileobj=archive_file, mode="r:"
+    ) as tf:
+        prefixes, index, _ = read_archive_header(base_path, tf)
+    if index is None:
+        raise IOError(f"Delta base archive {base_path} has no index")
+    if index.delta_base is not None:
+        raise IOError(f"Delta base archive {base_path} is itself a delta archive")
+    return prefixes, index
+
+
+def _delta_unchanged_paths(
+    base_prefixes: ManifestPrefixes,
+    base_index: ArtifactIndex,
+    new_prefixes: ManifestPrefixes,
+    new_index: ArtifactIndex,
+) -> set[str]:
+    """Returns the paths of entries that are the same in both indexes (and are
+    flattened to the same path)."""
+    if base_index.hash_algorithm != new_index.hash_algorithm:
+        return set()
+    unchanged = set()
+    for path, entry in new_index.entries.items():
+        base_entry = base_index.entries.get(path)
+        if (
+            base_entry is not None
+            and base_entry.to_json() == entry.to_json()
+            and base_prefixes.scope(path) == new_prefixes.scope(path)
+        ):
+            unchanged.add(path)
+    return unchanged
 
-    with _open_archive(output_path) as arc:
-        for artifact_path in args.artifact:
-            manifest_path: Path = artifact_path / "artifact_manifest.txt"
-            relpaths = manifest_path.read_text().splitlines()
-            # Important: The manifest must be stored first.
-            arc.add(manifest_path, arcname=manifest_path.name, recursive=False)
-            for relpath in relpaths:
-                if not relpath:
-                    continue
-                source_dir = artifact_path / relpath
-                if not source_dir.exists():
-                    continue
-                pm = PatternMatcher()
-                pm.add_basedir(source_dir)
-                for subpath, dir_entry in pm.all.items():
-                    fullpath = f"{relpath}/{subpath}"
-                    arc.add(dir_entry.path, arcname=fullpath, recursive=False)
 
-    if args.hash_file:
-        digest = calculate_hash(output_path, args.hash_algorithm)
-        write_hash(args.hash_file, digest)
+def _report_delta(base_index: ArtifactIndex, index: ArtifactIndex, unchanged: set):
+    added = sum(1 for path in index.entries if path not in base_index.entries)
+    removed = sum(1 for path in base_index.entries if path not in index.entries)
+    changed = len(index.entries) - added - len(unchanged)
+    changed_bytes = sum(
+        e.size
+        for e in index.entries.values()
+        if e.path not in unchanged and e.type == ENTRY_FILE
+    )
+    total_bytes = sum(e.size for e in index.entries.values() if e.type == ENTRY_FILE)
+    print(
+        f"artifact-delta: {added} added, {changed} changed, {removed} removed, "
+        f"{len(unchanged)} unchanged entries ({changed_bytes / 1e6:.1f} of "
+        f"{total_bytes / 1e6:.1f} MB stored)",
+        file=sys.stderr,
+    )
+
+
+def _add_indexed_member(
+    arc: tarfile.TarFile,
+    fs_path: str,
+    entry: IndexEntry,
+    tar_filter: Callable[[tarfile.TarInfo], tarfile.TarInfo] | None,
+):
+    """Adds a member to an archive as described by its index entry."""
+    tarinfo = arc.gettarinfo(fs_path, arcname=entry.path)
+    if entry.type == ENTRY_HARDLINK:
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = entry.target
+        tarinfo.size = 0
+    elif tarinfo.islnk():
+        # The file shares an inode with an earlier member, but is indexed (and
+        # so stored) in full, i.e. with --reproducible.
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.linkname = ""
+        tarinfo.size = entry.size
+    if tar_filter:
+        tarinfo = tar_filter(tarinfo)
+    if tarinfo.isreg():
+        with open(fs_path, "rb") as f:
+            arc.addfile(tarinfo, f)
+    else:
+        arc.addfile(tarinfo)
+
+
+# Archive member kinds for `--member-order kind`, in archive order. Similar data
+# is grouped so that the compressor's window holds like with like: text first,
+# then machine code, then GPU code objects and kernel databases.
+_KIND_DIR = 0
+_KIND_SYMLINK = 1
+_KIND_HEADER = 2
+_KIND_CMAKE = 3
+_KIND_TEXT = 4
+_KIND_ELF = 5
+_KIND_STATIC_LIBRARY = 6
+_KIND_CODE_OBJECT = 7
+_KIND_OTHER = 8
+
+_KIND_BY_EXTENSION = {
+    ".h": _KIND_HEADER,
+    ".hh": _KIND_HEADER,
+    ".hpp": _KIND_HEADER,
+    ".hxx": _KIND_HEADER,
+    ".inc": _KIND_HEADER,
+    ".inl": _KIND_HEADER,
+    ".def": _KIND_HEADER,
+    ".cuh": _KIND_HEADER,
+    ".cmake": _KIND_CMAKE,
+    ".pc": _KIND_CMAKE,
+    ".txt": _KIND_TEXT,
+    ".md": _KIND_TEXT,
+    ".py": _KIND_TEXT,
+    ".json": _KIND_TEXT,
+    ".yaml": _KIND_TEXT,
+    ".xml": _KIND_TEXT,
+    ".html": _KIND_TEXT,
+    ".a": _KIND_STATIC_LIBRARY,
+    ".lib": _KIND_STATIC_LIBRARY,
+    ".so": _KIND_ELF,
+    ".o": _KIND_ELF,
+    ".hsaco": _KIND_CODE_OBJECT,
+    ".co": _KIND_CODE_OBJECT,
+    ".kdb": _KIND_CODE_OBJECT,
+    ".dat": _KIND_CODE_OBJECT,
+    ".model": _KIND_CODE_OBJECT,
+}
+
 
+def _member_kind(arcname: str, fs_path: str) -> tuple[int, str]:
+    """Returns the (kind, extension) sort key of an archive member."""
+    if os.path.islink(fs_path):
+        return _KIND_SYMLINK, ""
+    if os.path.isdir(fs_path):
+        return _KIND_DIR, ""
+    name = arcname.rpartition("/")[2]
+    # Versioned shared libraries (libfoo.so.1.2) sort with other ELF files.
+    if ".so." in name:
+        return _KIND_ELF, ".so"
+    stem, ext = os.path.splitext(name)
+    if ext:
+        kind = _KIND_BY_EXTENSION.get(ext.lower())
+        if kind is not None:
+            return kind, ext
+    if name == "CMakeLists.txt":
+        return _KIND_CMAKE, ext
+    # Executables and other files without a known extension: sniff ELF.
+    with open(fs_path, "rb") as f:
+        if f.read(4) == b"\x7fELF":
+            return _KIND_ELF, ext
+    return _KIND_OTHER, ext
 
-def _open_archive(p: Path) -> tarfile.TarFile:
-    return tarfile.TarFile.open(p, mode="x:xz")
+
+def _order_members(members: list[tuple[str, str]], member_order: str):
+    """Sorts (archive name, file system path) members in place."""
+    if member_order == "scan":
+        return
+    elif member_order == "path":
+        # Sort by path components so that directories precede their contents.
+        members.sort(key=lambda m: m[0].split("/"))
+    elif member_order == "kind":
+        # Directories still sort first (by path), so they precede their
+        # contents.
+        members.sort(key=lambda m: (*_member_kind(*m), m[0].split("/")))
+    else:
+        raise ValueError(f"Unknown member order: {member_order}")
+
+
+def _reproducible_mode(mode: int, entry_type: str) -> int:
+    """Normalizes permissions so that they do not depend on the umask."""
+    if entry_type == ENTRY_SYMLINK:
+        return 0o777
+    if entry_type == ENTRY_DIR or mode & 0o111:
+        return 0o755
+    return 0o644
+
+
+def _reproducible_tarinfo(
+    tarinfo: tarfile.TarInfo, source_date_epoch: int
+) -> tarfile.TarInfo:
+    """Strips build machine specific metadata from an archive member."""
+    if tarinfo.issym():
+        entry_type = ENTRY_SYMLINK
+    elif tarinfo.isdir():
+        entry_type = ENTRY_DIR
+    else:
+        entry_type = ENTRY_FILE
+    tarinfo.mode = _reproducible_mode(tarinfo.mode, entry_type)
+    tarinfo.mtime = source_date_epoch
+    tarinfo.uid = 0
+    tarinfo.gid = 0
+    tarinfo.uname = ""
+    tarinfo.gname = ""
+    return tarinfo
 
 
 def _do_artifact_flatten(args):
-    output_path: Path = args.o
+    stats = CopyStats()
+    # Artifact directories scanned for the fingerprint, reused for flattening.
+    scans: dict[Path, PatternMatcher] = {}
+    fingerprint = None
+    if args.fingerprint_file:
+        fingerprint = _flatten_fingerprint(args, scans)
+        if _outputs_up_to_date(args, fingerprint, [args.o], "artifact-flatten"):
+            return
+    store = ObjectStore(args.store) if args.store else None
+    if args.delta is not None:
+        if args.base is None or args.artifact or args.sync:
+            raise ValueError(
+                "artifact-flatten --delta requires --base and no other artifacts"
+            )
+        _flatten_delta(args, stats, store)
+    elif not args.artifact:
+        raise ValueError("artifact-flatten requires artifacts or --base and --delta")
+    elif args.sync:
+        _sync_artifact_dirs(args, stats, store, scans)
+    else:
+        _flatten_artifacts(args, stats, store, scans)
+    if fingerprint is not None:
+        write_fingerprint(args.fingerprint_file, fingerprint.hexdigest())
+    if args.stats:
+        stats.report("artifact-flatten")
+
+
+def _flatten_fingerprint(args, scans: dict[Path, PatternMatcher]) -> TreeFingerprint:
+    """Fingerprints the inputs of artifact-flatten, recording the scans of
+    artifact directories in `scans`."""
+    fingerprint = _tool_fingerprint()
+    fingerprint.add_value("output", os.fspath(args.o))
+    fingerprint.add_value(
+        "options",
+        (args.sync, args.skip_identical, args.store and os.fspath(args.store)),
+    )
+    inputs: list[Path] = list(args.artifact)
+    inputs.extend(p for p in (args.base, args.delta) if p is not None)
+    fingerprint.add_value("inputs", [os.fspath(p) for p in inputs])
+    for artifact_path in inputs:
+        if artifact_path.is_dir():
+            pm = _scan_artifact_dir(artifact_path)
+            scans[artifact_path] = pm
+            fingerprint.add_tree(os.fspath(artifact_path), pm.all.items())
+        else:
+            fingerprint.add_file_stat(os.fspath(artifact_path), artifact_path)
+    return fingerprint
+
+
+def _flatten_artifacts(
+    args,
+    stats: CopyStats,
+    store: ObjectStore | None,
+    scans: dict[Path, PatternMatcher],
+):
     artifact_paths: list[Path] = args.artifact
+    archive_count = sum(1 for p in artifact_paths if not p.is_dir())
+    if args.jobs > 1 and archive_count > 1 and not args.skip_identical:
+        _flatten_artifacts_parallel(args, stats, store, scans)
+        return
     for artifact_path in artifact_paths:
         if artifact_path.is_dir():
-            # Process an exploded artifact dir.
-            pm = PatternMatcher()
-            manifest_path: Path = artifact_path / "artifact_manifest.txt"
-            relpaths = manifest_path.read_text().splitlines()
-            for relpath in relpaths:
-                if not relpath:
-                    continue
-                source_dir = artifact_path / relpath
-                if not source_dir.exists():
+            _flatten_artifact_dir(args, artifact_path, stats, store, scans)
+        else:
+            _flatten_archive_file(args, artifact_path, args.o, stats, store)
+
+
+def _flatten_artifacts_parallel(
+    args,
+    stats: CopyStats,
+    store: ObjectStore | None,
+    scans: dict[Path, PatternMatcher],
+):
+    """Flattens artifacts, extracting archives concurrently.
+
+    Each archive is extracted on its own thread into a staging directory next
+    to the output directory (on the same file system, but outside of the
+    output). Artifacts are then merged into the output in command line order
+    (archives by renaming their staged entries), so that conflicts resolve
+    exactly as in serial mode: the last artifact wins. Staging directories
+    left behind by an interrupted run are removed first.
+    """
+    output_path: Path = args.o
+    artifact_paths: list[Path] = args.artifact
+    start_time = time.perf_counter()
+    output_path.mkdir(parents=True, exist_ok=True)
+    staging_parent = output_path.absolute().parent
+    staging_prefix = f".{output_path.name}.flatten-"
+    with os.scandir(staging_parent) as it:
+        stale_paths = [
+            entry.path
+            for entry in it
+            if entry.name.startswith(staging_prefix)
+            and entry.is_dir(follow_symlinks=False)
+        ]
+    for stale_path in stale_paths:
+        shutil.rmtree(stale_path)
+
+    def stage_archive(staging_path: Path, artifact_path: Path) -> CopyStats:
+        archive_stats = CopyStats()
+        _flatten_archive_file(args, artifact_path, staging_path, archive_stats, store)
+        return archive_stats
+
+    with tempfile.TemporaryDirectory(
+        prefix=staging_prefix, dir=staging_parent
+    ) as staging_root, ThreadPoolExecutor(
+        max_workers=args.jobs, thread_name_prefix="flatten"
+    ) as executor:
+        staged: dict[int, tuple[Path, Future]] = {}
+        for i, artifact_path in enumerate(artifact_paths):
+            if not artifact_path.is_dir():
+                staging_path = Path(staging_root) / str(i)
+                staged[i] = (
+                    staging_path,
+                    executor.submit(stage_archive, staging_path, artifact_path),
+                )
+        try:
+            for i, artifact_path in enumerate(artifact_paths):
+                if artifact_path.is_dir():
+                    _flatten_artifact_dir(args, artifact_path, stats, store, scans)
                     continue
-                pm.add_basedir(source_dir)
-            pm.copy_to(destdir=output_path, verbose=args.verbose, remove_dest=False)
+                staging_path, future = staged[i]
+                stats.add(future.result())
+                if staging_path.exists():
+                    _merge_staged_tree(staging_path, output_path)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    stats.elapsed = time.perf_counter() - start_time
+
+
+def _merge_staged_tree(staging_path: Path, output_path: Path):
+    """Moves the contents of `staging_path` into `output_path`.
+
+    Entries replace what is in the way as extracting them in place would:
+    directories merge with existing directories, while files, symlinks and
+    directories replace existing files and symlinks.
+    """
+    with os.scandir(staging_path) as it:
+        entries = list(it)
+    for entry in entries:
+        dest_path = os.path.join(output_path, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            try:
+                st = os.lstat(dest_path)
+            except FileNotFoundError:
+                os.rename(entry.path, dest_path)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                _merge_staged_tree(entry.path, dest_path)
+                continue
+            os.unlink(dest_path)
+            os.rename(entry.path, dest_path)
         else:
-            # Process as an archive file.
-            with tarfile.TarFile.open(artifact_path, mode="r:xz") as tf:
-                # Read manifest first.
-                manifest_member = tf.next()
-                if (
-                    manifest_member is None
-                    or manifest_member.name != "artifact_manifest.txt"
+            os.replace(entry.path, dest_path)
+
+
+def _scan_artifact_dir(artifact_path: Path) -> PatternMatcher:
+    """Scans the base directories of an exploded artifact dir, flattened."""
+    pm = PatternMatcher()
+    manifest_path: Path = artifact_path / "artifact_manifest.txt"
+    relpaths = manifest_path.read_text().splitlines()
+    for relpath in relpaths:
+        if not relpath:
+            continue
+        source_dir = artifact_path / relpath
+        if not source_dir.exists():
+            continue
+        pm.add_basedir(source_dir)
+    return pm
+
+
+def _flatten_artifact_dir(
+    args,
+    artifact_path: Path,
+    stats: CopyStats,
+    store: ObjectStore | None,
+    scans: dict[Path, PatternMatcher],
+):
+    # Process an exploded artifact dir.
+    pm = scans.get(artifact_path) or _scan_artifact_dir(artifact_path)
+    pm.copy_to(
+        destdir=args.o,
+        verbose=args.verbose,
+        remove_dest=False,
+        jobs=args.jobs,
+        stats=stats,
+        store=store,
+    )
+
+
+def _flatten_archive_file(
+    args,
+    artifact_path: Path,
+    output_path: Path,
+    stats: CopyStats,
+    store: ObjectStore | None,
+):
+    start_time = time.perf_counter()
+    with open_compressed_reader(artifact_path) as archive_file, tarfile.TarFile.open(
+        fileobj=archive_file, mode="r:"
+    ) as tf:
+        _flatten_archive(args, artifact_path, tf, output_path, stats, store)
+    stats.elapsed += time.perf_counter() - start_time
+
+
+# Archive members are extracted in chunks of this size, bounding memory use
+# regardless of member size.
+_EXTRACT_CHUNK_SIZE = 1 << 20
+
+
+def _flatten_archive(
+    args,
+    artifact_path: Path,
+    tf: tarfile.TarFile,
+    output_path: Path,
+    stats: CopyStats,
+    store: ObjectStore | None,
+    *,
+    header: tuple[ManifestPrefixes, ArtifactIndex | None, tarfile.TarInfo | None]
+    | None = None,
+    skip_members: set[str] = frozenset(),
+):
+    """Extracts the members of an archive into `output_path`.
+
+    `header` is the result of `read_archive_header` if the caller already read
+    it. Members named in `skip_members` are not extracted.
+    """
+    if header is None:
+        header = read_archive_header(artifact_path, tf)
+        check_not_delta(artifact_path, header[1])
+    prefixes, index, member = header
+    if args.skip_identical and index is None:
+        raise IOError(
+            f"Artifact archive {artifact_path} has no index: cannot use --skip-identical"
+        )
+    made_dirs: set[Path] = set()
+    # Iterate over all remaining members.
+    while member:
+        member_name = member.name
+        index_entry = None
+        if index is not None:
+            index_entry = index.entries.pop(member_name, None)
+            if index_entry is None:
+                raise IOError(
+                    f"Extracting tar artifact archive, encountered file not in index: {member}"
+                )
+        if member_name in skip_members:
+            member = tf.next()
+            continue
+        scoped_path = prefixes.scope(member_name)
+        if scoped_path is None:
+            raise IOError(
+                f"Extracting tar artifact archive, encountered file not in manifest: {member}"
+            )
+        link_target_path = None
+        if member.islnk():
+            link_target_path = _link_target_path(output_path, member, prefixes)
+        _extract_member(
+            tf,
+            member,
+            output_path / PurePosixPath(scoped_path),
+            index_entry,
+            index,
+            link_target_path=link_target_path,
+            skip_identical=args.skip_identical,
+            made_dirs=made_dirs,
+            stats=stats,
+            store=store,
+        )
+        member = tf.next()
+    if index is not None and index.entries:
+        missing = ", ".join(list(index.entries.keys())[:10])
+        raise IOError(
+            f"Artifact archive {artifact_path} is missing {len(index.entries)} "
+            f"indexed members: {missing}"
+        )
+
+
+def _flatten_delta(args, stats: CopyStats, store: ObjectStore | None):
+    """Flattens a delta archive on top of its base archive.
+
+    Base members that the delta changes or removes are skipped, then the
+    delta's members are extracted over the result.
+    """
+    start_time = time.perf_counter()
+    with open_compressed_reader(args.delta) as delta_file, tarfile.TarFile.open(
+        fileobj=delta_file, mode="r:"
+    ) as delta_tf:
+        delta_header = read_archive_header(args.delta, delta_tf)
+        delta_prefixes, delta_index, _ = delta_header
+        if delta_index is None or delta_index.delta_base is None:
+            raise IOError(f"Artifact archive {args.delta} is not a delta archive")
+        with open_compressed_reader(args.base) as base_file, tarfile.TarFile.open(
+            fileobj=base_file, mode="r:"
+        ) as base_tf:
+            base_header = read_archive_header(args.base, base_tf)
+            base_prefixes, base_index, _ = base_header
+            if base_index is None or base_index.fingerprint() != delta_index.delta_base:
+                raise IOError(
+                    f"Artifact archive {args.base} is not the base of delta "
+                    f"archive {args.delta}"
+                )
+            unchanged = _delta_unchanged_paths(
+                base_prefixes, base_index, delta_prefixes, delta_index
+            )
+            skip_members = set(base_index.entries.keys()) - unchanged
+            # Unchanged hardlinks need their targets, even if the delta then
+            # replaces them.
+            for path in unchanged:
+                entry = base_index.entries[path]
+                if entry.type == ENTRY_HARDLINK:
+                    skip_members.discard(entry.target)
+            _flatten_archive(
+                args,
+                args.base,
+                base_tf,
+                args.o,
+                stats,
+                store,
+                header=base_header,
+                skip_members=skip_members,
+            )
+        # Unchanged entries were extracted from the base.
+        for path in unchanged:
+            del delta_index.entries[path]
+        _flatten_archive(
+            args, args.delta, delta_tf, args.o, stats, store, header=delta_header
+        )
+    stats.elapsed += time.perf_counter() - start_time
+
+
+def _link_target_path(
+    output_path: Path, member: tarfile.TarInfo, prefixes: ManifestPrefixes
+) -> Path:
+    """Returns where the target of a hardlink member was extracted to."""
+    scoped_path = prefixes.scope(member.linkname)
+    if scoped_path is None:
+        raise IOError(
+            f"Extracting tar artifact archive, encountered hardlink to a file "
+            f"not in manifest: {member}"
+        )
+    return output_path / PurePosixPath(scoped_path)
+
+
+def _extract_member(
+    tf: tarfile.TarFile,
+    member: tarfile.TarInfo,
+    dest_path: Path,
+    index_entry: IndexEntry | None,
+    index: ArtifactIndex | None,
+    *,
+    link_target_path: Path | None = None,
+    skip_identical: bool,
+    made_dirs: set[Path],
+    stats: CopyStats,
+    store: ObjectStore | None = None,
+):
+    """Extracts one archive member to `dest_path`.
+
+    File contents are copied in fixed size chunks, so memory use does not
+    depend on member sizes. Directories created (or found to exist) are added
+    to `made_dirs` so that each is only created once. If `store` is given,
+    files are added to it (unless their indexed digest already is) and
+    hardlinked from it.
+
+    Hardlink members are linked to (or, failing that, copied from)
+    `link_target_path`, where their target was previously extracted.
+    """
+    if (
+        skip_identical
+        and member.isfile()
+        and _is_identical_file(dest_path, index_entry, index)
+    ):
+        stats.unchanged += 1
+        return
+    if member.isdir():
+        if dest_path not in made_dirs:
+            _remove_non_dir(dest_path)
+            dest_path.mkdir(parents=True, exist_ok=True)
+            made_dirs.add(dest_path)
+        stats.dirs += 1
+        return
+    parent_path = dest_path.parent
+    if parent_path not in made_dirs:
+        parent_path.mkdir(parents=True, exist_ok=True)
+        made_dirs.add(parent_path)
+    _remove_non_dir(dest_path)
+    if member.isfile() and store is not None:
+        _extract_to_store(tf, member, dest_path, index_entry, index, store, stats)
+    elif member.isfile():
+        exec_mask = member.mode & 0o111
+        with tf.extractfile(member) as member_file:
+            with open(
+                dest_path,
+                "wb",
+            ) as out_file:
+                if index_entry is None:
+                    shutil.copyfileobj(member_file, out_file, _EXTRACT_CHUNK_SIZE)
+                else:
+                    _copy_verified(member_file, out_file, index_entry, index)
+                st = os.fstat(out_file.fileno())
+                new_mode = st.st_mode | exec_mask
+                os.fchmod(out_file.fileno(), new_mode)
+        stats.extracted += 1
+        stats.copied_bytes += member.size
+    elif member.issym():
+        if index_entry is not None and (
+            index_entry.type != ENTRY_SYMLINK or index_entry.target != member.linkname
+        ):
+            raise IOError(
+                f"Archive member {member.name} does not match its index entry"
+            )
+        dest_path.symlink_to(member.linkname)
+        stats.symlinks += 1
+    elif member.islnk():
+        if index_entry is not None and (
+            index_entry.type != ENTRY_HARDLINK or index_entry.target != member.linkname
+        ):
+            raise IOError(
+                f"Archive member {member.name} does not match its index entry"
+            )
+        if link_target_path is None or not link_target_path.is_file():
+            raise IOError(
+                f"Cannot extract hardlink {member.name}: its target "
+                f"{member.linkname} was not extracted"
+            )
+        try:
+            os.link(link_target_path, dest_path)
+        except OSError:
+            shutil.copy2(link_target_path, dest_path)
+        stats.hardlinks += 1
+    else:
+        raise IOError(f"Unhandled tar member: {member}")
+
+
+def _extract_to_store(
+    tf: tarfile.TarFile,
+    member: tarfile.TarInfo,
+    dest_path: Path,
+    index_entry: IndexEntry | None,
+    index: ArtifactIndex | None,
+    store: ObjectStore,
+    stats: CopyStats,
+):
+    digest = None
+    if index_entry is not None:
+        if index_entry.type != ENTRY_FILE and index_entry.type != ENTRY_HARDLINK:
+            raise IOError(
+                f"Archive member {index_entry.path} is not a file in the index"
+            )
+        if index.hash_algorithm == store.hash_algorithm:
+            digest = index_entry.digest
+    with tf.extractfile(member) as member_file:
+        object_path, is_new = store.add_stream(
+            member_file, member.mode, digest=digest, size=member.size
+        )
+    method = store.link(object_path, os.fspath(dest_path))
+    if is_new:
+        stats.stored += 1
+        stats.copied_bytes += member.size
+    elif method == "hardlink":
+        stats.hardlinks += 1
+    else:
+        stats.copy_methods[method] += 1
+        stats.copied_bytes += member.size
+
+
+def _remove_non_dir(path: Path):
+    """Removes a file or symlink (but not a directory) at `path` if present."""
+    try:
+        st = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(path)
+
+
+def _copy_verified(member_file, out_file, index_entry, index: ArtifactIndex):
+    """Copies a member's contents, checking them against its index entry."""
+    if index_entry.type != ENTRY_FILE and index_entry.type != ENTRY_HARDLINK:
+        raise IOError(f"Archive member {index_entry.path} is not a file in the index")
+    digest = hashlib.new(index.hash_algorithm)
+    size = 0
+    while chunk := member_file.read(_EXTRACT_CHUNK_SIZE):
+        digest.update(chunk)
+        out_file.write(chunk)
+        size += len(chunk)
+    if size != index_entry.size or digest.hexdigest() != index_entry.digest:
+        raise IOError(
+            f"Archive member {index_entry.path} does not match its index entry "
+            f"(corrupt archive?)"
+        )
+
+
+def _is_identical_file(dest_path: Path, index_entry, index: ArtifactIndex) -> bool:
+    """Whether `dest_path` is a regular file with the indexed contents and mode."""
+    try:
+        st = os.lstat(dest_path)
+    except FileNotFoundError:
+        return False
+    if (
+        not stat.S_ISREG(st.st_mode)
+        or st.st_size != index_entry.size
+        or (st.st_mode & 0o111) != (index_entry.mode & 0o111)
+    ):
+        return False
+    digest = calculate_hash(dest_path, index.hash_algorithm)
+    return digest.hexdigest() == index_entry.digest
+
+
+def do_artifact_extract(args):
+    archive_path: Path = args.archive
+    predicate = MatchPredicate(args.include or [], args.exclude or [])
+    seek_index_path = args.seek_index or seek_index_path_for(archive_path)
+    stats = CopyStats()
+    start_time = time.perf_counter()
+    if seek_index_path.exists():
+        seek_index = SeekIndex.load(seek_index_path)
+        seek_index.check_archive(archive_path)
+        _extract_seekable(args, seek_index, predicate, stats)
+    else:
+        _extract_streaming(args, predicate, stats)
+    stats.elapsed += time.perf_counter() - start_time
+    if args.stats:
+        stats.report("artifact-extract")
+
+
+def _extract_streaming(args, predicate: MatchPredicate, stats: CopyStats):
+    """Extracts by reading through the whole archive (no seek index).
+
+    A selected hardlink may follow a target that is not selected. The contents
+    of such a target are extracted under the name of one of its hardlinks,
+    which the others are then linked to. The index lists these targets up
+    front. Archives without an index are read a second time if the first pass
+    came across any.
+    """
+    archive_path: Path = args.archive
+    extracted: dict[str, Path] = {}
+    made_dirs: set[Path] = set()
+    link_names: dict[str, str] | None = None
+    for pass_number in range(2):
+        with open_compressed_reader(archive_path) as archive_file, tarfile.TarFile.open(
+            fileobj=archive_file, mode="r:"
+        ) as tf:
+            prefixes, index, member = read_archive_header(archive_path, tf)
+            check_not_delta(archive_path, index)
+            if link_names is None:
+                link_names = _unselected_link_targets(prefixes, index, predicate)
+            defer_links = index is None and pass_number == 0
+            deferred = False
+            while member:
+                link_name = link_names.get(member.name)
+                if member.name in extracted or link_name in extracted:
+                    # Extracted on the first pass.
+                    pass
+                elif (
+                    defer_links
+                    and member.islnk()
+                    and member.linkname not in extracted
+                    and _is_selected(prefixes, predicate, member.name)
                 ):
+                    link_names.setdefault(member.linkname, member.name)
+                    deferred = True
+                else:
+                    _extract_matching_member(
+                        args,
+                        tf,
+                        member,
+                        prefixes,
+                        index,
+                        predicate,
+                        stats,
+                        extracted,
+                        made_dirs,
+                        link_name=link_name,
+                    )
+                member = tf.next()
+        if not deferred:
+            break
+
+
+def _unselected_link_targets(
+    prefixes: ManifestPrefixes, index: ArtifactIndex | None, predicate: MatchPredicate
+) -> dict[str, str]:
+    """Maps indexed hardlink targets that are not selected (but one of their
+    hardlinks is) to the name of such a hardlink."""
+    link_names: dict[str, str] = {}
+    if index is None:
+        return link_names
+    for entry in index.entries.values():
+        if (
+            entry.type == ENTRY_HARDLINK
+            and entry.target not in link_names
+            and _is_selected(prefixes, predicate, entry.path)
+            and not _is_selected(prefixes, predicate, entry.target)
+        ):
+            link_names[entry.target] = entry.path
+    return link_names
+
+
+def _is_selected(
+    prefixes: ManifestPrefixes, predicate: MatchPredicate, member_name: str
+) -> bool:
+    scoped_path = prefixes.scope(member_name)
+    return scoped_path is not None and predicate.matches(scoped_path, None)
+
+
+def _extract_seekable(
+    args, seek_index: SeekIndex, predicate: MatchPredicate, stats: CopyStats
+):
+    archive_path: Path = args.archive
+    with _SeekableArchiveReader(archive_path, seek_index) as archive_reader:
+        # The manifest and index are the first members.
+        with tarfile.TarFile(fileobj=archive_reader.open_at(0)) as tf:
+            prefixes, index, _ = read_archive_header(archive_path, tf)
+            check_not_delta(archive_path, index)
+        member_starts = {name: start for name, start, _ in seek_index.members}
+        extracted: dict[str, Path] = {}
+        made_dirs: set[Path] = set()
+        for name, start, _ in seek_index.members:
+            if name in ("artifact_manifest.txt", ARTIFACT_INDEX_NAME):
+                continue
+            scoped_path = prefixes.scope(name)
+            if scoped_path is None or not predicate.matches(scoped_path, None):
+                continue
+            with tarfile.TarFile(fileobj=archive_reader.open_at(start)) as tf:
+                member = tf.firstmember
+                if member is None or member.name != name:
                     raise IOError(
-                        f"Artifact archive {artifact_path} must have artifact_manifest.txt as its first member"
+                        f"Seek index for {archive_path} does not match the "
+                        f"archive (expected member {name} at offset {start})"
+                    )
+                if not member.islnk() or member.linkname in extracted:
+                    _extract_matching_member(
+                        args,
+                        tf,
+                        member,
+                        prefixes,
+                        index,
+                        predicate,
+                        stats,
+                        extracted,
+                        made_dirs,
                     )
-                with tf.extractfile(manifest_member) as mf_file:
-                    relpaths = mf_file.read().decode().splitlines()
-                # Iterate over all remaining members.
-                while member := tf.next():
-                    member_name = member.name
-                    # Figure out which relpath prefix it is a part of.
-                    for prefix_relpath in relpaths:
-                        prefix_relpath += "/"
-                        if member_name.startswith(prefix_relpath):
-                            scoped_path = member_name[len(prefix_relpath) :]
-                            dest_path = output_path / PurePosixPath(scoped_path)
-                            if dest_path.is_symlink() or (
-                                dest_path.exists() and not dest_path.is_dir()
-                            ):
-                                os.unlink(dest_path)
-                            dest_path.parent.mkdir(parents=True, exist_ok=True)
-                            if member.isfile():
-                                exec_mask = member.mode & 0o111
-                                with tf.extractfile(member) as member_file:
-                                    with open(
-                                        dest_path,
-                                        "wb",
-                                    ) as out_file:
-                                        out_file.write(member_file.read())
-                                        st = os.fstat(out_file.fileno())
-                                        new_mode = st.st_mode | exec_mask
-                                        os.fchmod(out_file.fileno(), new_mode)
-                            elif member.isdir():
-                                dest_path.mkdir(parents=True, exist_ok=True)
-                            elif member.issym():
-                                dest_path.symlink_to(member.linkname)
-                            else:
-                                raise IOError(f"Unhandled tar member: {member}")
-                            break
-                    else:
-                        raise IOError(
-                            f"Extracting tar artifact archive, encountered file not in manifest: {member}"
-                        )
+                    continue
+            # A hardlink to a member that was not selected: extract the
+            # contents of its target under the link's name instead.
+            target_start = member_starts[member.linkname]
+            with tarfile.TarFile(
+                fileobj=archive_reader.open_at(target_start)
+            ) as target_tf:
+                _extract_matching_member(
+                    args,
+                    target_tf,
+                    target_tf.firstmember,
+                    prefixes,
+                    index,
+                    predicate,
+                    stats,
+                    extracted,
+                    made_dirs,
+                    link_name=member.name,
+                )
+
+
+class _SeekableArchiveReader:
+    """Opens decompressing readers at uncompressed offsets of an archive."""
+
+    def __init__(self, archive_path: Path, seek_index: SeekIndex):
+        self.archive_path = archive_path
+        self.seek_index = seek_index
+        self.reader: _ForwardReader | None = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def open_at(self, offset: int) -> "_ForwardReader":
+        """Returns a reader positioned at an uncompressed offset.
+
+        The current reader is reused if that only skips forward within the
+        current block. Otherwise decompression restarts at the block containing
+        the offset.
+        """
+        block_start, compressed_offset = self.seek_index.block_for(offset)
+        reader = self.reader
+        if reader is None or not (block_start <= reader.position <= offset):
+            if reader is not None:
+                reader.close()
+            reader = self.reader = _ForwardReader(
+                open_compressed_reader(
+                    self.archive_path, compressed_offset=compressed_offset
+                ),
+                block_start,
+            )
+        reader.seek(offset)
+        return reader
+
+
+def _extract_matching_member(
+    args,
+    tf: tarfile.TarFile,
+    member: tarfile.TarInfo,
+    prefixes: ManifestPrefixes,
+    index: ArtifactIndex | None,
+    predicate: MatchPredicate,
+    stats: CopyStats,
+    extracted: dict[str, Path],
+    made_dirs: set[Path],
+    *,
+    link_name: str | None = None,
+):
+    """Extracts `member` if its flattened path matches `predicate`.
+
+    Extracted member names are added to `extracted`, with the paths they were
+    extracted to. If `link_name` is given, `member` is the target of that
+    hardlink and was not selected itself, and its contents are extracted under
+    the hardlink's name instead.
+    """
+    name = member.name if link_name is None else link_name
+    scoped_path = prefixes.scope(name)
+    if scoped_path is None:
+        raise IOError(
+            f"Extracting tar artifact archive, encountered file not in manifest: {name}"
+        )
+    if not predicate.matches(scoped_path, None):
+        return
+    index_entry = None
+    if index is not None:
+        index_entry = index.entries.get(name)
+        if index_entry is None:
+            raise IOError(
+                f"Extracting tar artifact archive, encountered file not in index: {name}"
+            )
+    if args.verbose:
+        print(f"extract {scoped_path}", file=sys.stderr)
+    dest_path = args.o / PurePosixPath(scoped_path)
+    extracted[name] = dest_path
+    if link_name is not None:
+        extracted[member.name] = dest_path
+    link_target_path = None
+    if member.islnk():
+        link_target_path = extracted.get(member.linkname)
+    _extract_member(
+        tf,
+        member,
+        dest_path,
+        index_entry,
+        index,
+        link_target_path=link_target_path,
+        skip_identical=False,
+        made_dirs=made_dirs,
+        stats=stats,
+    )
+
+
+class _ForwardReader:
+    """Read-only file object over a decompressing stream that tracks the
+    uncompressed position and supports seeking forward (by reading)."""
+
+    def __init__(self, fileobj: BinaryIO, position: int):
+        self.fileobj = fileobj
+        self.position = position
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence != os.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek from the start or current")
+        if offset < self.position:
+            raise io.UnsupportedOperation("Can only seek forward")
+        while self.position < offset:
+            if not self.read(min(offset - self.position, 1 << 20)):
+                break
+        return self.position
+
+    def close(self):
+        self.fileobj.close()
+
+
+def do_artifact_list(args):
+    with open_compressed_reader(args.archive) as archive_file, tarfile.TarFile.open(
+        fileobj=archive_file, mode="r:"
+    ) as tf:
+        _, index, member = read_archive_header(args.archive, tf)
+        if index is not None:
+            # Only the manifest and index were decompressed.
+            entries = index.entries.values()
+        else:
+            # Older archive: fall back to reading all members.
+            entries = []
+            while member:
+                entries.append(IndexEntry.from_tarinfo(member))
+                member = tf.next()
+    for entry in entries:
+        if args.long:
+            # Formatted like `tar -tv`.
+            size = entry.size if entry.type == ENTRY_FILE else 0
+            line = (
+                f"{entry.filemode()} {size:>12} {entry.digest or '-':<64} {entry.path}"
+            )
+            if entry.type == ENTRY_SYMLINK:
+                line += f" -> {entry.target}"
+            elif entry.type == ENTRY_HARDLINK:
+                line += f" link to {entry.target}"
+            print(line)
+        else:
+            print(entry.path)
+
+
+def _sync_artifact_dirs(
+    args,
+    stats: CopyStats,
+    store: ObjectStore | None,
+    scans: dict[Path, PatternMatcher],
+):
+    # In sync mode, all artifacts are merged into one PatternMatcher so that
+    # conflicting paths resolve (last artifact wins) before anything is
+    # written. Otherwise each conflicting file would be rewritten every time.
+    pm = PatternMatcher()
+    for artifact_path in args.artifact:
+        if not artifact_path.is_dir():
+            raise ValueError(
+                f"artifact-flatten --sync only supports artifact directories: "
+                f"{artifact_path}"
+            )
+        artifact_pm = scans.get(artifact_path) or _scan_artifact_dir(artifact_path)
+        pm.all.update(artifact_pm.all)
+    pm.copy_to(
+        destdir=args.o,
+        verbose=args.verbose,
+        jobs=args.jobs,
+        stats=stats,
+        sync=True,
+        store=store,
+    )
+
+
+def do_artifact_store_gc(args):
+    if not (args.store / "objects").is_dir():
+        raise ValueError(f"Not an object store: {args.store}")
+    store = ObjectStore(args.store)
+    result = store.gc(
+        max_bytes=args.max_size,
+        max_age=args.max_age * 24 * 60 * 60 if args.max_age is not None else None,
+        dry_run=args.dry_run,
+    )
+    print(f"artifact-store-gc: {result}", file=sys.stderr)
+
+
+def _parse_size(value: str) -> int:
+    """Parses a byte count with an optional K, M, G or T (binary) suffix."""
+    multipliers = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    multiplier = multipliers.get(value[-1:].upper())
+    if multiplier is None:
+        return int(value)
+    return int(float(value[:-1]) * multiplier)
 
 
 def _dup_list_or_str(v: list[str] | str) -> list[str]:
@@ -322,6 +1627,145 @@ def main(cl_args: list[str]):
         p.add_argument("--include", nargs="+", help="Recursive glob pattern to include")
         p.add_argument("--exclude", nargs="+", help="Recursive glob pattern to exclude")
         p.add_argument("--verbose", action="store_true", help="Print verbose status")
+        add_scan_args(p)
+
+    def add_scan_args(p: argparse.ArgumentParser):
+        p.add_argument(
+            "--scan-threads",
+            type=int,
+            default=0,
+            help="Scan directory trees with this many threads (default serial)",
+        )
+
+    def add_copy_args(
+        p: argparse.ArgumentParser,
+        jobs_help: str = "Link/copy files with this many threads (default serial)",
+    ):
+        p.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=0,
+            help=jobs_help,
+        )
+        p.add_argument(
+            "--stats", action="store_true", help="Print copy statistics to stderr"
+        )
+
+    def add_sync_arg(p: argparse.ArgumentParser):
+        p.add_argument(
+            "--sync",
+            action="store_true",
+            help="Incrementally update the destination: only changed entries are "
+            "rewritten and entries no longer present are removed",
+        )
+
+    def add_fingerprint_arg(p: argparse.ArgumentParser):
+        p.add_argument(
+            "--fingerprint-file",
+            type=Path,
+            help="File recording a fingerprint of the inputs (scanned file "
+            "metadata and options): if it matches, the outputs are left untouched "
+            "and nothing is done, otherwise it is rewritten after the outputs",
+        )
+
+    def add_store_arg(p: argparse.ArgumentParser):
+        p.add_argument(
+            "--store",
+            type=Path,
+            help="Content-addressed object store directory: files are added to "
+            "it once and hardlinked from it into the output (see "
+            "artifact-store-gc)",
+        )
+
+    def add_archive_write_args(p: argparse.ArgumentParser):
+        p.add_argument(
+            "-o",
+            type=Path,
+            required=True,
+            help=f"Output archive name (format selected by suffix: "
+            f"{', '.join(ARCHIVE_FORMATS.keys())})",
+        )
+        p.add_argument(
+            "--hash-file",
+            type=Path,
+            action="append",
+            help="Hash file to write representing the archive contents (can be "
+            "repeated, paired in order with --hash-algorithm)",
+        )
+        p.add_argument(
+            "--hash-algorithm",
+            action="append",
+            help="Hash algorithm for the corresponding --hash-file (default sha256)",
+        )
+        p.add_argument(
+            "--compression-threads",
+            type=int,
+            default=default_threads(),
+            help="Number of threads to compress with (default all cores, up to "
+            f"{DEFAULT_MAX_THREADS})",
+        )
+        p.add_argument(
+            "--compression-level",
+            type=int,
+            help=f"Compression level (default {DEFAULT_COMPRESSION_LEVELS['xz']} "
+            f"for xz, {DEFAULT_COMPRESSION_LEVELS['zst']} for zst)",
+        )
+        p.add_argument(
+            "--reproducible",
+            action="store_true",
+            help="Write byte-identical archives for identical inputs: members are "
+            "sorted and their mtime (SOURCE_DATE_EPOCH or 0), owner and permissions "
+            "are normalized. Files that share an inode are stored in full, so that "
+            "the archive does not depend on how its inputs are linked (see "
+            "--dedup-content)",
+        )
+        p.add_argument(
+            "--dedup-content",
+            action="store_true",
+            help="Store files with the same contents and permissions as an earlier "
+            "file as hardlinks to it (files sharing an inode always are, except "
+            "with --reproducible)",
+        )
+        p.add_argument(
+            "--member-order",
+            choices=["scan", "path", "kind"],
+            help="Order of archive members after the manifest and index: directory "
+            "scan order, sorted by path, or grouped by kind (headers, cmake, text, "
+            "ELF, static libraries, code objects) and extension so that similar "
+            "data compresses together (default path with --reproducible, "
+            "otherwise scan)",
+        )
+        p.add_argument(
+            "--seekable",
+            action="store_true",
+            help="Compress in small independent blocks and write a seek index next "
+            f"to the archive ({{archive}}{SEEK_INDEX_SUFFIX}) for artifact-extract",
+        )
+        p.add_argument(
+            "--seek-index",
+            type=Path,
+            help="Path of the seek index to write with --seekable",
+        )
+        p.add_argument(
+            "--block-size",
+            type=int,
+            help="Uncompressed size of independently compressed blocks (default "
+            f"{DEFAULT_SEEKABLE_BLOCK_SIZE} with --seekable)",
+        )
+        p.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=default_threads(),
+            help="Number of threads to hash files for the archive index with "
+            f"(default all cores, up to {DEFAULT_MAX_THREADS})",
+        )
+        p.add_argument(
+            "--stats",
+            action="store_true",
+            help="Print compression statistics to stderr",
+        )
 
     def pattern_matcher_action(
         action: Callable[[argparse.Namespace, PatternMatcher], None]
@@ -331,8 +1775,6 @@ def main(cl_args: list[str]):
                 # base dir is CWD
                 args.basedir = [Path.cwd()]
             pm = PatternMatcher(args.include or [], args.exclude or [])
-            for basedir in args.basedir:
-                pm.add_basedir(basedir)
             action(args, pm)
 
         return run_action
@@ -353,6 +1795,9 @@ def main(cl_args: list[str]):
         action=argparse.BooleanOptionalAction,
         help="Remove the destination directory before copying",
     )
+    add_copy_args(copy_p)
+    add_sync_arg(copy_p)
+    add_fingerprint_arg(copy_p)
     add_pattern_matcher_args(copy_p)
     copy_p.set_defaults(func=pattern_matcher_action(do_copy))
 
@@ -366,7 +1811,11 @@ def main(cl_args: list[str]):
         "artifact", help="Merge artifacts based on a descriptor"
     )
     artifact_p.add_argument(
-        "--output-dir", type=Path, required=True, help="Artifact output directory"
+        "--output-dir",
+        type=Path,
+        required=True,
+        action="append",
+        help="Artifact output directory (one per --component, in order)",
     )
     artifact_p.add_argument(
         "--root-dir",
@@ -381,8 +1830,16 @@ def main(cl_args: list[str]):
         help="TOML file describing the artifact",
     )
     artifact_p.add_argument(
-        "--component", required=True, help="Component within the descriptor to merge"
+        "--component",
+        required=True,
+        action="append",
+        help="Component within the descriptor to merge (may be repeated)",
     )
+    add_scan_args(artifact_p)
+    add_copy_args(artifact_p)
+    add_sync_arg(artifact_p)
+    add_fingerprint_arg(artifact_p)
+    add_store_arg(artifact_p)
     artifact_p.set_defaults(func=do_artifact)
 
     # 'artifact-archive' command
@@ -393,18 +1850,27 @@ def main(cl_args: list[str]):
     artifact_archive_p.add_argument(
         "artifact", nargs="+", type=Path, help="Artifact directory"
     )
-    artifact_archive_p.add_argument(
-        "-o", type=Path, required=True, help="Output archive name"
+    add_archive_write_args(artifact_archive_p)
+    artifact_archive_p.set_defaults(func=do_artifact_archive, base=None)
+
+    # 'artifact-delta' command
+    artifact_delta_p = sub_p.add_parser(
+        "artifact-delta",
+        help="Creates a delta archive of an artifact directory against a base "
+        "archive: it only stores entries that were added or changed (apply "
+        "it with artifact-flatten --base --delta)",
     )
-    artifact_archive_p.add_argument(
-        "--hash-file",
+    artifact_delta_p.add_argument(
+        "base",
         type=Path,
-        help="Hash file to write representing the archive contents",
+        help="Base artifact archive (must have an index, and should be "
+        "created with the same --reproducible and --dedup-content options)",
     )
-    artifact_archive_p.add_argument(
-        "--hash-algorithm", default="sha256", help="Hash algorithm"
+    artifact_delta_p.add_argument(
+        "artifact", nargs=1, type=Path, help="New artifact directory"
     )
-    artifact_archive_p.set_defaults(func=do_artifact_archive)
+    add_archive_write_args(artifact_delta_p)
+    artifact_delta_p.set_defaults(func=do_artifact_archive)
 
     # 'artifact-flatten' command
     artifact_flatten_p = sub_p.add_parser(
@@ -412,7 +1878,21 @@ def main(cl_args: list[str]):
         help="Flattens one or more artifact directories into one output directory",
     )
     artifact_flatten_p.add_argument(
-        "artifact", nargs="+", type=Path, help="Artifact directory"
+        "artifact",
+        nargs="*",
+        type=Path,
+        help="Artifact directory or archive (.tar.xz or .tar.zst)",
+    )
+    artifact_flatten_p.add_argument(
+        "--base",
+        type=Path,
+        help="Base archive of the --delta archive",
+    )
+    artifact_flatten_p.add_argument(
+        "--delta",
+        type=Path,
+        help="Delta archive (from artifact-delta) to flatten on top of --base, "
+        "instead of flattening artifacts",
     )
     artifact_flatten_p.add_argument(
         "-o", type=Path, required=True, help="Output archive name"
@@ -420,8 +1900,97 @@ def main(cl_args: list[str]):
     artifact_flatten_p.add_argument(
         "--verbose", action="store_true", help="Print verbose status"
     )
+    artifact_flatten_p.add_argument(
+        "--skip-identical",
+        action="store_true",
+        help="Do not rewrite files from archives that already exist in the "
+        "output with the same mode and content hash (requires an archive index)",
+    )
+    add_copy_args(
+        artifact_flatten_p,
+        jobs_help="Link/copy files with this many threads and extract up to this "
+        "many archives concurrently (default serial; archives are extracted "
+        "serially with --skip-identical)",
+    )
+    add_sync_arg(artifact_flatten_p)
+    add_fingerprint_arg(artifact_flatten_p)
+    add_store_arg(artifact_flatten_p)
     artifact_flatten_p.set_defaults(func=_do_artifact_flatten)
 
+    # 'artifact-extract' command
+    artifact_extract_p = sub_p.add_parser(
+        "artifact-extract",
+        help="Extracts files matching patterns from an artifact archive into a "
+        "flattened output directory (random access with a seek index)",
+    )
+    artifact_extract_p.add_argument("archive", type=Path, help="Artifact archive")
+    artifact_extract_p.add_argument(
+        "-o", type=Path, required=True, help="Output directory"
+    )
+    artifact_extract_p.add_argument(
+        "--include",
+        nargs="+",
+        help="Recursive glob pattern of flattened paths to include",
+    )
+    artifact_extract_p.add_argument(
+        "--exclude",
+        nargs="+",
+        help="Recursive glob pattern of flattened paths to exclude",
+    )
+    artifact_extract_p.add_argument(
+        "--seek-index",
+        type=Path,
+        help=f"Seek index of the archive (default {{archive}}{SEEK_INDEX_SUFFIX} "
+        "if it exists)",
+    )
+    artifact_extract_p.add_argument(
+        "--verbose", action="store_true", help="Print verbose status"
+    )
+    artifact_extract_p.add_argument(
+        "--stats", action="store_true", help="Print extraction statistics to stderr"
+    )
+    artifact_extract_p.set_defaults(func=do_artifact_extract)
+
+    # 'artifact-list' command
+    artifact_list_p = sub_p.add_parser(
+        "artifact-list",
+        help="Lists the contents of an artifact archive (only the index is "
+        "decompressed if the archive has one)",
+    )
+    artifact_list_p.add_argument("archive", type=Path, help="Artifact archive")
+    artifact_list_p.add_argument(
+        "-l",
+        "--long",
+        action="store_true",
+        help="Show mode, size, content hash and symlink target",
+    )
+    artifact_list_p.set_defaults(func=do_artifact_list)
+
+    # 'artifact-store-gc' command
+    artifact_store_gc_p = sub_p.add_parser(
+        "artifact-store-gc",
+        help="Evicts least recently used objects from an object store (objects "
+        "still linked from an output tree are kept)",
+    )
+    artifact_store_gc_p.add_argument("store", type=Path, help="Object store directory")
+    artifact_store_gc_p.add_argument(
+        "--max-size",
+        type=_parse_size,
+        help="Evict least recently used objects until the store is at most this "
+        "size (bytes, or with a K, M, G or T suffix)",
+    )
+    artifact_store_gc_p.add_argument(
+        "--max-age",
+        type=float,
+        help="Evict objects unused for more than this many days",
+    )
+    artifact_store_gc_p.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report what would be evicted",
+    )
+    artifact_store_gc_p.set_defaults(func=do_artifact_store_gc)
+
     args = p.parse_args(cl_args)
     args.func(args)
 
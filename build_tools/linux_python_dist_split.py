@@ -139,47 +139,45 @@ should be fine and allows builds to run reproducibly on non-GPU systems.
 
 import argparse
 import functools
-import magic
-import re
 import os
 from pathlib import Path
 import shutil
 import subprocess
 import sys
 
+from _therock_utils.artifact_archive import ArchiveEntry
 from _therock_utils.artifacts import ArtifactCatalog, ArtifactName
+from _therock_utils.binary_type import classify_binary
 from _therock_utils.exe_stub_gen import generate_exe_link_stub
 from _therock_utils.pattern_match import MatchPredicate, PatternMatcher
-
-MAGIC_AR_MATCH = re.compile("ar archive")
-MAGIC_EXECUTABLE_MATCH = re.compile("ELF[^,]+executable,")
-MAGIC_SO_MATCH = re.compile("ELF[^,]+shared object,")
+from _therock_utils.tree_index import TreeEntry
 
 
 def run(args: argparse.Namespace):
-    artifacts = ArtifactCatalog(args.artifact_dir)
-    target_families = artifacts.all_target_families
-
-    core_path = args.dest_dir / f"rocm_sdk_core{args.version_suffix}"
-    libraries_path = args.dest_dir / f"rocm_sdk_libraries{args.version_suffix}"
-    devel_path = args.dest_dir / f"rocm_sdk_devel{args.version_suffix}"
-
-    # Where things go is a waterfall: each package we populate removes files
-    # from consideration. Anything that is left goes in the devel package.
-    # Relative path to materialized abs path.
-    materialized_paths: dict[str, Path] = {}
-    populate_core_package(args, core_path, artifacts, materialized_paths)
-
-    # Emit libraries, one per artifact family that we have
-    for target_family in target_families:
-        libraries_path = (
-            args.dest_dir / f"rocm_sdk_libraries_{target_family}{args.version_suffix}"
-        )
-        populate_libraries_package(
-            args, target_family, libraries_path, artifacts, materialized_paths
-        )
+    with ArtifactCatalog(args.artifact_dir) as artifacts:
+        target_families = artifacts.all_target_families
+
+        core_path = args.dest_dir / f"rocm_sdk_core{args.version_suffix}"
+        libraries_path = args.dest_dir / f"rocm_sdk_libraries{args.version_suffix}"
+        devel_path = args.dest_dir / f"rocm_sdk_devel{args.version_suffix}"
+
+        # Where things go is a waterfall: each package we populate removes files
+        # from consideration. Anything that is left goes in the devel package.
+        # Relative path to materialized abs path.
+        materialized_paths: dict[str, Path] = {}
+        populate_core_package(args, core_path, artifacts, materialized_paths)
+
+        # Emit libraries, one per artifact family that we have
+        for target_family in target_families:
+            libraries_path = (
+                args.dest_dir
+                / f"rocm_sdk_libraries_{target_family}{args.version_suffix}"
+            )
+            populate_libraries_package(
+                args, target_family, libraries_path, artifacts, materialized_paths
+            )
 
-    populate_devel_package(args, devel_path, artifacts, materialized_paths)
+        populate_devel_package(args, devel_path, artifacts, materialized_paths)
 
 
 def core_artifact_filter(an: ArtifactName) -> bool:
@@ -229,9 +227,7 @@ def populate_core_package(
     materialized_paths: dict[str, Path],
 ):
     # Setup.
-    our_artifacts = ArtifactCatalog(
-        all_artifacts.artifact_dir, filter=core_artifact_filter
-    )
+    our_artifacts = all_artifacts.filtered(core_artifact_filter)
     our_artifacts.pm.predicate = MatchPredicate(
         # TODO: The base package is shoving CMake redirects into lib.
         excludes=["**/cmake/**"],
@@ -253,9 +249,8 @@ def populate_libraries_package(
     materialized_paths: dict[str, Path],
 ):
     # Setup.
-    our_artifacts = ArtifactCatalog(
-        all_artifacts.artifact_dir,
-        filter=functools.partial(libraries_artifact_filter, target_family),
+    our_artifacts = all_artifacts.filtered(
+        functools.partial(libraries_artifact_filter, target_family)
     )
     print(f"::: Populating libraries package {target_family} {package_path}")
     for an in our_artifacts.artifact_names:
@@ -278,6 +273,7 @@ def populate_devel_package(
     if package_path.exists():
         shutil.rmtree(package_path)
     package_path.mkdir(parents=True, exist_ok=True)
+    extracted = ExtractedFiles()
     for relpath, dir_entry in all_artifacts.pm.matches():
         dest_path = package_path / relpath
         materialize_devel_file(
@@ -285,10 +281,85 @@ def populate_devel_package(
             dest_path,
             dir_entry,
             materialized_paths,
+            extracted,
             root_output_dir=package_path.parent,
         )
 
 
+# Artifacts read in place from archives have no file system path, so the
+# contents of their files are extracted directly to where they are
+# materialized, in archive order (so that each archive is only decompressed
+# once per package), and classified there. Files that turn out not to belong
+# there (i.e. shared libraries not named by their SONAME) are kept until the
+# end of the package, since a symlink may yet materialize them under its name.
+class ExtractedFiles:
+    def __init__(self):
+        # Extracted path of each relative path, and its inverse.
+        self.paths: dict[str, Path] = {}
+        self.relpaths: dict[Path, str] = {}
+        # Extracted paths that were not materialized (yet).
+        self.unused: set[Path] = set()
+
+    def extract(self, relpath: str, src_entry: ArchiveEntry, dest_path: Path) -> Path:
+        """Extracts a file entry to `dest_path` (initially unused)."""
+        if dest_path.exists(follow_symlinks=False):
+            dest_path.unlink()
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        # Hardlink targets precede the hardlink, so they were usually
+        # extracted already.
+        content_path = None
+        target = src_entry.hardlink_target()
+        if target is not None:
+            content_path = self.paths.get(target.relpath)
+        if content_path is not None:
+            shutil.copy2(content_path, dest_path)
+        else:
+            src_entry.extract_to(dest_path)
+        self._record(relpath, dest_path)
+        self.unused.add(dest_path)
+        return dest_path
+
+    def path_of(
+        self,
+        src_entry: ArchiveEntry,
+        aside_path: Path,
+        materialized_paths: dict[str, Path],
+    ) -> Path:
+        """Returns a path holding the contents of a (resolved) file entry.
+
+        Entries that were not extracted or materialized yet (i.e. symlink
+        targets excluded from the package) are extracted to `aside_path`.
+        """
+        path = self.paths.get(src_entry.relpath) or materialized_paths.get(
+            src_entry.relpath
+        )
+        if path is None:
+            path = self.extract(src_entry.relpath, src_entry, aside_path)
+        return path
+
+    def materialize(self, src_path: Path, dest_path: Path):
+        """Copies `src_path` to `dest_path`, or moves it if it is an unused
+        extracted file."""
+        if src_path == dest_path:
+            self.unused.discard(dest_path)
+        elif src_path in self.unused:
+            os.replace(src_path, dest_path)
+            self.unused.remove(src_path)
+            self._record(self.relpaths.pop(src_path), dest_path)
+        else:
+            shutil.copy2(src_path, dest_path)
+
+    def remove_unused(self):
+        for path in self.unused:
+            path.unlink()
+            del self.paths[self.relpaths.pop(path)]
+        self.unused.clear()
+
+    def _record(self, relpath: str, path: Path):
+        self.paths[relpath] = path
+        self.relpaths[path] = relpath
+
+
 # Materializes a "library" package. This is used for everything except the
 # devel package, which is a catch-all of everything.
 def materialize_lib_package(
@@ -296,26 +367,36 @@ def materialize_lib_package(
     package_dest_dir: Path,
     materialized_paths: dict[str, Path],
 ):
-    # Handle each file.
+    # Handle each file. Symlinks are handled last, when everything they can
+    # point to has been extracted.
+    extracted = ExtractedFiles()
+    symlinks: list[tuple[str, Path, os.DirEntry[str] | ArchiveEntry]] = []
     for relpath, dir_entry in pm.matches():
         if relpath in materialized_paths:
             continue
-        file_type = get_file_type(dir_entry)
         dest_path = package_dest_dir / relpath
-        if file_type == "symlink":
-            maybe_materialize_lib_symlink(
-                relpath, dest_path, dir_entry, materialized_paths
-            )
+        if dir_entry.is_symlink():
+            symlinks.append((relpath, dest_path, dir_entry))
         else:
-            materialize_lib_file(relpath, dest_path, dir_entry, materialized_paths)
+            materialize_lib_file(
+                relpath, dest_path, dir_entry, materialized_paths, extracted
+            )
+    for relpath, dest_path, dir_entry in symlinks:
+        if relpath in materialized_paths:
+            continue
+        maybe_materialize_lib_symlink(
+            relpath, dest_path, dir_entry, materialized_paths, extracted
+        )
+    extracted.remove_unused()
 
 
 # Maybe materializes a symlink destined for a library package.
 def maybe_materialize_lib_symlink(
     relpath: str,
     dest_path: Path,
-    src_entry: os.DirEntry[str],
+    src_entry: os.DirEntry[str] | ArchiveEntry,
     materialized_paths: dict[str, Path],
+    extracted: ExtractedFiles,
 ):
     # Symlink handling is annoying because we can't have any :(
     # Here is what we do based on what it points to:
@@ -323,46 +404,68 @@ def maybe_materialize_lib_symlink(
     #   2. Shared library symlink: materialize if the symlink name is the SONAME
     #   3. Executable: Build a little executable launcher in place of the symlink (TODO)
     #   4. Copy it into place (this should work for scripts and such -- hopefully).
-    resolved_path = Path(src_entry.path).resolve()
-    # Case 1.
-    if resolved_path.is_dir() or not resolved_path.exists():
-        return
+    if isinstance(src_entry, ArchiveEntry):
+        resolved_entry = src_entry.resolve()
+        # Case 1.
+        if resolved_entry is None or resolved_entry.is_dir():
+            return
+        resolved_path = extracted.path_of(
+            resolved_entry,
+            dest_path.with_name(f".{dest_path.name}.target"),
+            materialized_paths,
+        )
+    else:
+        resolved_path = Path(src_entry.path).resolve()
+        # Case 1.
+        if resolved_path.is_dir() or not resolved_path.exists():
+            return
 
     target_file_type = get_file_type(resolved_path)
 
     # Case 2: Shared library.
     if target_file_type == "so":
-        maybe_materialize_lib_so(relpath, dest_path, src_entry, materialized_paths)
+        maybe_materialize_lib_so(
+            relpath, dest_path, src_entry, resolved_path, materialized_paths, extracted
+        )
         return
 
     # Case 3: Executable.
     if target_file_type == "exe":
         # Compile a standalone executable that dynamically emulates the symlink.
-        link_target = os.readlink(src_entry.path)
+        link_target = read_link(src_entry)
         generate_exe_link_stub(dest_path, link_target)
         materialized_paths[relpath] = dest_path
         return
 
     # Case 4: Copy.
-    materialize_file(relpath, dest_path, src_entry, materialized_paths)
+    materialize_file(
+        relpath,
+        dest_path,
+        src_entry,
+        materialized_paths,
+        extracted,
+        src_path=resolved_path,
+    )
 
 
-# Materializes a shared library iff its name == the SONAME. This will resolve
-# symlinks.
+# Materializes a shared library iff its name == the SONAME. `resolved_path`
+# holds the contents that symlinks resolve to.
 def maybe_materialize_lib_so(
     relpath: str,
     dest_path: Path,
-    src_entry: os.DirEntry[str],
+    src_entry: os.DirEntry[str] | ArchiveEntry,
+    resolved_path: Path,
     materialized_paths: dict[str, Path],
+    extracted: ExtractedFiles,
 ):
-    soname = get_soname(src_entry.path)
+    soname = get_soname(resolved_path)
     if soname != src_entry.name:
         return
 
     if src_entry.is_symlink():
         # We're just going to "rotate" the symlinks so that the SONAME based
         # one is primary and everything else points to that.
-        link_target = os.readlink(src_entry.path)
+        link_target = read_link(src_entry)
         if not link_target.count("/"):
             # It is just the normal libfoo.so.0 -> libfoo.so.0.1 style thing.
             # Note that this path was materialized to dest_path too.
@@ -370,7 +473,12 @@ def maybe_materialize_lib_so(
             assert link_target_relpath not in materialized_paths
             materialized_paths[link_target_relpath] = dest_path
     materialize_file(
-        relpath, dest_path, src_entry, materialized_paths, resolve_src=True
+        relpath,
+        dest_path,
+        src_entry,
+        materialized_paths,
+        extracted,
+        src_path=resolved_path,
     )
 
 
@@ -380,30 +488,39 @@ def maybe_materialize_lib_so(
 def materialize_lib_file(
     relpath: str,
     dest_path: Path,
-    src_entry: os.DirEntry[str],
+    src_entry: os.DirEntry[str] | ArchiveEntry,
     materialized_paths: dict[str, Path],
+    extracted: ExtractedFiles,
 ):
+    if src_entry.is_dir():
+        materialize_file(relpath, dest_path, src_entry, materialized_paths, extracted)
+        return
+    if isinstance(src_entry, ArchiveEntry):
+        src_path = extracted.extract(relpath, src_entry, dest_path)
+    else:
+        src_path = Path(src_entry.path)
     # Skip shared library without matching SONAME.
-    file_type = get_file_type(src_entry.path)
+    file_type = get_file_type(src_path)
     if file_type == "so":
-        soname = get_soname(src_entry.path)
+        soname = get_soname(src_path)
         if soname != dest_path.name:
             return
-    materialize_file(relpath, dest_path, src_entry, materialized_paths)
+    materialize_file(
+        relpath, dest_path, src_entry, materialized_paths, extracted, src_path=src_path
+    )
 
 
 def materialize_file(
     relpath: str,
     dest_path: Path,
-    src_entry: os.DirEntry[str],
+    src_entry: os.DirEntry[str] | ArchiveEntry,
     materialized_paths: dict[str, Path],
+    extracted: ExtractedFiles,
     *,
-    resolve_src: bool = True,
+    src_path: Path | None = None,
 ):
-    is_symlink = src_entry.is_symlink()
-    src_path = Path(src_entry.path)
-    if resolve_src and is_symlink:
-        src_path = src_path.resolve()
+    """Materializes `src_entry`, whose contents (resolving symlinks) are at
+    `src_path` if given."""
     dest_path.parent.mkdir(parents=True, exist_ok=True)
 
     # If it is a directory entry, just mkdir it.
@@ -412,11 +529,13 @@ def materialize_file(
         return
 
     # It is a regular file of some kind.
-    if dest_path.exists():
+    if src_path is None:
+        src_path = Path(src_entry.path).resolve()
+    if dest_path.exists() and src_path != dest_path:
         os.unlink(dest_path)
     # We have to patch many files, so we do not hard-link: always copy.
-    print(f"  MATERIALIZE: {relpath} (from {src_path})")
-    shutil.copy2(src_path, dest_path)
+    print(f"  MATERIALIZE: {relpath} (from {src_entry_description(src_entry)})")
+    extracted.materialize(src_path, dest_path)
     if relpath in materialized_paths:
         print(f"WARNING: Path already materialized: {relpath}")
     materialized_paths[relpath] = dest_path
@@ -425,8 +544,9 @@ def materialize_file(
 def materialize_devel_file(
     relpath: str,
     dest_path: Path,
-    src_entry: os.DirEntry[str],
+    src_entry: os.DirEntry[str] | ArchiveEntry,
     materialized_paths: dict[str, Path],
+    extracted: ExtractedFiles,
     *,
     root_output_dir: Path,
 ):
@@ -449,21 +569,38 @@ def materialize_devel_file(
     if src_entry.is_symlink():
         if dest_path.exists(follow_symlinks=False):
             dest_path.unlink()
-        target_path = os.readlink(src_entry.path)
+        target_path = read_link(src_entry)
         print(f"LINK: {relpath} (to {target_path})")
         os.symlink(target_path, dest_path)
         return
 
     # Otherwise, no one else has emitted it, so just materialize verbatim.
-    print(f"MATERIALIZE: {relpath} (from {src_entry.path})")
+    print(f"MATERIALIZE: {relpath} (from {src_entry_description(src_entry)})")
+    if isinstance(src_entry, ArchiveEntry):
+        extracted.materialize(
+            extracted.extract(relpath, src_entry, dest_path), dest_path
+        )
+        return
     if dest_path.exists(follow_symlinks=False):
         dest_path.unlink()
     dest_path.parent.mkdir(parents=True, exist_ok=True)
     shutil.copy2(src_entry.path, dest_path)
 
 
-def get_file_type(dir_entry: os.DirEntry[str] | Path) -> str:
-    if isinstance(dir_entry, os.DirEntry):
+def read_link(src_entry: os.DirEntry[str] | ArchiveEntry) -> str:
+    if isinstance(src_entry, ArchiveEntry):
+        return src_entry.link_target
+    return os.readlink(src_entry.path)
+
+
+def src_entry_description(src_entry: os.DirEntry[str] | ArchiveEntry) -> str:
+    if isinstance(src_entry, ArchiveEntry):
+        return str(src_entry)
+    return src_entry.path
+
+
+def get_file_type(dir_entry: os.DirEntry[str] | TreeEntry | Path) -> str:
+    if isinstance(dir_entry, (os.DirEntry, TreeEntry)):
         path = Path(dir_entry.path)
     else:
         path = Path(dir_entry)
@@ -478,14 +615,8 @@ def get_file_type(dir_entry: os.DirEntry[str] | Path) -> str:
     path = str(path)
     if path.endswith(".txt") or path.endswith(".h") or path.endswith(".hpp"):
         return "text"
-    desc = magic.from_file(path)
-    if MAGIC_EXECUTABLE_MATCH.search(desc):
-        return "exe"
-    if MAGIC_SO_MATCH.search(desc):
-        return "so"
-    if MAGIC_AR_MATCH.search(desc):
-        return "ar"
-    return "other"
+    # One of "exe", "so", "ar" or "other".
+    return classify_binary(path)
 
 
 def get_soname(sofile: Path) -> str:
@@ -502,7 +633,8 @@ def main(argv: list[str]):
         "--artifact-dir",
         type=Path,
         required=True,
-        help="Source artifacts/ dir from a build",
+        help="Source artifacts/ dir from a build (artifact directories and/or "
+        "artifact archives)",
     )
     p.add_argument(
         "--dest-dir",
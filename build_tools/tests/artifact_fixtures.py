@@ -0,0 +1,55 @@
+"""Helpers shared by tests that build artifact directories and archives."""
+
+from pathlib import Path
+import shlex
+import subprocess
+import sys
+
+FILESET_TOOL = Path(__file__).parent.parent / "fileset_tool.py"
+
+
+def exec(args: list[str | Path], cwd: Path = FILESET_TOOL.parent):
+    args = [str(arg) for arg in args]
+    print(f"++ Exec [{cwd}]$ {shlex.join(args)}")
+    subprocess.check_call(args, cwd=str(cwd), stdin=subprocess.DEVNULL)
+
+
+def write_text(p: Path, text: str):
+    p.parent.mkdir(exist_ok=True, parents=True)
+    p.write_text(text)
+
+
+def make_artifact_dir(
+    artifact_dir: Path, files: dict[str, str], symlinks: dict[str, str] = {}
+) -> Path:
+    """Makes an artifact dir with a single `stage` manifest relpath holding
+    `files` (relpath to contents) and `symlinks` (relpath to target)."""
+    write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+    for relpath, contents in files.items():
+        write_text(artifact_dir / "stage" / relpath, contents)
+    for relpath, target in symlinks.items():
+        link_path = artifact_dir / "stage" / relpath
+        link_path.parent.mkdir(parents=True, exist_ok=True)
+        link_path.symlink_to(target)
+    return artifact_dir
+
+
+def make_archive(
+    artifact_dir: Path, archive: Path | None = None, *extra_args: str
+) -> Path:
+    """Archives an artifact dir (by default to `{artifact_dir}.tar.xz`) with
+    `fileset_tool.py artifact-archive` and `extra_args`."""
+    if archive is None:
+        archive = artifact_dir.with_name(artifact_dir.name + ".tar.xz")
+    exec(
+        [
+            sys.executable,
+            FILESET_TOOL,
+            "artifact-archive",
+            artifact_dir,
+            "-o",
+            archive,
+            *extra_args,
+        ]
+    )
+    return archive
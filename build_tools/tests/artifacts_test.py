@@ -0,0 +1,299 @@
+import functools
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+from _therock_utils.artifact_archive import ArchiveEntry, ArtifactArchive
+from _therock_utils.artifacts import ArtifactCatalog
+from _therock_utils.compression import zstandard
+from _therock_utils.pattern_match import PatternMatcher
+from _therock_utils.tree_index import TreeIndex
+import linux_python_dist_split
+from artifact_fixtures import make_archive, make_artifact_dir, write_text
+
+
+class ArtifactCatalogTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir = Path(self._temp_dir.name)
+        self.artifacts_dir = self.temp_dir / "artifacts"
+        self.artifacts_dir.mkdir()
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def make_dist_artifacts(self):
+        """Makes artifacts as linux_python_dist_split splits them."""
+        for name, files in {
+            "base_lib_generic": {"lib/libbase.so": "base"},
+            "core-hip_dev_generic": {"include/hip.h": "hip"},
+            "core-hip_lib_generic": {"lib/libamdhip64.so": "hip"},
+            "blas_lib_gfx110X": {"lib/librocblas.so": "gfx110X"},
+            "blas_lib_gfx120X": {"lib/librocblas.so": "gfx120X"},
+            "blas_dev_gfx110X": {"include/rocblas.h": "blas"},
+        }.items():
+            make_artifact_dir(self.artifacts_dir / name, files)
+
+    # Verifies that the views linux_python_dist_split makes for its packages
+    # match catalogs constructed with the same filters, while each base
+    # directory is only scanned once across all of them.
+    def testDistSplitViews(self):
+        self.make_dist_artifacts()
+        filters = [
+            linux_python_dist_split.core_artifact_filter,
+            functools.partial(
+                linux_python_dist_split.libraries_artifact_filter, "gfx110X"
+            ),
+            functools.partial(
+                linux_python_dist_split.libraries_artifact_filter, "gfx120X"
+            ),
+        ]
+        catalog = ArtifactCatalog(self.artifacts_dir)
+        self.assertEqual(catalog.all_target_families, {"gfx110X", "gfx120X"})
+        add_basedir = PatternMatcher.add_basedir
+        with mock.patch.object(
+            PatternMatcher, "add_basedir", autospec=True, side_effect=add_basedir
+        ) as add_basedir_mock:
+            views = [catalog.filtered(filter) for filter in filters]
+            view_trees = [sorted(view.pm.all.keys()) for view in views]
+            catalog.pm
+        self.assertEqual(add_basedir_mock.call_count, len(catalog.artifact_basedirs))
+
+        for filter, view, view_tree in zip(filters, views, view_trees):
+            expected = ArtifactCatalog(self.artifacts_dir, filter=filter)
+            self.assertEqual(
+                [
+                    (an.name, an.component, basedir)
+                    for an, basedir in view.artifact_basedirs
+                ],
+                [
+                    (an.name, an.component, basedir)
+                    for an, basedir in expected.artifact_basedirs
+                ],
+            )
+            self.assertEqual(view_tree, sorted(expected.pm.all.keys()))
+        self.assertEqual(
+            view_trees[0],
+            ["include", "include/hip.h", "lib", "lib/libamdhip64.so", "lib/libbase.so"],
+        )
+        self.assertEqual(view_trees[1], ["lib", "lib/librocblas.so"])
+        self.assertEqual(
+            Path(views[2].pm.all["lib/librocblas.so"].path).read_text(), "gfx120X"
+        )
+
+    def make_artifacts(self):
+        # foo is present both as a directory and as an archive.
+        make_artifact_dir(
+            self.artifacts_dir / "foo_lib_generic", {"lib/libfoo.so": "foo dir"}
+        )
+        make_artifact_dir(
+            self.temp_dir / "foo_archive", {"lib/libfoo.so": "foo archive"}
+        )
+        make_archive(
+            self.temp_dir / "foo_archive",
+            self.artifacts_dir / "foo_lib_generic.tar.xz",
+        )
+        make_artifact_dir(
+            self.temp_dir / "bar_archive",
+            {"lib/libbar.so": "bar", "include/bar.h": "header"},
+        )
+        make_archive(
+            self.temp_dir / "bar_archive",
+            self.artifacts_dir / "bar_dev_gfx110X.tar.xz",
+        )
+
+    # Verifies a catalog over directory and archive artifacts, where the
+    # directory of an artifact wins over its archive.
+    def testMixedSources(self):
+        self.make_artifacts()
+        with ArtifactCatalog(self.artifacts_dir) as catalog:
+            self.assertEqual(
+                sorted(
+                    (an.name, an.component, an.target_family)
+                    for an in catalog.artifact_names
+                ),
+                [("bar", "dev", "gfx110X"), ("foo", "lib", "generic")],
+            )
+            self.assertEqual(catalog.all_target_families, {"gfx110X"})
+            self.assertEqual(
+                {an.name: basedir for an, basedir in catalog.artifact_basedirs},
+                {
+                    "bar": self.artifacts_dir / "bar_dev_gfx110X.tar.xz",
+                    "foo": self.artifacts_dir / "foo_lib_generic" / "stage",
+                },
+            )
+
+            entries = catalog.pm.all
+            self.assertEqual(
+                sorted(
+                    relpath for relpath, entry in entries.items() if not entry.is_dir()
+                ),
+                ["include/bar.h", "lib/libbar.so", "lib/libfoo.so"],
+            )
+            self.assertNotIsInstance(entries["lib/libfoo.so"], ArchiveEntry)
+            self.assertEqual(Path(entries["lib/libfoo.so"].path).read_text(), "foo dir")
+            self.assertIsInstance(entries["lib/libbar.so"], ArchiveEntry)
+            with entries["lib/libbar.so"].open() as f:
+                self.assertEqual(f.read(), b"bar")
+            # Archive entries are held in the same kind of index as scanned
+            # ones, and the last artifact with a path wins.
+            self.assertIsInstance(entries, TreeIndex)
+            self.assertIsInstance(entries["lib"], ArchiveEntry)
+            self.assertTrue(entries["lib"].is_dir())
+            archive = entries["lib/libbar.so"].archive
+            self.assertIsNotNone(archive._tf)
+        # Closing the catalog closes its archives.
+        self.assertIsNone(archive._tf)
+
+    # Verifies that views made with `filtered` only see their artifacts and
+    # share base directory scans with the catalog (in either order of use).
+    def testFilteredSharesScans(self):
+        self.make_artifacts()
+        catalog = ArtifactCatalog(self.artifacts_dir)
+        bar_view = catalog.filtered(lambda an: an.name == "bar")
+        foo_view = catalog.filtered(lambda an: an.name == "foo")
+        self.assertEqual(
+            [an.name for an in bar_view.artifact_names],
+            ["bar"],
+        )
+        self.assertEqual(
+            sorted(bar_view.pm.all.keys()),
+            ["include", "include/bar.h", "lib", "lib/libbar.so"],
+        )
+        self.assertEqual(sorted(foo_view.pm.all.keys()), ["lib", "lib/libfoo.so"])
+        scans = dict(catalog._scans)
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(len(catalog.pm.all), 5)
+        # The catalog reused the scans made through its views.
+        self.assertEqual(catalog._scans, scans)
+        for basedir, scan in scans.items():
+            self.assertIs(catalog._scans[basedir], scan)
+        self.assertIs(foo_view._scans, catalog._scans)
+
+
+class ArtifactArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir = Path(self._temp_dir.name)
+        self.artifact_dir = self.temp_dir / "artifact_dir"
+        self.contents = {
+            f"lib/lib{i}.so": f"lib {i} {os.urandom(8192).hex()}" for i in range(8)
+        }
+        make_artifact_dir(self.artifact_dir, self.contents)
+        stage_dir = self.artifact_dir / "stage"
+        # An inode hardlink and a copy that --dedup-content stores as one.
+        os.link(stage_dir / "lib" / "lib0.so", stage_dir / "lib" / "lib0_link.so")
+        write_text(stage_dir / "share" / "copy.so", self.contents["lib/lib0.so"])
+        (stage_dir / "lib" / "lib0.so.1").symlink_to("lib0.so")
+        (stage_dir / "bin").mkdir()
+        (stage_dir / "bin" / "chain").symlink_to("../lib/lib0.so.1")
+        (stage_dir / "bin" / "dangling").symlink_to("missing")
+        (stage_dir / "bin" / "absolute").symlink_to("/etc/hostname")
+        (stage_dir / "bin" / "outside").symlink_to("../../other")
+        # Symlinks through a symlinked directory.
+        (stage_dir / "lib64").symlink_to("lib")
+        (stage_dir / "bin" / "via_dir").symlink_to("../lib64/lib0.so.1")
+        (stage_dir / "bin" / "via_file").symlink_to("../lib/lib0.so/x")
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def suffixes(self) -> list[str]:
+        suffixes = [".tar.xz"]
+        if zstandard is not None:
+            suffixes.append(".tar.zst")
+        return suffixes
+
+    def testEntries(self):
+        archive_path = self.temp_dir / "artifact.tar.xz"
+        make_archive(
+            self.artifact_dir,
+            archive_path,
+            "--member-order",
+            "path",
+            "--dedup-content",
+        )
+        with ArtifactArchive(archive_path) as archive:
+            entries = archive.entries
+            lib0 = entries["lib/lib0.so"]
+            self.assertTrue(lib0.is_file())
+            self.assertEqual(lib0.name, "lib0.so")
+            self.assertEqual(lib0.member_name, "stage/lib/lib0.so")
+            self.assertIsNone(lib0.hardlink_target())
+            for relpath in ["lib/lib0_link.so", "share/copy.so"]:
+                with self.subTest(relpath=relpath):
+                    entry = entries[relpath]
+                    self.assertTrue(entry.is_file(follow_symlinks=False))
+                    self.assertIs(entry.hardlink_target(), lib0)
+                    self.assertIs(entry.resolve(), entry)
+                    with entry.open() as f:
+                        self.assertEqual(
+                            f.read().decode(), self.contents["lib/lib0.so"]
+                        )
+
+            self.assertTrue(entries["bin"].is_dir())
+            self.assertEqual(entries["lib/lib0.so.1"].link_target, "lib0.so")
+            self.assertIs(entries["lib/lib0.so.1"].resolve(), lib0)
+            self.assertIs(entries["bin/chain"].resolve(), lib0)
+            self.assertTrue(entries["bin/chain"].is_file())
+            self.assertFalse(entries["bin/chain"].is_file(follow_symlinks=False))
+            self.assertIs(entries["lib64"].resolve(), entries["lib"])
+            self.assertTrue(entries["lib64"].is_dir())
+            self.assertIs(entries["bin/via_dir"].resolve(), lib0)
+            for relpath in [
+                "bin/dangling",
+                "bin/absolute",
+                "bin/outside",
+                "bin/via_file",
+            ]:
+                with self.subTest(relpath=relpath):
+                    entry = entries[relpath]
+                    self.assertTrue(entry.is_symlink())
+                    self.assertIsNone(entry.resolve())
+                    self.assertFalse(entry.is_file())
+                    self.assertFalse(entry.is_dir())
+            with self.assertRaises(IOError):
+                entries["bin"].open()
+            with self.assertRaises(OSError):
+                lib0.link_target
+
+            extracted = self.temp_dir / "extracted.so"
+            entries["share/copy.so"].extract_to(extracted)
+            self.assertEqual(extracted.read_text(), self.contents["lib/lib0.so"])
+
+    # Verifies reading entries in and out of archive order, including
+    # hardlinks, whose contents precede them in the archive.
+    def testOpenOutOfOrder(self):
+        for suffix in self.suffixes():
+            with self.subTest(suffix=suffix):
+                archive_path = self.temp_dir / f"artifact{suffix}"
+                make_archive(self.artifact_dir, archive_path, "--member-order", "path")
+                relpaths = sorted(self.contents.keys())
+                orders = [
+                    relpaths,
+                    list(reversed(relpaths)),
+                    relpaths[::2] + relpaths[1::2] + relpaths[:3],
+                ]
+                with ArtifactArchive(archive_path) as archive:
+                    for order in orders:
+                        for relpath in order:
+                            with archive.entries[relpath].open() as f:
+                                self.assertEqual(
+                                    f.read().decode(), self.contents[relpath]
+                                )
+                    # A hardlink after an entry following its target, then
+                    # its target again.
+                    for relpath in ["lib/lib7.so", "lib/lib0_link.so", "lib/lib0.so"]:
+                        with archive.entries[relpath].open() as f:
+                            self.assertEqual(
+                                f.read().decode(),
+                                self.contents[relpath.replace("_link", "")],
+                            )
+
+
+if __name__ == "__main__":
+    unittest.main()
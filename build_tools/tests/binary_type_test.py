@@ -0,0 +1,141 @@
+import os
+from pathlib import Path
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+from _therock_utils.binary_type import (
+    BINARY_AR,
+    BINARY_EXE,
+    BINARY_OTHER,
+    BINARY_SO,
+    classify_binary,
+)
+
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+DT_SONAME = 14
+DT_FLAGS_1 = 0x6FFFFFFB
+DF_1_NOW = 0x1
+DF_1_PIE = 0x08000000
+
+
+def make_elf(
+    e_type: int,
+    *,
+    interp: bool = False,
+    dynamic: list[tuple[int, int]] | None = None,
+    is_64: bool = True,
+    byte_order: str = "<",
+) -> bytes:
+    """Makes a minimal ELF file: header, program headers and dynamic section."""
+    if is_64:
+        ehdr = struct.Struct(byte_order + "16sHHIQQQIHHHHHH")
+        phdr = struct.Struct(byte_order + "IIQQQQQQ")
+        dyn = struct.Struct(byte_order + "qQ")
+    else:
+        ehdr = struct.Struct(byte_order + "16sHHIIIIIHHHHHH")
+        phdr = struct.Struct(byte_order + "IIIIIIII")
+        dyn = struct.Struct(byte_order + "iI")
+    phdrs = [(PT_LOAD, 0, 0)]
+    if interp:
+        phdrs.append((PT_INTERP, 0, 0))
+    dynamic_data = b""
+    if dynamic is not None:
+        dynamic_data = b"".join(dyn.pack(*d) for d in dynamic + [(0, 0)])
+        phdrs.append((PT_DYNAMIC, 0, len(dynamic_data)))
+    dynamic_offset = ehdr.size + phdr.size * len(phdrs)
+
+    def pack_phdr(p_type: int, p_offset: int, p_filesz: int) -> bytes:
+        if p_type == PT_DYNAMIC:
+            p_offset = dynamic_offset
+        if is_64:
+            return phdr.pack(p_type, 0, p_offset, 0, 0, p_filesz, p_filesz, 0)
+        return phdr.pack(p_type, p_offset, 0, 0, p_filesz, p_filesz, 0, 0)
+
+    ident = b"\x7fELF" + bytes([2 if is_64 else 1, 1 if byte_order == "<" else 2, 1])
+    header = ehdr.pack(
+        ident.ljust(16, b"\0"),
+        e_type,
+        62,
+        1,
+        0,
+        ehdr.size,
+        0,
+        0,
+        ehdr.size,
+        phdr.size,
+        len(phdrs),
+        0,
+        0,
+        0,
+    )
+    return header + b"".join(pack_phdr(*p) for p in phdrs) + dynamic_data
+
+
+class ClassifyBinaryTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir = Path(self._temp_dir.name)
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def classify(self, contents: bytes) -> str:
+        path = self.temp_dir / "file"
+        path.write_bytes(contents)
+        return classify_binary(path)
+
+    def testElfTypes(self):
+        for is_64 in (True, False):
+            for byte_order in ("<", ">"):
+
+                def classify(e_type, **kwargs):
+                    return self.classify(
+                        make_elf(e_type, is_64=is_64, byte_order=byte_order, **kwargs)
+                    )
+
+                with self.subTest(is_64=is_64, byte_order=byte_order):
+                    self.assertEqual(classify(ET_EXEC, interp=True), BINARY_EXE)
+                    self.assertEqual(classify(ET_REL), BINARY_OTHER)
+                    # Shared library.
+                    self.assertEqual(
+                        classify(ET_DYN, dynamic=[(DT_SONAME, 1)]), BINARY_SO
+                    )
+                    # Code object without a dynamic section.
+                    self.assertEqual(classify(ET_DYN), BINARY_SO)
+                    # PIE executables.
+                    self.assertEqual(
+                        classify(ET_DYN, interp=True, dynamic=[(DT_FLAGS_1, DF_1_PIE)]),
+                        BINARY_EXE,
+                    )
+                    self.assertEqual(
+                        classify(ET_DYN, interp=True, dynamic=[]), BINARY_EXE
+                    )
+                    # Runnable shared libraries.
+                    self.assertEqual(
+                        classify(ET_DYN, interp=True, dynamic=[(DT_SONAME, 1)]),
+                        BINARY_SO,
+                    )
+                    self.assertEqual(
+                        classify(ET_DYN, interp=True, dynamic=[(DT_FLAGS_1, DF_1_NOW)]),
+                        BINARY_SO,
+                    )
+
+    def testNonElf(self):
+        self.assertEqual(self.classify(b"!<arch>\nfoo.o/"), BINARY_AR)
+        self.assertEqual(self.classify(b"#!/bin/sh\n"), BINARY_OTHER)
+        self.assertEqual(self.classify(b""), BINARY_OTHER)
+        self.assertEqual(self.classify(b"\x7fELF"), BINARY_OTHER)
+        # Truncated after the identification.
+        self.assertEqual(self.classify(make_elf(ET_DYN)[:20]), BINARY_OTHER)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,32 +1,45 @@
+import errno
 import hashlib
+import io
+import lzma
 import os
 from pathlib import Path
 import platform
-import shlex
+import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
 import unittest
+from unittest import mock
 
 sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+from _therock_utils.artifact_index import ARTIFACT_INDEX_NAME, ArtifactIndex
+from _therock_utils.compression import ParallelXzWriter, zstandard
+from _therock_utils import file_copy
+from _therock_utils.file_copy import COPY_METHODS, copy_file
 from _therock_utils.hash_util import calculate_hash
-
-FILESET_TOOL = Path(__file__).parent.parent / "fileset_tool.py"
+from artifact_fixtures import (
+    FILESET_TOOL,
+    exec,
+    make_archive,
+    make_artifact_dir,
+    write_text,
+)
 
 ARTIFACT_DESCRIPTOR_1 = r"""
 [components.doc."example/stage"]
 """
 
-
-def exec(args: list[str | Path], cwd: Path = FILESET_TOOL.parent):
-    args = [str(arg) for arg in args]
-    print(f"++ Exec [{cwd}]$ {shlex.join(args)}")
-    subprocess.check_call(args, cwd=str(cwd), stdin=subprocess.DEVNULL)
-
-
-def write_text(p: Path, text: str):
-    p.parent.mkdir(exist_ok=True, parents=True)
-    p.write_text(text)
+ARTIFACT_DESCRIPTOR_2 = r"""
+[components.dev."example/stage"]
+[components.doc."example/stage"]
+[components.lib."example/stage"]
+[components.lib."example/other"]
+optional = true
+[components.run."example/stage"]
+include = ["bin/**"]
+"""
 
 
 def is_windows():
@@ -41,6 +54,22 @@ def is_executable(path: Path):
     return bool(os.stat(path).st_mode & 0o111)
 
 
+def snapshot_tree(root: Path) -> dict[str, str]:
+    """Returns the type and contents (or target) of each entry under `root`."""
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = Path(dirpath) / name
+            relpath = path.relative_to(root).as_posix()
+            if path.is_symlink():
+                tree[relpath] = f"-> {os.readlink(path)}"
+            elif path.is_dir():
+                tree[relpath] = "dir"
+            else:
+                tree[relpath] = path.read_text()
+    return tree
+
+
 class FilesetToolTest(unittest.TestCase):
     def setUp(self):
         override_temp = os.getenv("TEST_TMPDIR")
@@ -134,6 +163,8 @@ class FilesetToolTest(unittest.TestCase):
                 artifact_archive,
                 "--hash-file",
                 hash_file,
+                "--compression-threads",
+                "2",
             ]
         )
 
@@ -186,6 +217,1078 @@ class FilesetToolTest(unittest.TestCase):
         if not is_windows():
             self.assertTrue(is_executable(flat2_dir / "share" / "doc" / "executable"))
 
+    # Verifies that producing several components in one invocation gives the
+    # same result as one invocation per component.
+    def testMultiComponentArtifact(self):
+        input_dir = self.temp_dir / "input"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_2)
+        stage_dir = input_dir / "example" / "stage"
+        write_text(stage_dir / "bin" / "tool", "Tool")
+        write_text(stage_dir / "include" / "foo.h", "Header")
+        write_text(stage_dir / "lib" / "libfoo.so.1", "Library")
+        (stage_dir / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+        write_text(stage_dir / "lib" / "cmake" / "foo" / "foo-config.cmake", "")
+        write_text(stage_dir / "share" / "doc" / "README", "Docs")
+        components = ["dev", "doc", "lib", "run"]
+        base_args = [
+            sys.executable,
+            FILESET_TOOL,
+            "artifact",
+            "--descriptor",
+            descriptor_file,
+            "--root-dir",
+            input_dir,
+        ]
+
+        multi_args = list(base_args)
+        for component in components:
+            multi_args.extend(
+                [
+                    "--component",
+                    component,
+                    "--output-dir",
+                    self.temp_dir / "multi" / component,
+                ]
+            )
+        exec(multi_args)
+        for component in components:
+            exec(
+                base_args
+                + [
+                    "--component",
+                    component,
+                    "--output-dir",
+                    self.temp_dir / "single" / component,
+                ]
+            )
+
+        def list_tree(root: Path) -> list[str]:
+            return sorted(str(p.relative_to(root)) for p in root.rglob("*"))
+
+        for component in components:
+            self.assertEqual(
+                list_tree(self.temp_dir / "multi" / component),
+                list_tree(self.temp_dir / "single" / component),
+            )
+        self.assertIn(
+            "example/stage/lib/libfoo.so",
+            list_tree(self.temp_dir / "multi" / "lib"),
+        )
+        self.assertIn(
+            "example/stage/bin/tool",
+            list_tree(self.temp_dir / "multi" / "run"),
+        )
+
+    # Verifies that a parallel copy produces the same tree as a serial copy.
+    def testParallelCopy(self):
+        input_dir = self.temp_dir / "input"
+        for i in range(600):
+            write_text(input_dir / f"dir{i % 7}" / f"file{i}.txt", f"Contents {i}")
+        (input_dir / "dir0" / "link").symlink_to("file0.txt")
+        serial_dir = self.temp_dir / "serial"
+        parallel_dir = self.temp_dir / "parallel"
+        exec([sys.executable, FILESET_TOOL, "copy", serial_dir, input_dir])
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "copy",
+                parallel_dir,
+                input_dir,
+                "-j",
+                "4",
+                "--stats",
+                "--always-copy",
+            ]
+        )
+        serial_files = sorted(
+            str(p.relative_to(serial_dir)) for p in serial_dir.rglob("*")
+        )
+        parallel_files = sorted(
+            str(p.relative_to(parallel_dir)) for p in parallel_dir.rglob("*")
+        )
+        self.assertEqual(serial_files, parallel_files)
+        self.assertEqual(
+            (parallel_dir / "dir4" / "file599.txt").read_text(), "Contents 599"
+        )
+        self.assertEqual(os.readlink(parallel_dir / "dir0" / "link"), "file0.txt")
+
+    # Verifies that `copy --sync` only rewrites changed entries and removes
+    # stale ones.
+    def testSyncCopy(self):
+        input_dir = self.temp_dir / "input"
+        output_dir = self.temp_dir / "output"
+        write_text(input_dir / "unchanged.txt", "Unchanged")
+        write_text(input_dir / "changed.txt", "Original")
+        write_text(input_dir / "removed" / "file.txt", "Removed")
+        (input_dir / "link").symlink_to("unchanged.txt")
+        sync_args = [sys.executable, FILESET_TOOL, "copy", "--sync", "--always-copy"]
+        exec(sync_args + [output_dir, input_dir])
+        unchanged_inode = (output_dir / "unchanged.txt").stat().st_ino
+
+        write_text(input_dir / "changed.txt", "Changed contents")
+        shutil.rmtree(input_dir / "removed")
+        write_text(input_dir / "added.txt", "Added")
+        (input_dir / "link").unlink()
+        (input_dir / "link").symlink_to("added.txt")
+        exec(sync_args + ["--stats", output_dir, input_dir])
+
+        self.assertEqual(
+            sorted(str(p.relative_to(output_dir)) for p in output_dir.rglob("*")),
+            ["added.txt", "changed.txt", "link", "unchanged.txt"],
+        )
+        self.assertEqual((output_dir / "unchanged.txt").stat().st_ino, unchanged_inode)
+        self.assertEqual((output_dir / "changed.txt").read_text(), "Changed contents")
+        self.assertEqual(os.readlink(output_dir / "link"), "added.txt")
+
+    def testCopyFile(self):
+        src_path = self.temp_dir / "src.bin"
+        contents = os.urandom(4096) * 300
+        with open(src_path, "wb") as f:
+            f.write(contents)
+            if not is_windows():
+                fset_executable(f)
+        dest_path = self.temp_dir / "dest.bin"
+        method, size = copy_file(str(src_path), str(dest_path))
+        self.assertIn(method, COPY_METHODS)
+        self.assertEqual(size, len(contents))
+        self.assertEqual(dest_path.read_bytes(), contents)
+        self.assertEqual(src_path.stat().st_mtime, dest_path.stat().st_mtime)
+        if not is_windows():
+            self.assertTrue(is_executable(dest_path))
+
+    # Verifies that copy_file falls back to the next method when an in-kernel
+    # copy fails or copies nothing, and only stops trying a method for a pair
+    # of devices when it is unsupported between them.
+    @unittest.skipUnless(sys.platform.startswith("linux"), "in-kernel copies")
+    def testCopyFileFallbacks(self):
+        src_path = self.temp_dir / "src.bin"
+        contents = os.urandom(4096) * 30
+        src_path.write_bytes(contents)
+        dest_path = self.temp_dir / "dest.bin"
+
+        def failing_copier(errno_value: int):
+            def copier(src_fd: int, dest_fd: int, size: int):
+                raise OSError(errno_value, os.strerror(errno_value))
+
+            return copier
+
+        with mock.patch.object(file_copy, "_unsupported_methods", set()) as unsupported:
+            with mock.patch.dict(
+                file_copy._COPIERS, {"reflink": failing_copier(errno.EPERM)}
+            ), mock.patch.object(file_copy.os, "copy_file_range", return_value=0):
+                method, size = copy_file(str(src_path), str(dest_path))
+            self.assertEqual(method, "sendfile")
+            self.assertEqual(size, len(contents))
+            self.assertEqual(dest_path.read_bytes(), contents)
+            self.assertEqual(unsupported, set())
+
+            with mock.patch.dict(
+                file_copy._COPIERS, {"reflink": failing_copier(errno.EXDEV)}
+            ):
+                copy_file(str(src_path), str(dest_path))
+            self.assertEqual(dest_path.read_bytes(), contents)
+            self.assertEqual({method for method, _, _ in unsupported}, {"reflink"})
+
+    # Verifies that several hash files can be written while archiving.
+    def testArchiveHashes(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        artifact_archive = self.temp_dir / "artifact.tar.xz"
+        write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+        write_text(artifact_dir / "stage" / "file.txt", "Contents")
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                artifact_dir,
+                "-o",
+                artifact_archive,
+                "--hash-file",
+                self.temp_dir / "artifact.tar.xz.sha256sum",
+                "--hash-algorithm",
+                "sha256",
+                "--hash-file",
+                self.temp_dir / "artifact.tar.xz.md5sum",
+                "--hash-algorithm",
+                "md5",
+            ]
+        )
+        for hash_algorithm, suffix in [("sha256", ".sha256sum"), ("md5", ".md5sum")]:
+            expected_digest = calculate_hash(artifact_archive, hash_algorithm)
+            self.assertEqual(
+                (self.temp_dir / f"artifact.tar.xz{suffix}").read_text(),
+                f"{expected_digest.hexdigest()}\n",
+            )
+
+    # Verifies that archives embed a per-file index after the manifest, that
+    # flattening checks it and can skip identical files, and that the archive
+    # can be listed from it.
+    def testArchiveIndex(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        artifact_archive = self.temp_dir / "artifact.tar.xz"
+        flat_dir = self.temp_dir / "flat"
+        write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+        write_text(artifact_dir / "stage" / "bin" / "tool", "Tool")
+        write_text(artifact_dir / "stage" / "lib" / "libfoo.so.1", "Foo")
+        (artifact_dir / "stage" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                artifact_dir,
+                "-o",
+                artifact_archive,
+                "-j",
+                "2",
+            ]
+        )
+        with tarfile.open(artifact_archive) as tf:
+            members = tf.getmembers()
+            self.assertEqual(
+                [m.name for m in members[:2]],
+                ["artifact_manifest.txt", ARTIFACT_INDEX_NAME],
+            )
+            index = ArtifactIndex.from_bytes(tf.extractfile(members[1]).read())
+        self.assertEqual(list(index.entries.keys()), [m.name for m in members[2:]])
+        tool_entry = index.entries["stage/bin/tool"]
+        self.assertEqual(tool_entry.size, 4)
+        self.assertEqual(tool_entry.digest, hashlib.sha256(b"Tool").hexdigest())
+        self.assertEqual(index.entries["stage/lib/libfoo.so"].target, "libfoo.so.1")
+
+        listing = subprocess.check_output(
+            [sys.executable, FILESET_TOOL, "artifact-list", artifact_archive],
+            cwd=FILESET_TOOL.parent,
+        )
+        self.assertEqual(listing.decode().splitlines(), list(index.entries.keys()))
+
+        flatten_args = [
+            sys.executable,
+            FILESET_TOOL,
+            "artifact-flatten",
+            artifact_archive,
+            "-o",
+            flat_dir,
+        ]
+        exec(flatten_args)
+        self.assertEqual((flat_dir / "bin" / "tool").read_text(), "Tool")
+        tool_inode = (flat_dir / "bin" / "tool").stat().st_ino
+        write_text(flat_dir / "lib" / "libfoo.so.1", "Modified")
+        exec(flatten_args + ["--skip-identical"])
+        self.assertEqual((flat_dir / "bin" / "tool").stat().st_ino, tool_inode)
+        self.assertEqual((flat_dir / "lib" / "libfoo.so.1").read_text(), "Foo")
+
+        # A corrupt index entry fails extraction.
+        tool_entry.digest = hashlib.sha256(b"Other").hexdigest()
+        corrupt_archive = self.temp_dir / "corrupt.tar.xz"
+        with tarfile.open(artifact_archive) as tf, tarfile.open(
+            corrupt_archive, "w:xz"
+        ) as out_tf:
+            for member in tf.getmembers():
+                if member.name == ARTIFACT_INDEX_NAME:
+                    contents = index.to_bytes()
+                    member.size = len(contents)
+                    out_tf.addfile(member, io.BytesIO(contents))
+                else:
+                    out_tf.addfile(member, tf.extractfile(member))
+        with self.assertRaises(subprocess.CalledProcessError):
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact-flatten",
+                    corrupt_archive,
+                    "-o",
+                    self.temp_dir / "flat_corrupt",
+                ]
+            )
+
+    # Verifies that artifact-extract pulls files by pattern out of seekable
+    # archives (and falls back to streaming without a seek index).
+    def testSeekableExtract(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+        for i in range(20):
+            write_text(
+                artifact_dir / "stage" / "include" / f"header{i}.h",
+                f"// Header {i} {os.urandom(4096).hex()}",
+            )
+        write_text(artifact_dir / "stage" / "lib" / "libfoo.so.1", "Foo")
+        (artifact_dir / "stage" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+        suffixes = [".tar.xz"]
+        if zstandard is not None:
+            suffixes.append(".tar.zst")
+        for suffix in suffixes:
+            with self.subTest(suffix=suffix):
+                artifact_archive = self.temp_dir / f"artifact{suffix}"
+                seek_index = self.temp_dir / f"artifact{suffix}.seek.json"
+                exec(
+                    [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-archive",
+                        artifact_dir,
+                        "-o",
+                        artifact_archive,
+                        "--seekable",
+                        "--block-size",
+                        "16384",
+                    ]
+                )
+                self.assertTrue(seek_index.exists())
+                for use_seek_index in [True, False]:
+                    extract_dir = self.temp_dir / f"extract{suffix}{use_seek_index}"
+                    extract_args = [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-extract",
+                        artifact_archive,
+                        "-o",
+                        extract_dir,
+                        "--include",
+                        "include/header1*.h",
+                        "lib/**",
+                        "--exclude",
+                        "include/header12.h",
+                    ]
+                    if not use_seek_index:
+                        extract_args += ["--seek-index", self.temp_dir / "missing"]
+                    exec(extract_args)
+                    self.assertEqual(
+                        sorted(
+                            str(p.relative_to(extract_dir))
+                            for p in extract_dir.rglob("*")
+                        ),
+                        sorted(
+                            ["include", "lib", "lib/libfoo.so", "lib/libfoo.so.1"]
+                            + [
+                                f"include/header{i}.h"
+                                for i in [1, 10, 11, 13, 14, 15, 16, 17, 18, 19]
+                            ]
+                        ),
+                    )
+                    self.assertEqual(
+                        (extract_dir / "include" / "header17.h").read_text(),
+                        (artifact_dir / "stage" / "include" / "header17.h").read_text(),
+                    )
+                    self.assertEqual(
+                        os.readlink(extract_dir / "lib" / "libfoo.so"), "libfoo.so.1"
+                    )
+
+    # Verifies that --reproducible archives only depend on file contents,
+    # names and exec bits (not on mtimes, permissions or creation order).
+    def testReproducibleArchive(self):
+        suffixes = [".tar.xz"]
+        if zstandard is not None:
+            suffixes.append(".tar.zst")
+        for i, names in enumerate([["b", "a", "c"], ["c", "a", "b"]]):
+            artifact_dir = self.temp_dir / f"artifact_dir{i}"
+            write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+            for name in names:
+                write_text(artifact_dir / "stage" / name / "file.txt", name)
+                os.chmod(artifact_dir / "stage" / name / "file.txt", 0o664 - i * 0o20)
+                os.utime(artifact_dir / "stage" / name / "file.txt", (i, i))
+            (artifact_dir / "stage" / "link").symlink_to("a/file.txt")
+        for suffix in suffixes:
+            archives = []
+            for i, threads in enumerate(["1", "3"]):
+                archive = self.temp_dir / f"artifact{i}{suffix}"
+                exec(
+                    [
+                        sys.executable,
+                        FILESET_TOOL,
+                        "artifact-archive",
+                        self.temp_dir / f"artifact_dir{i}",
+                        "-o",
+                        archive,
+                        "--reproducible",
+                        "--compression-threads",
+                        threads,
+                    ]
+                )
+                archives.append(archive.read_bytes())
+            self.assertEqual(archives[0], archives[1])
+        with tarfile.open(self.temp_dir / "artifact0.tar.xz") as tf:
+            members = tf.getmembers()
+        self.assertEqual(
+            [m.name for m in members],
+            [
+                "artifact_manifest.txt",
+                ARTIFACT_INDEX_NAME,
+                "stage/a",
+                "stage/a/file.txt",
+                "stage/b",
+                "stage/b/file.txt",
+                "stage/c",
+                "stage/c/file.txt",
+                "stage/link",
+            ],
+        )
+        self.assertEqual(members[3].mode, 0o644)
+        self.assertEqual(members[3].mtime, 0)
+        self.assertEqual((members[3].uid, members[3].uname), (0, ""))
+
+    # Verifies that `--member-order kind` groups members by kind while keeping
+    # the manifest and index first, and that the result still flattens.
+    def testMemberOrderKind(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        artifact_archive = self.temp_dir / "artifact.tar.xz"
+        write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+        stage_dir = artifact_dir / "stage"
+        write_text(stage_dir / "lib" / "libfoo.so.1", "\x7fELF foo")
+        write_text(stage_dir / "lib" / "foo.hsaco", "code object")
+        write_text(stage_dir / "lib" / "cmake" / "foo-config.cmake", "cmake")
+        write_text(stage_dir / "include" / "foo.h", "header")
+        write_text(stage_dir / "bin" / "foo", "\x7fELF tool")
+        write_text(stage_dir / "bin" / "foo.sh", "script")
+        (stage_dir / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                artifact_dir,
+                "-o",
+                artifact_archive,
+                "--member-order",
+                "kind",
+            ]
+        )
+        with tarfile.open(artifact_archive) as tf:
+            names = tf.getnames()
+        self.assertEqual(
+            names,
+            [
+                "artifact_manifest.txt",
+                ARTIFACT_INDEX_NAME,
+                "stage/bin",
+                "stage/include",
+                "stage/lib",
+                "stage/lib/cmake",
+                "stage/lib/libfoo.so",
+                "stage/include/foo.h",
+                "stage/lib/cmake/foo-config.cmake",
+                "stage/bin/foo",
+                "stage/lib/libfoo.so.1",
+                "stage/lib/foo.hsaco",
+                "stage/bin/foo.sh",
+            ],
+        )
+        flat_dir = self.temp_dir / "flat"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                artifact_archive,
+                "-o",
+                flat_dir,
+            ]
+        )
+        self.assertEqual((flat_dir / "lib" / "foo.hsaco").read_text(), "code object")
+
+    # Verifies that files sharing an inode (and with --dedup-content, files
+    # with identical contents) are stored once, as hardlink members, and are
+    # restored by artifact-flatten and artifact-extract.
+    def testHardlinkDedup(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        artifact_archive = self.temp_dir / "artifact.tar.xz"
+        contents = os.urandom(65536).hex()
+        write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+        write_text(artifact_dir / "stage" / "a" / "lib.so", contents)
+        (artifact_dir / "stage" / "b").mkdir()
+        os.link(
+            artifact_dir / "stage" / "a" / "lib.so",
+            artifact_dir / "stage" / "b" / "lib.so",
+        )
+        write_text(artifact_dir / "stage" / "c" / "copy.so", contents)
+        write_text(artifact_dir / "stage" / "c" / "other.so", "Other")
+        for dedup_content in [False, True]:
+            if artifact_archive.exists():
+                artifact_archive.unlink()
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact-archive",
+                    artifact_dir,
+                    "-o",
+                    artifact_archive,
+                    "--member-order",
+                    "path",
+                    "--seekable",
+                ]
+                + (["--dedup-content"] if dedup_content else [])
+            )
+            with tarfile.open(artifact_archive) as tf:
+                links = {m.name: m.linkname for m in tf.getmembers() if m.islnk()}
+            expected_links = {"stage/b/lib.so": "stage/a/lib.so"}
+            if dedup_content:
+                expected_links["stage/c/copy.so"] = "stage/a/lib.so"
+            self.assertEqual(links, expected_links)
+
+        flat_dir = self.temp_dir / "flat"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                artifact_archive,
+                "-o",
+                flat_dir,
+            ]
+        )
+        for relpath in ["a/lib.so", "b/lib.so", "c/copy.so"]:
+            self.assertEqual((flat_dir / relpath).read_text(), contents)
+        self.assertTrue(
+            (flat_dir / "a" / "lib.so").samefile(flat_dir / "c" / "copy.so")
+        )
+
+        # Extracting only a hardlink uses the contents of its target.
+        extract_dir = self.temp_dir / "extract"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-extract",
+                artifact_archive,
+                "-o",
+                extract_dir,
+                "--include",
+                "c/**",
+            ]
+        )
+        self.assertEqual((extract_dir / "c" / "copy.so").read_text(), contents)
+        self.assertFalse((extract_dir / "a").exists())
+
+    # Verifies extracting hardlinks whose target is not selected by streaming
+    # through archives without a seek index, with and without an index.
+    def testStreamingExtractHardlinks(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        artifact_archive = self.temp_dir / "artifact.tar.xz"
+        contents = os.urandom(65536).hex()
+        write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+        write_text(artifact_dir / "stage" / "a" / "lib.so", contents)
+        (artifact_dir / "stage" / "b").mkdir()
+        os.link(
+            artifact_dir / "stage" / "a" / "lib.so",
+            artifact_dir / "stage" / "b" / "lib.so",
+        )
+        write_text(artifact_dir / "stage" / "c" / "copy.so", contents)
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                artifact_dir,
+                "-o",
+                artifact_archive,
+                "--member-order",
+                "path",
+                "--dedup-content",
+            ]
+        )
+
+        unindexed_archive = self.temp_dir / "unindexed.tar.xz"
+        with tarfile.open(unindexed_archive, "w:xz") as tf:
+            tf.add(artifact_dir / "artifact_manifest.txt", "artifact_manifest.txt")
+            for relpath in ["a/lib.so", "b/lib.so", "c/copy.so"]:
+                info = tarfile.TarInfo(f"stage/{relpath}")
+                if relpath == "a/lib.so":
+                    info.size = len(contents)
+                    tf.addfile(info, io.BytesIO(contents.encode()))
+                else:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = "stage/a/lib.so"
+                    tf.addfile(info)
+
+        for archive in [artifact_archive, unindexed_archive]:
+            for i, (selection, expected) in enumerate(
+                [
+                    (["--include", "c/**"], ["c/copy.so"]),
+                    (["--exclude", "a/**"], ["b/lib.so", "c/copy.so"]),
+                ]
+            ):
+                with self.subTest(archive=archive.name, selection=selection):
+                    extract_dir = self.temp_dir / f"extract_{archive.name}_{i}"
+                    exec(
+                        [
+                            sys.executable,
+                            FILESET_TOOL,
+                            "artifact-extract",
+                            archive,
+                            "-o",
+                            extract_dir,
+                        ]
+                        + selection
+                    )
+                    self.assertEqual(
+                        sorted(
+                            str(p.relative_to(extract_dir).as_posix())
+                            for p in extract_dir.rglob("*")
+                            if p.is_file()
+                        ),
+                        expected,
+                    )
+                    for relpath in expected:
+                        self.assertEqual((extract_dir / relpath).read_text(), contents)
+                    self.assertTrue(
+                        (extract_dir / expected[0]).samefile(extract_dir / expected[-1])
+                    )
+
+    # Verifies flattening an archive without an index (as written before
+    # indexes were added), with nested manifest relpaths and a member larger
+    # than the extraction chunk size.
+    def testFlattenUnindexedArchive(self):
+        artifact_archive = self.temp_dir / "artifact.tar.xz"
+        big_contents = os.urandom(3 * 1024 * 1024 + 17)
+        with tarfile.open(artifact_archive, "w:xz") as tf:
+
+            def add(name: str, data: bytes):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+
+            # The first matching relpath of the manifest wins.
+            add("artifact_manifest.txt", b"x/y\nx\n")
+            add("x/y/big.bin", big_contents)
+            add("x/z/small.txt", b"small")
+        flat_dir = self.temp_dir / "flat"
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                artifact_archive,
+                "-o",
+                flat_dir,
+                "--stats",
+            ],
+            stderr=subprocess.STDOUT,
+        ).decode()
+        self.assertEqual((flat_dir / "big.bin").read_bytes(), big_contents)
+        self.assertEqual((flat_dir / "z" / "small.txt").read_text(), "small")
+        self.assertIn("2 extracted", output)
+
+    # Verifies that flattening archives concurrently (-j) gives the same tree as
+    # flattening them serially, including for conflicting paths.
+    @unittest.skipIf(is_windows(), "symlinks")
+    def testParallelFlatten(self):
+        def make_artifact(name: str, files: dict[str, str], symlinks={}):
+            return make_artifact_dir(self.temp_dir / name, files, symlinks)
+
+        artifacts = [
+            make_archive(
+                make_artifact(
+                    "a", {"bin/tool": "a", "lib/libfoo.so": "a", "lib/x/y": "a"}
+                )
+            ),
+            make_artifact("b", {"bin/tool": "b", "share/doc": "b"}),
+            make_archive(
+                make_artifact(
+                    "c",
+                    {"bin/tool": "c", "lib/x/y": "c", "share/doc/README": "c"},
+                    symlinks={"lib/libfoo.so": "libfoo.so.1"},
+                )
+            ),
+            make_archive(make_artifact("d", {"bin/other": "d"})),
+        ]
+
+        # Staging directories left behind by an interrupted run.
+        stale_staging_dir = self.temp_dir / ".flat4.flatten-stale"
+        write_text(stale_staging_dir / "0" / "bin" / "tool", "stale")
+
+        trees = []
+        for jobs in ["0", "4"]:
+            flat_dir = self.temp_dir / f"flat{jobs}"
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact-flatten",
+                    *artifacts,
+                    "-o",
+                    flat_dir,
+                    "-j",
+                    jobs,
+                ]
+            )
+            trees.append(snapshot_tree(flat_dir))
+        self.assertEqual(trees[0], trees[1])
+        self.assertEqual(trees[1]["bin/tool"], "c")
+        self.assertEqual(trees[1]["lib/libfoo.so"], "-> libfoo.so.1")
+        self.assertEqual(trees[1]["lib/x/y"], "c")
+        self.assertEqual(trees[1]["share/doc/README"], "c")
+        self.assertEqual(trees[1]["bin/other"], "d")
+        self.assertEqual(
+            [p.name for p in self.temp_dir.iterdir() if ".flatten-" in p.name], []
+        )
+
+    # Verifies that artifact and artifact-flatten with --store hardlink files
+    # from a shared object store, and that artifact-store-gc only evicts
+    # objects that are no longer linked.
+    @unittest.skipIf(is_windows(), "hardlink counts")
+    def testObjectStore(self):
+        input_dir = self.temp_dir / "input"
+        store_dir = self.temp_dir / "store"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        doc_dir = input_dir / "example" / "stage" / "share" / "doc"
+        write_text(doc_dir / "a.txt", "Same")
+        write_text(doc_dir / "b.txt", "Same")
+        write_text(doc_dir / "c.txt", "Changes")
+        write_text(doc_dir / "empty1.txt", "")
+        write_text(doc_dir / "empty2.txt", "")
+
+        def make_artifact(artifact_dir: Path, *extra_args, use_store: bool = True):
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact",
+                    "--descriptor",
+                    descriptor_file,
+                    "--output-dir",
+                    artifact_dir,
+                    "--root-dir",
+                    input_dir,
+                    "--component",
+                    "doc",
+                ]
+                + (["--store", store_dir] if use_store else [])
+                + list(extra_args)
+            )
+            return artifact_dir / "example" / "stage" / "share" / "doc"
+
+        def store_objects() -> set[str]:
+            return {p.name for p in (store_dir / "objects").glob("*/*")}
+
+        artifact1_doc = make_artifact(self.temp_dir / "artifact1")
+        self.assertTrue((artifact1_doc / "a.txt").samefile(artifact1_doc / "b.txt"))
+        self.assertEqual(len(store_objects()), 3)
+
+        # A rebuild only adds objects for changed files.
+        write_text(doc_dir / "c.txt", "Changed")
+        artifact2_doc = make_artifact(self.temp_dir / "artifact2")
+        self.assertTrue((artifact2_doc / "a.txt").samefile(artifact1_doc / "a.txt"))
+        self.assertFalse((artifact2_doc / "c.txt").samefile(artifact1_doc / "c.txt"))
+        self.assertTrue(
+            (artifact2_doc / "empty1.txt").samefile(artifact2_doc / "empty2.txt")
+        )
+        self.assertEqual(len(store_objects()), 4)
+
+        # Syncing leaves files linked from their objects alone, even where the
+        # object has the modification time of another file with its contents.
+        a_mtime_ns = (doc_dir / "a.txt").stat().st_mtime_ns
+        os.utime(doc_dir / "b.txt", ns=(a_mtime_ns, a_mtime_ns + 1_000_000_000))
+        a_object = next(
+            p
+            for p in (store_dir / "objects").glob("*/*")
+            if p.samefile(artifact2_doc / "a.txt")
+        )
+        a_object_ctime_ns = a_object.stat().st_ctime_ns
+        make_artifact(self.temp_dir / "artifact2", "--sync")
+        self.assertTrue((artifact2_doc / "a.txt").samefile(artifact2_doc / "b.txt"))
+        self.assertEqual(a_object.stat().st_ctime_ns, a_object_ctime_ns)
+
+        # Reproducible archives do not depend on whether the artifact is
+        # linked from the store.
+        plain_doc = make_artifact(self.temp_dir / "plain", use_store=False)
+        self.assertFalse((plain_doc / "a.txt").samefile(plain_doc / "b.txt"))
+        for dedup_args in [[], ["--dedup-content"]]:
+            reproducible_archives = []
+            for artifact_dir in [self.temp_dir / "artifact2", self.temp_dir / "plain"]:
+                archive = self.temp_dir / f"{artifact_dir.name}-reproducible.tar.xz"
+                if archive.exists():
+                    archive.unlink()
+                make_archive(artifact_dir, archive, "--reproducible", *dedup_args)
+                reproducible_archives.append(archive.read_bytes())
+                with tarfile.open(archive) as tf:
+                    links = {m.name for m in tf.getmembers() if m.islnk()}
+                self.assertEqual(
+                    links, {"example/stage/share/doc/b.txt"} if dedup_args else set()
+                )
+            self.assertEqual(reproducible_archives[0], reproducible_archives[1])
+
+        # Flattening an archive links extracted files to existing objects.
+        artifact_archive = make_archive(self.temp_dir / "artifact2")
+        flat_dir = self.temp_dir / "flat"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                artifact_archive,
+                "-o",
+                flat_dir,
+                "--store",
+                store_dir,
+            ]
+        )
+        self.assertTrue(
+            (flat_dir / "share" / "doc" / "c.txt").samefile(artifact2_doc / "c.txt")
+        )
+        self.assertEqual((flat_dir / "share" / "doc" / "c.txt").read_text(), "Changed")
+        self.assertEqual(len(store_objects()), 4)
+
+        # Only the object for the old c.txt is unlinked once artifact1 is gone.
+        shutil.rmtree(self.temp_dir / "artifact1")
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-store-gc",
+                store_dir,
+                "--max-size",
+                "0",
+            ]
+        )
+        self.assertEqual(len(store_objects()), 3)
+        self.assertEqual((artifact2_doc / "a.txt").read_text(), "Same")
+
+    # Verifies that a delta archive only stores added and changed entries, and
+    # that flattening it on top of its base gives the new tree.
+    @unittest.skipIf(is_windows(), "symlinks")
+    def testDeltaArchive(self):
+        base_dir = self.temp_dir / "base"
+        new_dir = self.temp_dir / "new"
+        base_archive = self.temp_dir / "base.tar.xz"
+        delta_archive = self.temp_dir / "delta.tar.xz"
+        for artifact_dir in [base_dir, new_dir]:
+            write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+            write_text(artifact_dir / "stage" / "keep.txt", "Keep")
+            write_text(artifact_dir / "stage" / "lib" / "libfoo.so.1", "Foo")
+            os.link(
+                artifact_dir / "stage" / "lib" / "libfoo.so.1",
+                artifact_dir / "stage" / "lib" / "libfoo.so.1.0",
+            )
+        write_text(base_dir / "stage" / "change.txt", "Old")
+        write_text(base_dir / "stage" / "removed" / "file.txt", "Removed")
+        (base_dir / "stage" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+        write_text(new_dir / "stage" / "change.txt", "New")
+        write_text(new_dir / "stage" / "added.txt", "Added")
+        (new_dir / "stage" / "lib" / "libfoo.so").symlink_to("libfoo.so.1.0")
+
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                base_dir,
+                "-o",
+                base_archive,
+                "--reproducible",
+            ]
+        )
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-delta",
+                base_archive,
+                new_dir,
+                "-o",
+                delta_archive,
+                "--reproducible",
+            ]
+        )
+        with tarfile.open(delta_archive) as tf:
+            member_names = tf.getnames()
+        self.assertEqual(
+            member_names,
+            [
+                "artifact_manifest.txt",
+                ARTIFACT_INDEX_NAME,
+                "stage/added.txt",
+                "stage/change.txt",
+                "stage/lib/libfoo.so",
+            ],
+        )
+
+        flat_dir = self.temp_dir / "flat"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                "--base",
+                base_archive,
+                "--delta",
+                delta_archive,
+                "-o",
+                flat_dir,
+            ]
+        )
+        expected_dir = self.temp_dir / "expected"
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                new_dir,
+                "-o",
+                expected_dir,
+            ]
+        )
+        self.assertEqual(snapshot_tree(flat_dir), snapshot_tree(expected_dir))
+
+        # A delta cannot be flattened on its own.
+        with self.assertRaises(subprocess.CalledProcessError):
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact-flatten",
+                    delta_archive,
+                    "-o",
+                    self.temp_dir / "flat2",
+                ]
+            )
+
+    # Verifies that --fingerprint-file leaves outputs alone while the inputs
+    # are unchanged.
+    def testFingerprintSkipsUnchanged(self):
+        input_dir = self.temp_dir / "input"
+        artifact_dir = self.temp_dir / "artifact"
+        flat_dir = self.temp_dir / "flat"
+        descriptor_file = self.temp_dir / "artifact.toml"
+        write_text(descriptor_file, ARTIFACT_DESCRIPTOR_1)
+        doc_dir = input_dir / "example" / "stage" / "share" / "doc"
+        write_text(doc_dir / "a.txt", "Original")
+        manifest_file = artifact_dir / "artifact_manifest.txt"
+        flat_file = flat_dir / "share" / "doc" / "a.txt"
+
+        def update():
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact",
+                    "--sync",
+                    "--descriptor",
+                    descriptor_file,
+                    "--output-dir",
+                    artifact_dir,
+                    "--root-dir",
+                    input_dir,
+                    "--component",
+                    "doc",
+                    "--fingerprint-file",
+                    self.temp_dir / "artifact.fingerprint",
+                ]
+            )
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact-flatten",
+                    "--sync",
+                    artifact_dir,
+                    "-o",
+                    flat_dir,
+                    "--fingerprint-file",
+                    self.temp_dir / "flat.fingerprint",
+                ]
+            )
+
+        update()
+        self.assertEqual(flat_file.read_text(), "Original")
+        manifest_mtime = manifest_file.stat().st_mtime_ns
+        # A stray output edit is left alone while the inputs are unchanged,
+        # which shows that nothing was rewritten.
+        flat_file.unlink()
+        write_text(flat_file, "Stray")
+        update()
+        self.assertEqual(manifest_file.stat().st_mtime_ns, manifest_mtime)
+        self.assertEqual(flat_file.read_text(), "Stray")
+
+        write_text(doc_dir / "a.txt", "Changed")
+        update()
+        self.assertEqual(flat_file.read_text(), "Changed")
+
+        # Removed outputs are recreated even though the inputs are unchanged.
+        shutil.rmtree(artifact_dir)
+        shutil.rmtree(flat_dir)
+        update()
+        self.assertEqual(flat_file.read_text(), "Changed")
+
+    # Verifies that a .tar.zst archive round trips through artifact-flatten.
+    @unittest.skipIf(zstandard is None, "zstandard module not installed")
+    def testZstdArchive(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        artifact_archive = self.temp_dir / "artifact.tar.zst"
+        flat_dir = self.temp_dir / "flat"
+        write_text(artifact_dir / "artifact_manifest.txt", "stage\n")
+        write_text(artifact_dir / "stage" / "bin" / "tool", "Tool")
+        write_text(artifact_dir / "stage" / "lib" / "libfoo.so.1", "Foo")
+        (artifact_dir / "stage" / "lib" / "libfoo.so").symlink_to("libfoo.so.1")
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-archive",
+                artifact_dir,
+                "-o",
+                artifact_archive,
+                "--stats",
+            ]
+        )
+        self.assertEqual(artifact_archive.read_bytes()[:4], b"\x28\xb5\x2f\xfd")
+        exec(
+            [
+                sys.executable,
+                FILESET_TOOL,
+                "artifact-flatten",
+                artifact_archive,
+                "-o",
+                flat_dir,
+            ]
+        )
+        self.assertEqual((flat_dir / "bin" / "tool").read_text(), "Tool")
+        self.assertEqual((flat_dir / "lib" / "libfoo.so.1").read_text(), "Foo")
+        self.assertEqual(os.readlink(flat_dir / "lib" / "libfoo.so"), "libfoo.so.1")
+
+    def testUnknownArchiveSuffix(self):
+        artifact_dir = self.temp_dir / "artifact_dir"
+        write_text(artifact_dir / "artifact_manifest.txt", "")
+        with self.assertRaises(subprocess.CalledProcessError):
+            exec(
+                [
+                    sys.executable,
+                    FILESET_TOOL,
+                    "artifact-archive",
+                    artifact_dir,
+                    "-o",
+                    self.temp_dir / "artifact.tar.gz",
+                ]
+            )
+        self.assertFalse((self.temp_dir / "artifact.tar.gz").exists())
+
+    # Verifies that block-parallel xz output decompresses as a single stream
+    # and does not depend on the number of threads.
+    def testParallelXzWriter(self):
+        contents = b"".join(
+            f"line {i} {os.urandom(8).hex()}\n".encode() for i in range(20000)
+        )
+        outputs = []
+        for threads in [1, 4]:
+            out = io.BytesIO()
+            with ParallelXzWriter(out, threads=threads, block_size=65536) as xz:
+                xz.write(contents[:1000])
+                xz.write(contents[1000:])
+            self.assertGreater(xz.block_count, 1)
+            self.assertEqual(xz.uncompressed_bytes, len(contents))
+            outputs.append(out.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(lzma.decompress(outputs[0]), contents)
+
+        # An empty stream is still a valid xz file.
+        out = io.BytesIO()
+        ParallelXzWriter(out, threads=2).close()
+        self.assertEqual(lzma.decompress(out.getvalue()), b"")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,304 @@
+import itertools
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.fspath(Path(__file__).parent.parent))
+from _therock_utils.pattern_match import (
+    MatchPredicate,
+    PatternMatcher,
+    RecursiveGlobPattern,
+)
+from _therock_utils.tree_index import TreeEntry, TreeIndex
+from fileset_tool import ComponentDefaults
+
+SAMPLE_PATHS = [
+    "",
+    "bin",
+    "bin/amdclang",
+    "bin/.hidden",
+    "include",
+    "include/hip/hip_runtime.h",
+    "lib",
+    "lib/libfoo.a",
+    "lib/libfoo.so",
+    "lib/libfoo.so.1",
+    "lib/libfoo.so.1.2",
+    "lib/libfoo.so.dbg",
+    "lib/.so",
+    "lib/cmake",
+    "lib/cmake/foo/fooConfig.cmake",
+    "lib/llvm/lib/clang/19/include/stddef.h",
+    "lib/pkgconfig/foo.pc",
+    "lib/rocblas/library/TensileLibrary.dat",
+    "share/doc",
+    "share/doc/README",
+    "share/docs/README",
+    "share/modulefiles/rocm",
+    "foo.dll",
+    "foo.dylib",
+    "foo.dylib.1",
+    "a/b",
+    "a/x/b",
+    "a/x/y/b",
+    "ab",
+    "a/bc",
+]
+
+EXTRA_GLOBS = [
+    "bin/**",
+    "bin/*",
+    "lib/libfoo.so",
+    "lib/*/library/*.dat",
+    "a/**/b",
+    "**/share/doc/**",
+    "lib/libfoo.so.?",
+    "**",
+    "*",
+]
+
+
+class PatternMatchTest(unittest.TestCase):
+    def assertSameAsPerPattern(self, predicate: MatchPredicate):
+        for path in SAMPLE_PATHS:
+            self.assertEqual(
+                predicate.matches(path, None),
+                predicate.matches_per_pattern(path, None),
+                msg=f"Mismatch for {path!r}",
+            )
+
+    def testComponentDefaults(self):
+        for name, defaults in ComponentDefaults.ALL.items():
+            with self.subTest(component=name):
+                self.assertSameAsPerPattern(
+                    MatchPredicate(defaults.includes, defaults.excludes)
+                )
+
+    def testGlobShapes(self):
+        for glob in EXTRA_GLOBS:
+            p = RecursiveGlobPattern(glob)
+            for path in SAMPLE_PATHS:
+                expected = p.matches(path, None)
+                actual = MatchPredicate(includes=[glob]).matches(path, None)
+                self.assertEqual(expected, actual, msg=f"{glob} vs {path!r}")
+
+    def testCombinations(self):
+        for includes, excludes, force_includes in itertools.product(
+            [[], EXTRA_GLOBS[:3], EXTRA_GLOBS[3:]],
+            [[], ["**/*.so"], EXTRA_GLOBS[4:6]],
+            [[], ["lib/libfoo.so.1"]],
+        ):
+            self.assertSameAsPerPattern(
+                MatchPredicate(includes, excludes, force_includes)
+            )
+
+    def testVerifyMode(self):
+        predicate = MatchPredicate(["**/*.so"], verify=True)
+        self.assertTrue(predicate.matches("lib/libfoo.so", None))
+        # Corrupt the compiled form and make sure verification notices.
+        predicate.include_set.suffixes = (".a",)
+        with self.assertRaises(AssertionError):
+            predicate.matches("lib/libfoo.so", None)
+
+
+class SubtreePruningTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_context = tempfile.TemporaryDirectory()
+        self.temp_dir = Path(self.temp_context.name)
+        for path in SAMPLE_PATHS:
+            # Paths which are a prefix of another path are directories.
+            if not path or any(p.startswith(f"{path}/") for p in SAMPLE_PATHS):
+                continue
+            file_path = self.temp_dir / path
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_text("")
+
+    def tearDown(self):
+        self.temp_context.cleanup()
+
+    def scan(self, prune: bool, *args, scan_threads: int = 0) -> PatternMatcher:
+        pm = PatternMatcher(*args)
+        pm.add_basedir(self.temp_dir, prune=prune, scan_threads=scan_threads)
+        return pm
+
+    def assertPruneEquivalent(self, *args) -> PatternMatcher:
+        pruned = self.scan(True, *args)
+        unpruned = self.scan(False, *args)
+        self.assertEqual(
+            [relpath for relpath, _ in pruned.matches()],
+            [relpath for relpath, _ in unpruned.matches()],
+        )
+        return pruned
+
+    def testComponentDefaults(self):
+        for name, defaults in ComponentDefaults.ALL.items():
+            with self.subTest(component=name):
+                self.assertPruneEquivalent(defaults.includes, defaults.excludes)
+
+    def testGlobs(self):
+        for glob in EXTRA_GLOBS:
+            with self.subTest(glob=glob):
+                self.assertPruneEquivalent([glob])
+                self.assertPruneEquivalent([], [glob])
+                self.assertPruneEquivalent([], [glob], ["lib/cmake/foo/**"])
+
+    def testPrunesSubtrees(self):
+        pm = self.assertPruneEquivalent(["bin/**", "lib/*/library/*.dat"])
+        self.assertIn("lib/rocblas/library/TensileLibrary.dat", pm.all)
+        self.assertIn("include", pm.all)
+        self.assertNotIn("include/hip", pm.all)
+        self.assertIn("lib/cmake/foo", pm.all)
+        self.assertNotIn("lib/cmake/foo/fooConfig.cmake", pm.all)
+        pm = self.assertPruneEquivalent([], ["**/share/doc/**"])
+        self.assertIn("share/doc", pm.all)
+        self.assertNotIn("share/doc/README", pm.all)
+        self.assertIn("share/docs/README", pm.all)
+
+    def testScanMatches(self):
+        for prune in [False, True]:
+            for args in [(), (["bin/**", "lib/**"],), ([], ["**/share/doc/**"])]:
+                scanned = self.scan(prune, *args)
+                streamed = PatternMatcher(*args)
+                self.assertEqual(
+                    [
+                        (relpath, entry.path)
+                        for relpath, entry in streamed.scan_matches(
+                            [self.temp_dir], prune=prune
+                        )
+                    ],
+                    [(relpath, entry.path) for relpath, entry in scanned.matches()],
+                )
+                self.assertEqual(len(streamed.all), 0)
+
+    def testParallelScanOrder(self):
+        for prune in [False, True]:
+            serial = self.scan(prune, ["bin/**", "lib/**"])
+            parallel = self.scan(prune, ["bin/**", "lib/**"], scan_threads=4)
+            self.assertEqual(list(serial.all.keys()), list(parallel.all.keys()))
+
+
+class TreeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_context = tempfile.TemporaryDirectory()
+        self.temp_dir = Path(self.temp_context.name)
+
+    def tearDown(self):
+        self.temp_context.cleanup()
+
+    def write(self, relpath: str):
+        path = self.temp_dir / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(relpath)
+
+    # Verifies that entries added with add_object are handed out as is, and
+    # are replaced like any other entry when merging.
+    def testObjects(self):
+        for relpath in ["a/lib/libfoo.so", "b/lib/libfoo.so", "objects/libbar.so"]:
+            self.write(relpath)
+        with os.scandir(self.temp_dir / "objects") as it:
+            (libbar,) = list(it)
+        objects = TreeIndex()
+        root_id = objects.add_root(os.fspath(self.temp_dir / "objects"))
+        lib_id = objects.intern_dir("lib/")
+        objects.add_object(root_id, lib_id, "libfoo.so", libbar)
+        objects.add_object(root_id, lib_id, "libbar.so", libbar)
+        self.assertIs(objects["lib/libbar.so"], libbar)
+        self.assertEqual(list(objects.values()), [libbar, libbar])
+
+        merged = PatternMatcher()
+        merged.add_basedir(self.temp_dir / "a")
+        merged.all.update(objects)
+        self.assertEqual(
+            list(merged.all.keys()), ["lib", "lib/libfoo.so", "lib/libbar.so"]
+        )
+        self.assertIsInstance(merged.all["lib"], TreeEntry)
+        self.assertIs(merged.all["lib/libfoo.so"], libbar)
+        self.assertIs(merged.all.get("lib/libbar.so"), libbar)
+        self.assertEqual(
+            [type(e) for e in merged.all.values()],
+            [TreeEntry, os.DirEntry, os.DirEntry],
+        )
+
+        merged.add_basedir(self.temp_dir / "b")
+        self.assertEqual(
+            merged.all["lib/libfoo.so"].path,
+            os.fspath(self.temp_dir / "b" / "lib" / "libfoo.so"),
+        )
+        self.assertIs(merged.all["lib/libbar.so"], libbar)
+
+    def testMatchesDictSemantics(self):
+        for relpath in ["a/bin/tool", "a/lib/libfoo.so", "b/lib/libfoo.so", "b/x"]:
+            self.write(relpath)
+        (self.temp_dir / "a" / "lib" / "link").symlink_to("libfoo.so")
+        pm = PatternMatcher()
+        pm.add_basedir(self.temp_dir / "a")
+        pm.add_basedir(self.temp_dir / "b")
+
+        # Equivalent to recording os.DirEntry objects in a dict, in scan order.
+        expected: dict[str, os.DirEntry[str]] = {}
+
+        def scan(path: str, prefix: str):
+            with os.scandir(path) as it:
+                for entry in it:
+                    expected[prefix + entry.name] = entry
+                    if entry.is_dir(follow_symlinks=False):
+                        scan(entry.path, f"{prefix}{entry.name}/")
+
+        scan(self.temp_dir / "a", "")
+        scan(self.temp_dir / "b", "")
+        self.assertEqual(list(pm.all.keys()), list(expected.keys()))
+        self.assertEqual(len(pm.all), len(expected))
+        for relpath, entry in pm.all.items():
+            expected_entry = expected[relpath]
+            self.assertEqual(entry.name, expected_entry.name)
+            self.assertEqual(entry.path, expected_entry.path)
+            self.assertEqual(entry.inode(), expected_entry.inode())
+            self.assertEqual(entry.is_dir(), expected_entry.is_dir())
+            self.assertEqual(entry.is_file(), expected_entry.is_file())
+            self.assertEqual(entry.is_symlink(), expected_entry.is_symlink())
+            self.assertEqual(
+                entry.stat(follow_symlinks=False),
+                expected_entry.stat(follow_symlinks=False),
+            )
+            self.assertEqual(os.fspath(entry), expected_entry.path)
+        # The second base directory replaced the entry, in place.
+        self.assertEqual(
+            pm.all["lib/libfoo.so"].path,
+            os.fspath(self.temp_dir / "b" / "lib" / "libfoo.so"),
+        )
+        self.assertNotIn("lib/missing", pm.all)
+        self.assertNotIn("missing/x", pm.all)
+
+        # Merging scans is equivalent to scanning into one matcher.
+        merged = PatternMatcher()
+        for basedir in ["a", "b"]:
+            scan = PatternMatcher()
+            scan.add_basedir(self.temp_dir / basedir)
+            merged.all.update(scan.all)
+        self.assertEqual(
+            [(k, e.path) for k, e in merged.all.items()],
+            [(k, e.path) for k, e in pm.all.items()],
+        )
+
+        # Streaming yields the same entries in the same order, including
+        # across overlapping base directories.
+        for relpath in ["c/lib/libfoo.so", "c/x/y", "c/bin/tool"]:
+            self.write(relpath)
+        (self.temp_dir / "c" / "real").mkdir()
+        self.write("c/real/libbar.so")
+        (self.temp_dir / "b" / "real").symlink_to(self.temp_dir / "c" / "real")
+        basedirs = [self.temp_dir / name for name in ["c", "a", "b"]]
+        scanned = PatternMatcher(excludes=["**/x/**"])
+        for basedir in basedirs:
+            scanned.add_basedir(basedir)
+        streamed = PatternMatcher(excludes=["**/x/**"])
+        self.assertEqual(
+            [(k, e.path, e.is_symlink()) for k, e in streamed.scan_matches(basedirs)],
+            [(k, e.path, e.is_symlink()) for k, e in scanned.matches()],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
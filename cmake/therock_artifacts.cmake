@@ -8,6 +8,13 @@
 # there is just this one for now.
 set_property(GLOBAL PROPERTY THEROCK_DIST_ARTIFACT_DIRS)
 
+# Sources of fileset_tool.py. Its --fingerprint-file hashes them, so commands
+# using it depend on all of them.
+file(GLOB THEROCK_FILESET_TOOL_SOURCES CONFIGURE_DEPENDS
+  "${CMAKE_CURRENT_LIST_DIR}/../build_tools/fileset_tool.py"
+  "${CMAKE_CURRENT_LIST_DIR}/../build_tools/_therock_utils/*.py"
+)
+
 function(therock_provide_artifact slice_name)
   cmake_parse_arguments(PARSE_ARGV 1 ARG
     "TARGET_NEUTRAL"
@@ -50,32 +57,43 @@ function(therock_provide_artifact slice_name)
   set(_stamp_file_deps)
   _therock_cmake_subproject_deps_to_stamp(_stamp_file_deps "stage.stamp" ${ARG_SUBPROJECT_DEPS})
 
-  # Assemble commands.
+  # Assemble command. All components are produced by one invocation so that
+  # stage directories are only scanned once.
   set(_fileset_tool "${THEROCK_SOURCE_DIR}/build_tools/fileset_tool.py")
-  set(_command_list)
+  set(_component_args)
   set(_manifest_files)
   foreach(_component ${ARG_COMPONENTS})
     set(_component_dir "${THEROCK_BINARY_DIR}/artifacts/${slice_name}_${_component}${_bundle_suffix}")
     set_property(GLOBAL APPEND PROPERTY THEROCK_DIST_ARTIFACT_DIRS "${_component_dir}")
     set(_manifest_file "${_component_dir}/artifact_manifest.txt")
     list(APPEND _manifest_files "${_manifest_file}")
-    list(APPEND _command_list
-      COMMAND "${Python3_EXECUTABLE}" "${_fileset_tool}" artifact
-        --output-dir "${_component_dir}"
-        --root-dir "${THEROCK_BINARY_DIR}" --descriptor "${ARG_DESCRIPTOR}"
-        --component "${_component}"
+    list(APPEND _component_args
+      --component "${_component}" --output-dir "${_component_dir}"
     )
   endforeach()
 
-  # Set up command.
+  set(_store_args)
+  if(THEROCK_ARTIFACT_STORE)
+    set(_store_args --store "${THEROCK_ARTIFACT_STORE}")
+  endif()
+
+  # Set up command. If the stage directories did not change since the last
+  # run (per the fingerprint), the tool leaves the manifests untouched. Listing
+  # the fingerprint as a byproduct makes Ninja restat the outputs, so that the
+  # archive and dist commands depending on the manifests do not re-run.
+  set(_fingerprint_file "${THEROCK_BINARY_DIR}/artifacts/.${slice_name}${_bundle_suffix}.fingerprint")
   add_custom_command(
     OUTPUT ${_manifest_files}
+    BYPRODUCTS "${_fingerprint_file}"
     COMMENT "Merging artifact ${slice_name}"
-    ${_command_list}
+    COMMAND "${Python3_EXECUTABLE}" "${_fileset_tool}" artifact --sync
+      --root-dir "${THEROCK_BINARY_DIR}" --descriptor "${ARG_DESCRIPTOR}"
+      --fingerprint-file "${_fingerprint_file}"
+      ${_component_args} ${_store_args}
     DEPENDS
       ${_stamp_file_deps}
       "${ARG_DESCRIPTOR}"
-      "${_fileset_tool}"
+      ${THEROCK_FILESET_TOOL_SOURCES}
   )
   add_custom_target(
     "${_target_name}"
@@ -88,7 +106,7 @@ function(therock_provide_artifact slice_name)
   foreach(_component ${ARG_COMPONENTS})
     set(_component_dir "${THEROCK_BINARY_DIR}/artifacts/${slice_name}_${_component}${_bundle_suffix}")
     set(_manifest_file "${_component_dir}/artifact_manifest.txt")
-    set(_archive_file "${THEROCK_BINARY_DIR}/artifacts/${slice_name}_${_component}${_bundle_suffix}${THEROCK_ARTIFACT_ARCHIVE_SUFFIX}.tar.xz")
+    set(_archive_file "${THEROCK_BINARY_DIR}/artifacts/${slice_name}_${_component}${_bundle_suffix}${THEROCK_ARTIFACT_ARCHIVE_SUFFIX}.tar.${THEROCK_ARTIFACT_ARCHIVE_FORMAT}")
     list(APPEND _archive_files "${_archive_file}")
     set(_archive_sha_file "${_archive_file}.sha256sum")
     add_custom_command(
@@ -101,9 +119,13 @@ function(therock_provide_artifact slice_name)
         artifact-archive "${_component_dir}"
           -o "${_archive_file}"
           --hash-file "${_archive_sha_file}" --hash-algorithm sha256
+          --reproducible
+          --compression-threads "${THEROCK_ARTIFACT_ARCHIVE_THREADS}"
+          -j "${THEROCK_ARTIFACT_ARCHIVE_THREADS}"
       DEPENDS
         "${_manifest_file}"
-        "${_fileset_tool}"
+        ${THEROCK_FILESET_TOOL_SOURCES}
+      JOB_POOL therock_archive
     )
   endforeach()
 
@@ -117,21 +139,27 @@ function(therock_create_dist)
   # settings later.
   set(_dist_dir "${THEROCK_BINARY_DIR}/dist/rocm")
   set(_stamp_file "${THEROCK_BINARY_DIR}/dist/.rocm.stamp")
+  set(_fingerprint_file "${THEROCK_BINARY_DIR}/dist/.rocm.fingerprint")
   set(_dist_name "rocm")
   get_property(_artifact_dirs GLOBAL PROPERTY THEROCK_DIST_ARTIFACT_DIRS)
 
   set(_fileset_tool "${THEROCK_SOURCE_DIR}/build_tools/fileset_tool.py")
   list(TRANSFORM _artifact_dirs APPEND "/artifact_manifest.txt" OUTPUT_VARIABLE _manifest_files)
 
+  # As for sub-project dist directories, the stamp is a copy of the
+  # fingerprint, so that it (and what depends on it) only changes when the
+  # dist directory does.
   add_custom_command(
     OUTPUT "${_stamp_file}"
+    BYPRODUCTS "${_fingerprint_file}"
     COMMENT "Creating dist ${_dist_dir}"
-    COMMAND "${Python3_EXECUTABLE}" "${_fileset_tool}" artifact-flatten --verbose
+    COMMAND "${Python3_EXECUTABLE}" "${_fileset_tool}" artifact-flatten --sync --verbose
+      --fingerprint-file "${_fingerprint_file}"
       -o "${_dist_dir}" ${_artifact_dirs}
     COMMAND
-      "${CMAKE_COMMAND}" -E touch "${_stamp_file}"
+      "${CMAKE_COMMAND}" -E copy_if_different "${_fingerprint_file}" "${_stamp_file}"
     DEPENDS
-      "${_fileset_tool}"
+      ${THEROCK_FILESET_TOOL_SOURCES}
       ${_manifest_files}
   )
 
@@ -14,4 +14,16 @@ function(therock_setup_job_pools)
   set_property(GLOBAL APPEND PROPERTY JOB_POOLS therock_background=${_background_jobs})
 endfunction()
 
+# Artifact archive commands each compress on THEROCK_ARTIFACT_ARCHIVE_THREADS
+# threads. Only run as many of them at once as there are cores for, so that
+# the number of compression threads (and their memory) stays bounded.
+function(therock_setup_archive_job_pool)
+  ProcessorCount(CORE_COUNT)
+  math(EXPR _archive_jobs "${CORE_COUNT} / ${THEROCK_ARTIFACT_ARCHIVE_THREADS}")
+  if(_archive_jobs LESS 1)
+    set(_archive_jobs 1)
+  endif()
+  set_property(GLOBAL APPEND PROPERTY JOB_POOLS therock_archive=${_archive_jobs})
+endfunction()
+
 therock_setup_job_pools()
@@ -647,19 +647,27 @@ function(therock_cmake_subproject_activate target_name)
   add_dependencies("${target_name}" "${target_name}+stage")
 
   # dist install target.
+  # The dist stamp is a copy of the fingerprint of the stage directories, and
+  # only changes when they do: if they did not, the copy is skipped and Ninja
+  # (which restats commands with byproducts) does not re-run dependents, such
+  # as the configure steps of downstream sub-projects.
   set(_dist_stamp_file "${_stamp_dir}/dist.stamp")
+  set(_dist_fingerprint_file "${_stamp_dir}/dist.fingerprint")
   set(_fileset_tool "${THEROCK_SOURCE_DIR}/build_tools/fileset_tool.py")
   _therock_cmake_subproject_get_stage_dirs(
     _dist_source_dirs "${target_name}" ${_runtime_deps})
   add_custom_command(
     OUTPUT "${_dist_stamp_file}"
-    COMMAND "${Python3_EXECUTABLE}" "${_fileset_tool}" copy "${_dist_dir}" ${_dist_source_dirs}
-    COMMAND "${CMAKE_COMMAND}" -E touch "${_dist_stamp_file}"
+    BYPRODUCTS "${_dist_fingerprint_file}"
+    COMMAND "${Python3_EXECUTABLE}" "${_fileset_tool}" copy --sync
+      --fingerprint-file "${_dist_fingerprint_file}"
+      "${_dist_dir}" ${_dist_source_dirs}
+    COMMAND "${CMAKE_COMMAND}" -E copy_if_different "${_dist_fingerprint_file}" "${_dist_stamp_file}"
     COMMENT "Merging sub-project dist directory for ${target_name}"
     ${_terminal_option}
     DEPENDS
       "${_stage_stamp_file}"
-      "${_fileset_tool}"
+      ${THEROCK_FILESET_TOOL_SOURCES}
   )
   add_custom_target(
     "${target_name}+dist"